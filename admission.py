@@ -0,0 +1,79 @@
+import collections
+import math
+import tornado.concurrent
+import tornado.ioloop
+
+
+# Raised through AdmissionControl.acquire() when a request cannot start in time
+# reason is "queue_full" or "timeout", retry_after the seconds clients should wait before retrying
+class Rejected(Exception):
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# Admission control: a concurrency limit with a bounded wait queue
+# At most max_concurrent callers hold a slot at once. Up to max_queue more wait for
+# one, first come first served, each for at most queue_timeout seconds. Callers past
+# either bound are rejected straight away, instead of piling up until they all time
+# out together. max_concurrent 0 admits everyone without limit.
+# Must be used from the IOLoop thread.
+class AdmissionControl(object):
+
+    def __init__(self, max_concurrent, max_queue=0, queue_timeout=1.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = max(1, int(math.ceil(queue_timeout)))
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "timeout": 0}
+        self._waiters = collections.deque()  # (future, timeout handle)
+
+    def acquire(self):
+        # Resolves once the caller holds a slot, which it must then give back with release()
+        future = tornado.concurrent.Future()
+        if self.max_concurrent <= 0 or (self.in_flight < self.max_concurrent and not self._waiters):
+            self._admit(future)
+        elif len(self._waiters) >= self.max_queue or self.queue_timeout <= 0:
+            self._reject(future, "queue_full")
+        else:
+            timeout = tornado.ioloop.IOLoop.current().call_later(self.queue_timeout, self._expire, future)
+            self._waiters.append((future, timeout))
+        return future
+
+    def release(self):
+        self.in_flight -= 1
+        if self._waiters:
+            future, timeout = self._waiters.popleft()
+            tornado.ioloop.IOLoop.current().remove_timeout(timeout)
+            self._admit(future)
+
+    def _admit(self, future):
+        self.in_flight += 1
+        self.admitted += 1
+        future.set_result(None)
+
+    def _expire(self, future):
+        for entry in self._waiters:
+            if entry[0] is future:
+                self._waiters.remove(entry)
+                break
+        self._reject(future, "timeout")
+
+    def _reject(self, future, reason):
+        self.rejected[reason] += 1
+        future.set_exception(Rejected(reason, self.retry_after))
+
+    def queued(self):
+        return len(self._waiters)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+        }
@@ -0,0 +1,104 @@
+import collections
+import time
+
+
+# Raised instead of calling an upstream whose circuit breaker is open
+# retry_after is the number of seconds until the breaker lets a trial request through
+class CircuitOpen(Exception):
+
+    def __init__(self, name, retry_after):
+        super().__init__("circuit open for upstream {}".format(name))
+        self.name = name
+        self.retry_after = retry_after
+
+
+# Circuit breaker tripping on the error rate of recent calls
+# While closed, the outcomes of the calls made in the last window seconds are kept,
+# and the breaker opens once at least min_requests of them saw an error_rate share
+# of failures. While open, callers are turned away straight away for open_for seconds,
+# after which the breaker is half open: a single trial call is let through, and
+# closes the breaker again if it succeeds, or reopens it if it fails.
+# allow() hands every call it lets through a token, to be given back to record(). Tokens
+# change with every state change, so only outcomes of calls allowed in the current state
+# count: a call started before the breaker opened cannot pass for the trial, nor count
+# towards the window once the breaker is closed again.
+class CircuitBreaker(object):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, error_rate=0.5, min_requests=20, window=10.0, open_for=5.0, clock=time.monotonic):
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.open_for = open_for
+        self.clock = clock
+        self.state = self.CLOSED
+        self.trips = 0
+        self._opened_at = None
+        self._token = object()  # handed out by allow() in the current state
+        self._trial_pending = False
+        self._outcomes = collections.deque()  # (time, failed) of the calls within the window
+        self._failures = 0
+
+    def allow(self):
+        # Token of a call that may go ahead now, None if it may not
+        # Every allowed call must be followed by record() with its token
+        if self.state == self.CLOSED:
+            return self._token
+        if self.state == self.OPEN:
+            if self.clock() < self._opened_at + self.open_for:
+                return None
+            self.state = self.HALF_OPEN
+            self._token = object()
+            self._trial_pending = False
+        if self._trial_pending:
+            return None
+        self._trial_pending = True
+        return self._token
+
+    def record(self, token, failed):
+        if token is not self._token:
+            # Late outcome of a call allowed before the last state change
+            return
+        now = self.clock()
+        if self.state == self.HALF_OPEN:
+            if failed:
+                self._open(now)
+            else:
+                self.state = self.CLOSED
+                self._token = object()
+                self._outcomes.clear()
+                self._failures = 0
+            return
+
+        self._outcomes.append((now, failed))
+        self._failures += failed
+        while self._outcomes and self._outcomes[0][0] <= now - self.window:
+            _, expired_failed = self._outcomes.popleft()
+            self._failures -= expired_failed
+        if len(self._outcomes) >= self.min_requests and self._failures >= self.error_rate * len(self._outcomes):
+            self._open(now)
+
+    def retry_after(self):
+        # Seconds until a trial call is let through, 0 unless the breaker is open
+        if self.state != self.OPEN:
+            return 0
+        return max(0.0, self._opened_at + self.open_for - self.clock())
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.trips += 1
+        self._opened_at = now
+        self._token = object()
+        self._trial_pending = False
+        self._outcomes.clear()
+        self._failures = 0
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "trips": self.trips,
+            "recent_calls": len(self._outcomes),
+            "recent_failures": self._failures,
+        }
@@ -0,0 +1,105 @@
+import time
+from collections import OrderedDict
+
+
+# In-process response cache with a TTL and LRU eviction
+# Entries expire ttl seconds after being stored, and the least recently used ones
+# are evicted once either max_entries or max_bytes (as reported by callers) is exceeded.
+# clear() bumps a generation number: a value computed before an invalidation is
+# dropped by set() instead of re-populating the cache with stale data.
+# With stale_ttl, expired entries are kept stale_ttl seconds longer, only for
+# get_stale() to fall back on when a fresh value cannot be computed.
+class ResponseCache(object):
+
+    def __init__(self, ttl, max_entries=1000, max_bytes=64 * 1024 * 1024, stale_ttl=0, clock=time.monotonic):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.generation = 0
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_hits = 0
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, size, value = entry
+        now = self.clock()
+        if expires_at <= now:
+            if expires_at + self.stale_ttl <= now:
+                self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, size, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+        # Entries that could never fit are not cached at all
+        if size > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (self.clock() + self.ttl, size, value)
+        self.size_bytes += size
+
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def get_stale(self, key):
+        # The value stored for key, even past its ttl, as long as it is within stale_ttl
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, _, value = entry
+        if expires_at + self.stale_ttl <= self.clock():
+            return None
+        self.stale_hits += 1
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.size_bytes = 0
+        self.generation += 1
+        self.invalidations += 1
+
+    def invalidate(self, keys):
+        # Like clear(), for the entries of keys only
+        for key in keys:
+            if key in self._entries:
+                self._remove(key)
+        self.generation += 1
+        self.invalidations += 1
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "stale_hits": self.stale_hits,
+        }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.size_bytes -= size
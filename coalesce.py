@@ -0,0 +1,37 @@
+import tornado.gen
+
+
+# Request coalescing (single-flight)
+# The first caller for a key starts the work, and every caller arriving while it is
+# still running gets the very same future, so they all share one result (or error).
+# Results are shared as is and must not be mutated by callers.
+class SingleFlight(object):
+
+    def __init__(self):
+        self.started = 0
+        self.coalesced = 0
+        self._in_flight = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return future
+
+        future = tornado.gen.convert_yielded(fn(*args, **kwargs))
+        self.started += 1
+        self._in_flight[key] = future
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key, future):
+        # A newer flight may already be registered under the same key
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+
+    def stats(self):
+        return {
+            "in_flight": len(self._in_flight),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
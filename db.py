@@ -0,0 +1,264 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+
+# Non-blocking access to a SQLite database file
+# Queries run on a bounded pool of reader threads, each holding its own connection,
+# and writes run on a single writer thread so they never contend for SQLite's write lock.
+# Every method returns a future that tornado coroutines can yield.
+# With group_commit_window set, single writes arriving within the window (or up to
+# group_commit_max_batch of them) are committed together in one transaction.
+# An optional observer(operation, seconds) is told how long every "query" and
+# "write" call, and every "commit" within them, took.
+class Database(object):
+
+    def __init__(self, path, pool_size=4, busy_timeout=5000,
+                 group_commit_window=None, group_commit_max_batch=128, observer=None):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.observer = observer
+        self.group_commit_window = group_commit_window
+        self.group_commit_max_batch = group_commit_max_batch
+        self._pending = []
+        self._flush_timeout = None
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._readers = ThreadPoolExecutor(max_workers=pool_size)
+        self._writer = ThreadPoolExecutor(max_workers=1)
+
+    def connect(self):
+        # WAL lets readers keep reading while the writer commits
+        conn = sqlite3.connect(self.path, check_same_thread=False, factory=_Connection)
+        conn.observer = self.observer
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA busy_timeout={};".format(int(self.busy_timeout)))
+        return conn
+
+    def _connection(self):
+        # One connection per executor thread, opened lazily on first use
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.connect()
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, operation, fn, args):
+        if self.observer is None:
+            return fn(self._connection(), *args)
+        start = time.monotonic()
+        try:
+            return fn(self._connection(), *args)
+        finally:
+            self.observer(operation, time.monotonic() - start)
+
+    def run(self, fn, *args):
+        # Runs fn(conn, *args) on a reader thread
+        return _on_io_loop(self._readers.submit(self._call, "query", fn, args))
+
+    def run_write(self, fn, *args):
+        # Runs fn(conn, *args) on the writer thread
+        return _on_io_loop(self._writer.submit(self._call, "write", fn, args))
+
+    def query(self, stmt, args=()):
+        return self.run(_fetchall, stmt, args)
+
+    def stream(self, stmt, args=(), chunk_size=1000):
+        # Iterates a query lazily, chunk_size rows at a time, see QueryStream
+        return QueryStream(self, stmt, args, chunk_size)
+
+    def execute(self, stmt, args=()):
+        # Runs a single write statement, resolving to lastrowid once it is committed
+        if self.group_commit_window is None:
+            return self.run_write(_execute_commit, stmt, args)
+
+        # Group commit: queue the write and commit it along with its neighbours
+        # Must be called from the IOLoop thread
+        future = Future()
+        self._pending.append((stmt, args, future))
+        if len(self._pending) >= self.group_commit_max_batch:
+            self._flush()
+        elif self._flush_timeout is None:
+            self._flush_timeout = IOLoop.current().call_later(self.group_commit_window, self._flush)
+        return future
+
+    def execute_many(self, stmt, rows, id_step=1):
+        # Inserts every row with one executemany in one transaction, resolving to the list of new ids
+        # id_step is the gap between consecutive ids handed out by stmt (see sharding.next_id_sql)
+        return self.run_write(_execute_many_commit, stmt, rows, id_step)
+
+    def _flush(self):
+        if self._flush_timeout is not None:
+            IOLoop.current().remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        statements = [(stmt, args) for stmt, args, _ in batch]
+        IOLoop.current().add_future(
+            self.run_write(_execute_batch_commit, statements),
+            lambda result: self._resolve_batch(batch, result)
+        )
+
+    def _resolve_batch(self, batch, result):
+        try:
+            outcomes = result.result()
+        except Exception as e:
+            # The commit itself failed, so none of the writes are durable
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, _, future), (lastrowid, error) in zip(batch, outcomes):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(lastrowid)
+
+    def close(self):
+        self._flush()
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+
+
+# Connection reporting commit durations to the Database observer
+class _Connection(sqlite3.Connection):
+    observer = None
+
+    def commit(self):
+        if self.observer is None:
+            return super().commit()
+        start = time.monotonic()
+        try:
+            return super().commit()
+        finally:
+            self.observer("commit", time.monotonic() - start)
+
+
+# Lazily iterated query result
+# The cursor lives on a dedicated connection, and each next_chunk() call runs one
+# fetchmany on a reader thread, so only one chunk of rows is in memory at a time.
+# Calls must not overlap: wait for each chunk before asking for the next one,
+# and close() the stream once done with it.
+class QueryStream(object):
+
+    def __init__(self, db, stmt, args, chunk_size):
+        self.chunk_size = chunk_size
+        self._db = db
+        self._stmt = stmt
+        self._args = args
+        self._conn = None
+        self._cursor = None
+        self._done = False
+
+    def next_chunk(self):
+        # Resolves to the next list of rows, an empty list once the result is exhausted
+        return _on_io_loop(self._db._readers.submit(self._fetch))
+
+    def _fetch(self):
+        if self._done:
+            return []
+        if self._cursor is None:
+            self._conn = self._db.connect()
+            self._cursor = self._conn.execute(self._stmt, self._args)
+        rows = self._cursor.fetchmany(self.chunk_size)
+        if len(rows) < self.chunk_size:
+            self._done = True
+        return rows
+
+    def close(self):
+        self._done = True
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            self._cursor = None
+
+
+# Executor futures resolve on the executor thread, which does not wake the IOLoop up
+# when several of them are waited on at once (yield [...]). The returned tornado
+# Future is resolved on the IOLoop instead. Must be called from the IOLoop thread.
+def _on_io_loop(concurrent_future):
+    future = Future()
+
+    def copy(concurrent_future):
+        error = concurrent_future.exception()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(concurrent_future.result())
+
+    IOLoop.current().add_future(concurrent_future, copy)
+    return future
+
+
+def _fetchall(conn, stmt, args):
+    return conn.execute(stmt, args).fetchall()
+
+
+def _execute_commit(conn, stmt, args):
+    try:
+        cursor = conn.execute(stmt, args)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return cursor.lastrowid
+
+
+def _execute_many_commit(conn, stmt, rows, id_step=1):
+    rows = list(rows)
+    if not rows:
+        return []
+    try:
+        conn.executemany(stmt, rows)
+        # The writer holds the write lock for the whole transaction, so the
+        # ids handed out to this batch are consecutive (id_step apart)
+        last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return list(range(last_id - (len(rows) - 1) * id_step, last_id + 1, id_step))
+
+
+def _execute_batch_commit(conn, statements):
+    # Runs every statement in one transaction, returning a (lastrowid, error) per statement
+    # A failing statement is rolled back to its savepoint on its own and does not abort
+    # the rest of the batch. Some errors (SQLITE_FULL, SQLITE_IOERR, SQLITE_BUSY, RAISE(ROLLBACK)
+    # in a trigger...) make SQLite roll the whole transaction back though, and then the
+    # error is raised, failing every statement of the batch.
+    outcomes = []
+    try:
+        # Begun explicitly, releasing the outermost savepoint would commit otherwise
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        for stmt, args in statements:
+            conn.execute("SAVEPOINT batch_statement")
+            try:
+                cursor = conn.execute(stmt, args)
+            except sqlite3.Error as e:
+                if not conn.in_transaction:
+                    raise
+                conn.execute("ROLLBACK TO batch_statement")
+                conn.execute("RELEASE batch_statement")
+                outcomes.append((None, e))
+                continue
+            conn.execute("RELEASE batch_statement")
+            outcomes.append((cursor.lastrowid, None))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return outcomes
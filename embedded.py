@@ -0,0 +1,115 @@
+import tornado.gen
+import tornado.options
+import types
+import listing_service
+import publicapi_service
+import user_service
+import serving
+
+
+# Reads publicapi_service makes, served in-process by the listing_service and user_service
+# apps of the same process: the same queries GET /listings and GET /users run, without the
+# loopback HTTP round trips and the encoding and decoding on both ends.
+# Has the same coroutines as publicapi_service.UpstreamReads.
+class LocalReads(object):
+
+    def __init__(self, listing_app, user_app):
+        self.listing_app = listing_app
+        self.user_app = user_app
+
+    @tornado.gen.coroutine
+    def versions(self):
+        return self.listing_app.data_version, self.user_app.data_version
+
+    # Versions are read before the queries run, which reflect them at least
+    @tornado.gen.coroutine
+    def listings_page(self, page_num, page_size, filters):
+        version = self.listing_app.data_version
+        filters = {field: value for field, value in filters.items() if value is not None}
+        results = yield listing_service.query_listings(
+            self.listing_app.shards, filters, page_size, page_num=page_num)
+        return [dict(zip(listing_service.LISTING_FIELDS, row)) for row in results], version
+
+    @tornado.gen.coroutine
+    def users_by_ids(self, ids):
+        version = self.user_app.data_version
+        results = yield self.user_app.lookup_users(ids)
+        return [dict(zip(user_service.USER_FIELDS, row)) for row in results], version
+
+
+# Copy of options (tornado's, or any namespace) with some of them replaced
+def _with(options, **overrides):
+    if isinstance(options, tornado.options.OptionParser):
+        values = options.as_dict()
+    else:
+        values = dict(vars(options))
+    values.update(overrides)
+    return types.SimpleNamespace(**values)
+
+
+# Builds the publicapi_service, listing_service and user_service apps, in that order
+# publicapi_service reads from the other two in-process, its writes still go through
+# its write-behind queues to their batch endpoints, on options.listing_port and options.user_port
+def make_apps(options):
+    listing_app = listing_service.make_app(_with(options, db_path=options.listing_db_path))
+    user_app = user_service.make_app(_with(options, db_path=options.user_db_path))
+    public_app = publicapi_service.make_app(
+        _with(
+            options,
+            listing_service_urls=["http://127.0.0.1:{}".format(options.listing_port)],
+            user_service_urls=["http://127.0.0.1:{}".format(options.user_port)]
+        ),
+        reads=LocalReads(listing_app, user_app)
+    )
+    return [public_app, listing_app, user_app]
+
+
+# Options of the embedded launcher, the three services' options with a port and a db_path per service
+def define_options(parser=tornado.options.options):
+    # Specify the port number publicapi_service listens on
+    parser.define("port", default=6533)
+    # Specify the port number listing_service listens on
+    parser.define("listing_port", default=6555)
+    # Specify the port number user_service listens on
+    parser.define("user_port", default=6524)
+    # Specify whether the apps should run in debug mode
+    # Debug mode restarts the process automatically on file changes, only use it in development
+    parser.define("debug", default=False)
+    # Define the process model options (processes, reuse_port, shutdown_timeout, max_restarts)
+    serving.define_options(parser)
+    # Specify the JSON backend: orjson, ujson, json, or auto to pick the fastest installed one
+    parser.define("json_backend", default="auto")
+    # Specify the listing_service SQLite database file
+    parser.define("listing_db_path", default="listings.db")
+    # Specify the user_service SQLite database file
+    parser.define("user_db_path", default="users.db")
+    # Specify the number of threads (and SQLite connections) serving queries, for each service
+    parser.define("db_pool_size", default=4)
+    # Specify the number of db files listings are sharded over by user_id (cannot change once data exists)
+    parser.define("db_shards", default=1)
+    # Specify how long (in ms) inserts may wait to be committed together with others (0 disables group commit)
+    parser.define("group_commit_window_ms", default=0)
+    # Specify the maximum number of inserts committed in one group commit transaction
+    parser.define("group_commit_max_batch", default=128)
+    # Specify how often (in ms) the data versions and the listing stats are re-read from the dbs,
+    # so that writes made by other processes are noticed (0 disables, only safe with a single process)
+    parser.define("version_refresh_ms", default=1000)
+    # Define the user_service cache options
+    user_service.define_options(parser)
+    # Define the publicapi_service upstream, cache, write queue and admission control options
+    publicapi_service.define_options(parser)
+
+
+if __name__ == "__main__":
+    # Define settings/options for the web app
+    define_options()
+
+    # Read settings/options from command line
+    tornado.options.parse_command_line()
+
+    # Access the settings defined
+    options = tornado.options.options
+
+    # Create web apps and start the event loop(s)
+    serving.serve_apps(
+        make_apps, [options.port, options.listing_port, options.user_port], options, "embedded services")
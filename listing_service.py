@@ -1,24 +1,210 @@
 import tornado.web
 import tornado.log
 import tornado.options
-import sqlite3
+import tornado.escape
+import tornado.iostream
+import tornado.locks
+import tornado.ioloop
 import logging
-import json
 import time
+import base64
+import hashlib
+import datetime
+from contextlib import closing
+from db import Database
+from sharding import ShardSet, shard_paths, next_id_sql
+from stats import ListingStats
+from metrics import Registry, RequestMetrics, DatabaseMetrics, MetricsHandler
+import serialization
+import serving
+
+
+# Range of SQLite integers, larger values cannot be bound to a statement
+MIN_INTEGER = -2 ** 63
+MAX_INTEGER = 2 ** 63 - 1
+# Range of prices, bounding the open end of a price range
+MIN_PRICE = MIN_INTEGER
+MAX_PRICE = MAX_INTEGER
+# Maximum number of items accepted by a single batch request
+MAX_BATCH_SIZE = 10000
+# Maximum number of rows returned by a single change feed request
+MAX_CHANGES_LIMIT = 1000
+# Maximum number of seconds a change feed request may long-poll for
+MAX_CHANGES_WAIT = 60
+# Interval (in seconds) at which long-polling readers re-check the db, to also pick up
+# writes committed by other processes, which do not notify this one
+CHANGES_POLL_INTERVAL = 1.0
+# Delay (in seconds) before retrying a failed initial stats load, when there are no periodic refreshes
+STATS_RETRY_DELAY = 5.0
+
+# Inserts a listing with the next id of its shard, taking the shard index and the
+# number of shards ahead of the listing's fields
+INSERT_LISTING_STMT = (
+    "INSERT INTO 'listings' "
+    + "('id', 'user_id', 'listing_type', 'price', 'created_at', 'updated_at') "
+    + "VALUES (" + next_id_sql("listings") + ", ?, ?, ?, ?, ?)"
+)
 
 
 class App(tornado.web.Application):
 
-    def __init__(self, handlers, **kwargs):
+    def __init__(self, handlers, db_path="listings.db", db_pool_size=4, db_shards=1,
+                 group_commit_window_ms=0, group_commit_max_batch=128, version_refresh_ms=1000, **kwargs):
         super().__init__(handlers, **kwargs)
 
-        # Initialising db connection
-        self.db = sqlite3.connect("listings.db")
-        self.db.row_factory = sqlite3.Row
+        # Initialising metrics, served on /metrics
+        self.metrics = Registry()
+        self.request_metrics = RequestMetrics(self.metrics)
+
+        # Initialising db access layer, queries run off the IOLoop thread
+        # Listings are sharded by user_id over db_shards files, each with its own
+        # connections and writer. A non-zero group commit window batches concurrent
+        # inserts into one transaction per shard.
+        db_observer = DatabaseMetrics(self.metrics)
+        self.shards = ShardSet([
+            Database(
+                path,
+                pool_size=db_pool_size,
+                group_commit_window=(group_commit_window_ms / 1000.0) if group_commit_window_ms > 0 else None,
+                group_commit_max_batch=group_commit_max_batch,
+                observer=db_observer
+            )
+            for path in shard_paths(db_path, db_shards)
+        ])
         self.init_db()
 
+        # Long-polling change feed readers wait on this until a write commits
+        self.changes = tornado.locks.Condition()
+
+        # Price statistics served on /listings/stats, loaded from the db in the
+        # background, then updated by every write, see count_listings and refresh_stats
+        self.stats = ListingStats()
+        self.stats_seen = [0] * len(self.shards)  # highest id read from each shard
+        self.stats_written = set()  # ids counted by count_listings, not read from the db yet
+        self.stats_lock = tornado.locks.Lock()
+        self.stats_loaded = tornado.locks.Event()
+        self.stats_attempted = tornado.locks.Event()  # set once the first load has succeeded or failed
+        self.closed = False
+        tornado.ioloop.IOLoop.current().add_callback(self.refresh_stats)
+
+        # Writes made by other processes only show up in data_version and the stats once they are re-read
+        self.periodic_refresh = None
+        if version_refresh_ms > 0:
+            self.periodic_refresh = tornado.ioloop.PeriodicCallback(self.refresh, version_refresh_ms)
+            self.periodic_refresh.start()
+
+    def log_request(self, handler):
+        super().log_request(handler)
+        self.request_metrics.observe(handler)
+
+    def notify_changes(self, *last_ids):
+        # Releases long-polling change feed readers, called once a write has committed
+        # with the last id written to every shard involved
+        for last_id in last_ids:
+            self.bump_version(last_id)
+        self.changes.notify_all()
+
+    def bump_version(self, last_id):
+        # Rows are only ever inserted, so the highest id of a shard changes on every
+        # write to it, and ids are handed out in commit order. The data version is
+        # the sum of every shard's highest id.
+        if last_id is None:
+            return
+        index = self.shards.index_for(last_id)
+        if last_id > self.shard_versions[index]:
+            self.shard_versions[index] = last_id
+            self.data_version = sum(self.shard_versions)
+
+    def count_listings(self, listings):
+        # Adds listings written by this process to the stats as soon as they are committed
+        # Listings already read from the db by refresh_stats are not counted twice, and
+        # the ones counted here are skipped once refresh_stats reads them
+        for listing in listings:
+            if listing["id"] <= self.stats_seen[self.shards.index_for(listing["id"])]:
+                continue
+            self.stats.add(listing["user_id"], listing["listing_type"], listing["price"])
+            # Without periodic refreshes the db is only ever read once, at startup
+            if self.periodic_refresh is not None or not self.stats_loaded.is_set():
+                self.stats_written.add(listing["id"])
+
+    @tornado.gen.coroutine
+    def refresh_stats(self):
+        # Reads every listing committed since the last refresh, by any process, into the stats
+        # Ids of a shard grow in commit order, so the rows left to read are the ones with a higher id
+        with (yield self.stats_lock.acquire()):
+            if self.closed:
+                return
+            try:
+                for index, db in enumerate(self.shards):
+                    stream = db.stream(
+                        "SELECT id, user_id, listing_type, price FROM listings WHERE id>? ORDER BY id",
+                        (self.stats_seen[index],)
+                    )
+                    try:
+                        while True:
+                            rows = yield stream.next_chunk()
+                            if not rows:
+                                break
+                            for row in rows:
+                                if row["id"] in self.stats_written:
+                                    self.stats_written.discard(row["id"])
+                                else:
+                                    self.stats.add(row["user_id"], row["listing_type"], row["price"])
+                            self.stats_seen[index] = rows[-1]["id"]
+                    finally:
+                        stream.close()
+            except:
+                logging.exception("Error while refreshing listing stats")
+                # Periodic refreshes retry on their own, otherwise the load is retried until it succeeds
+                if self.periodic_refresh is None and not self.stats_loaded.is_set():
+                    tornado.ioloop.IOLoop.current().call_later(STATS_RETRY_DELAY, self.refresh_stats)
+            else:
+                self.stats_loaded.set()
+            self.stats_attempted.set()
+
+    @tornado.gen.coroutine
+    def refresh(self):
+        yield self.refresh_version()
+        yield self.refresh_stats()
+
+    @tornado.gen.coroutine
+    def refresh_version(self):
+        try:
+            for db in self.shards:
+                results = yield db.query("SELECT MAX(id) AS version FROM listings")
+                self.bump_version(results[0]["version"])
+        except:
+            logging.exception("Error while refreshing data version")
+
+    def close(self):
+        # Flushes pending group commits and closes every db connection
+        self.closed = True
+        if self.periodic_refresh is not None:
+            self.periodic_refresh.stop()
+        self.shards.close()
+
     def init_db(self):
-        cursor = self.db.cursor()
+        # Schema setup and the initial data version read run once at startup, on short-lived connections
+        self.shard_versions = []
+        for db in self.shards:
+            with closing(db.connect()) as conn:
+                self._create_schema(conn)
+                self._check_shard_count(conn, db.path)
+                self.shard_versions.append(conn.execute("SELECT MAX(id) FROM listings").fetchone()[0] or 0)
+        self.data_version = sum(self.shard_versions)
+
+    def _check_shard_count(self, conn, path):
+        # Rows are placed by user_id % number of shards, so the number of shards
+        # cannot change once a shard has been created. It is kept in user_version.
+        user_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if user_version == 0:
+            conn.execute("PRAGMA user_version={}".format(len(self.shards)))
+            conn.commit()
+        elif user_version != len(self.shards):
+            raise ValueError("{} belongs to a set of {} shards, not {}".format(path, user_version, len(self.shards)))
+
+    def _create_schema(self, conn):
+        cursor = conn.cursor()
 
         # Create table
         cursor.execute(
@@ -31,20 +217,236 @@ class App(tornado.web.Application):
             + "updated_at INTEGER NOT NULL"
             + ");"
         )
-        self.db.commit()
+
+        # Create indexes backing the (created_at, id) ordering used by pagination,
+        # so that both page_num and cursor pages are served by an index range scan
+        # whatever the filters (see listings_query). listing_type and price come last:
+        # they are checked on the index entries, and only matching rows are read.
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS 'idx_listings_created_at_filters' "
+            + "ON 'listings' (created_at, id, listing_type, price);"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS 'idx_listings_user_id_created_at_filters' "
+            + "ON 'listings' (user_id, created_at, id, listing_type, price);"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS 'idx_listings_listing_type_created_at' "
+            + "ON 'listings' (listing_type, created_at, id, price);"
+        )
+        # Create index serving price ranges on their own, which would otherwise walk the whole
+        # created_at index however narrow the range. It holds every selected column, so the
+        # listings in the range are read from it alone; they are then sorted, keeping only
+        # the rows of the page (see listings_query).
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS 'idx_listings_price_covering' "
+            + "ON 'listings' (price, created_at, id, user_id, listing_type, updated_at);"
+        )
+        # Drop the indexes superseded by the ones above
+        cursor.execute("DROP INDEX IF EXISTS 'idx_listings_created_at';")
+        cursor.execute("DROP INDEX IF EXISTS 'idx_listings_user_id_created_at';")
+
+        # Create index finding where the change feed starts when resuming from an updated_at
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS 'idx_listings_updated_at' "
+            + "ON 'listings' (updated_at, id);"
+        )
+        conn.commit()
 
 
 class BaseHandler(tornado.web.RequestHandler):
     def write_json(self, obj, status_code=200):
-        self.set_header("Content-Type", "application/json")
+        # Compact output unless ?pretty=1 is passed, MessagePack when the client accepts it
+        self.set_header("Vary", "Accept")
         self.set_status(status_code)
-        self.write(json.dumps((obj), indent=4))
+        if status_code != 200:
+            # Errors are never cached, see check_not_modified
+            self.clear_header("Etag")
+        if self.binary_requested():
+            self.set_header("Content-Type", serialization.MSGPACK_CONTENT_TYPES[0])
+            self.write(serialization.dumps_binary(obj))
+            return
+        pretty = self.get_argument("pretty", "0").lower() in ("1", "true")
+        self.set_header("Content-Type", "application/json")
+        self.write(serialization.dumps(obj, pretty=pretty))
+
+    def binary_requested(self):
+        return serialization.binary_accepted(self.request.headers.get("Accept"))
+
+    def columnar_requested(self):
+        # ?format=columnar returns pages as one array per column instead of one object per row
+        return self.get_argument("format", "rows") == "columnar"
+
+    def check_not_modified(self):
+        # Tags the response with the data version and the query args, and answers
+        # with 304 when the client's If-None-Match still matches, before any SQL runs
+        # JSON and MessagePack responses are different representations, with different tags
+        uri = self.request.uri + (" msgpack" if self.binary_requested() else "")
+        version = self.application.data_version
+        self.set_header("Etag", version_etag(version, uri))
+        # The response reflects at least this version, publicapi_service tags its pages with it
+        self.set_header("X-Data-Version", str(version))
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    @tornado.gen.coroutine
+    def write_ndjson(self, stream, fields):
+        # Streams query rows as newline-delimited JSON, one chunk of rows at a time
+        # Waiting on flush() after each chunk means a slow client slows down the reads
+        # instead of rows piling up in memory
+        self.set_header("Content-Type", "application/x-ndjson")
+        try:
+            while True:
+                rows = yield stream.next_chunk()
+                if not rows:
+                    break
+                lines = [
+                    tornado.escape.utf8(serialization.dumps({field: row[field] for field in fields}))
+                    for row in rows
+                ]
+                self.write(b"\n".join(lines) + b"\n")
+                yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            logging.info("Client closed the connection during export")
+        finally:
+            stream.close()
+
+
+# Columns of a listing, in the order GET /listings selects them
+LISTING_FIELDS = ("id", "user_id", "listing_type", "price", "created_at", "updated_at")
+
+
+# Strong ETag for a response computed from the data version and the request URI
+def version_etag(version, uri):
+    digest = hashlib.sha1(tornado.escape.utf8(uri)).hexdigest()[:16]
+    return '"{}-{}"'.format(version, digest)
+
+
+# Builds the select statement of a GET /listings page, resolving to (stmt, args)
+# filters may hold user_id, listing_type, min_price and max_price, and after is the
+# (created_at, id) of the row to resume after. The statement ends with a LIMIT
+# placeholder, for the caller to fill in (and to follow with an OFFSET if needed).
+# Every combination is served by one of the listings indexes, walked in
+# (created_at, id) order, so no combination scans the table or sorts its rows.
+def listings_query(filters, after=None):
+    select_stmt = "SELECT {} FROM listings".format(",".join(LISTING_FIELDS))
+    conditions = []
+    args = []
+    # Adding filter clauses for the params that are specified
+    if filters.get("user_id") is not None:
+        conditions.append("user_id=?")
+        args.append(filters["user_id"])
+    if filters.get("listing_type") is not None:
+        # Along with user_id, the unary + keeps SQLite from picking the listing_type
+        # index, which only splits listings in two, over the user_id one
+        conditions.append("+listing_type=?" if filters.get("user_id") is not None else "listing_type=?")
+        args.append(filters["listing_type"])
+    if filters.get("min_price") is not None or filters.get("max_price") is not None:
+        # An open end of the range is bound too, SQLite only picks the price index for
+        # a two-sided range. Bounds past SQLite's integers are clamped, as they cannot be bound.
+        conditions.append("price>=? AND price<=?")
+        for param, default in (("min_price", MIN_PRICE), ("max_price", MAX_PRICE)):
+            bound = filters[param] if filters.get(param) is not None else default
+            args.append(min(max(bound, MIN_PRICE), MAX_PRICE))
+    # Adding keyset clause to resume after the cursor row
+    if after is not None:
+        conditions.append("created_at<=? AND (created_at<? OR id<?)")
+        args.extend([after[0], after[0], after[1]])
+    if conditions:
+        select_stmt += " WHERE " + " AND ".join(conditions)
+    # Order by and pagination
+    select_stmt += " ORDER BY created_at DESC, id DESC LIMIT ?"
+    return select_stmt, args
+
+
+# Fetches one GET /listings page from the shards, resolving to rows in LISTING_FIELDS order
+# In cursor mode the page starts right after the (created_at, id) position after (at the
+# newest listing when None), otherwise it is page page_num of the offset pagination.
+# Also called in-process by publicapi_service when all services run in one process.
+@tornado.gen.coroutine
+def query_listings(shards, filters, page_size, page_num=1, after=None, cursor_mode=False):
+    select_stmt, args = listings_query(filters, after)
+    offset = (page_num - 1) * page_size if not cursor_mode else 0
+
+    user_id = filters.get("user_id")
+    if user_id is not None or len(shards) == 1:
+        # A user's listings all live on one shard
+        args.append(page_size)
+        if not cursor_mode:
+            select_stmt += " OFFSET ?"
+            args.append(offset)
+        results = yield shards.for_key(user_id or 0).query(select_stmt, args)
+        return results
+
+    # The first offset + page_size rows of every shard hold the whole page,
+    # merged newest first like the single shard ORDER BY
+    # A negative page_size means no limit, as with SQLite's LIMIT
+    offset = max(offset, 0)
+    limit = page_size if page_size >= 0 else None
+    args.append(offset + limit if limit is not None else -1)
+    results = yield shards.query(
+        select_stmt, args, sort_key=created_order, reverse=True, offset=offset, limit=limit)
+    return results
+
+
+# Sort keys merging rows of several shards, matching the ORDER BY of each shard's query
+def created_order(row):
+    return (row["created_at"], row["id"])
+
+
+def id_order(row):
+    return row["id"]
+
+
+# Opaque pagination cursors, encoding the (created_at, id) of the last row on a page
+def encode_cursor(created_at, id):
+    token = "{}:{}".format(created_at, id).encode("ascii")
+    return base64.urlsafe_b64encode(token).decode("ascii")
+
+
+def decode_cursor(cursor):
+    token = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii")
+    created_at, id = token.split(":")
+    return int(created_at), int(id)
+
+
+# Change feed resume tokens, encoding the last id read from every shard
+# Listings are only ever inserted, and a shard hands out ids inside its writer's transaction
+# (see next_id_sql), so each shard's ids grow in commit order: whatever its updated_at, which
+# is stamped before the transaction, a row committed after a token was issued has a higher id
+# than the token's id for its shard.
+def encode_since(marks):
+    token = ",".join(str(mark) for mark in marks).encode("ascii")
+    return base64.urlsafe_b64encode(token).decode("ascii")
+
+
+def decode_since(since):
+    token = base64.urlsafe_b64decode(since.encode("ascii")).decode("ascii")
+    return [int(mark) for mark in token.split(",")]
+
+
+# Rows of a shard after its mark, in commit order, in LISTING_FIELDS order
+CHANGES_STMT = "SELECT {} FROM listings WHERE id>? ORDER BY id LIMIT ?".format(",".join(LISTING_FIELDS))
+
+# Mark of a shard the change feed starts from when resuming from an updated_at: right
+# before the first row updated after it, or the last row when there is none yet
+# MIN(+id) reads the ids off the updated_at index, MIN(id) would walk the primary key instead
+CHANGES_START_STMT = (
+    "SELECT IFNULL((SELECT MIN(+id) FROM listings WHERE updated_at>?) - 1, "
+    + "(SELECT IFNULL(MAX(id), 0) FROM listings))"
+)
 
 
 # /listings
 class ListingsHandler(BaseHandler):
     @tornado.gen.coroutine
     def get(self):
+        # Nothing to do when the client already has this version of the response
+        if self.check_not_modified():
+            return
+
         # Parsing pagination params
         page_num = self.get_argument("page_num", 1)
         page_size = self.get_argument("page_size", 10)
@@ -62,40 +464,64 @@ class ListingsHandler(BaseHandler):
             self.write_json({"result": False, "errors": "invalid page_size"}, status_code=400)
             return
 
-        # Parsing user_id param
-        user_id = self.get_argument("user_id", None)
-        if user_id is not None:
+        if self.get_argument("format", "rows") not in ("rows", "columnar"):
+            self.write_json({"result": False, "errors": "invalid format. Supported values: 'rows', 'columnar'"}, status_code=400)
+            return
+
+        # Parsing user_id, min_price and max_price filters
+        filters = {}
+        for param in ("user_id", "min_price", "max_price"):
+            value = self.get_argument(param, None)
+            if value is not None:
+                try:
+                    filters[param] = int(value)
+                    # Price bounds are clamped by listings_query, user ids must be SQLite integers
+                    if param == "user_id" and not MIN_INTEGER <= filters[param] <= MAX_INTEGER:
+                        raise ValueError(value)
+                except:
+                    self.write_json({"result": False, "errors": "invalid {}".format(param)}, status_code=400)
+                    return
+
+        # Parsing listing_type filter
+        listing_type = self.get_argument("listing_type", None)
+        if listing_type is not None:
+            errors = []
+            filters["listing_type"] = self._validate_listing_type(listing_type, errors)
+            if len(errors) > 0:
+                self.write_json({"result": False, "errors": errors}, status_code=400)
+                return
+
+        # Parsing cursor param
+        # An empty cursor requests the first page in cursor mode
+        cursor_arg = self.get_argument("cursor", None)
+        after = None
+        if cursor_arg:
             try:
-                user_id = int(user_id)
+                after = decode_cursor(cursor_arg)
             except:
-                self.write_json({"result": False, "errors": "invalid user_id"}, status_code=400)
+                logging.exception("Error while parsing cursor: {}".format(cursor_arg))
+                self.write_json({"result": False, "errors": "invalid cursor"}, status_code=400)
                 return
 
-        # Building select statement
-        select_stmt = "SELECT * FROM listings"
-        # Adding user_id filter clause if param is specified
-        if user_id is not None:
-            select_stmt += " WHERE user_id=?"
-        # Order by and pagination
-        limit = page_size
-        offset = (page_num - 1) * page_size
-        select_stmt += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
-
         # Fetching listings from db
-        if user_id is not None:
-            args = (user_id, limit, offset)
-        else:
-            args = (limit, offset)
-        cursor = self.application.db.cursor()
-        results = cursor.execute(select_stmt, args)
+        results = yield query_listings(
+            self.application.shards, filters, page_size, page_num=page_num, after=after,
+            cursor_mode=cursor_arg is not None)
 
-        listings = []
-        for row in results:
-            fields = ["id", "user_id", "listing_type", "price", "created_at", "updated_at"]
-            listing = {
-                field: row[field] for field in fields
-            }
-            listings.append(listing)
+        # Rows are selected in LISTING_FIELDS order
+        if self.columnar_requested():
+            listings = serialization.columns(LISTING_FIELDS, results)
+        else:
+            listings = [dict(zip(LISTING_FIELDS, row)) for row in results]
+
+        if cursor_arg is not None:
+            # A short page means there is nothing left to read
+            next_cursor = None
+            if len(results) == page_size and page_size > 0:
+                last = results[-1]
+                next_cursor = encode_cursor(last["created_at"], last["id"])
+            self.write_json({"result": True, "listings": listings, "next_cursor": next_cursor})
+            return
 
         self.write_json({"result": True, "listings": listings})
 
@@ -118,23 +544,20 @@ class ListingsHandler(BaseHandler):
             self.write_json({"result": False, "errors": errors}, status_code=400)
             return
 
-        # Proceed to store the listing in our db
-        cursor = self.application.db.cursor()
-        cursor.execute(
-            "INSERT INTO 'listings' "
-            + "('user_id', 'listing_type', 'price', 'created_at', 'updated_at') "
-            + "VALUES (?, ?, ?, ?, ?)",
-            (user_id_val, listing_type_val, price_val, time_now, time_now)
+        # Proceed to store the listing in the shard of its user
+        shards = self.application.shards
+        lastrowid = yield shards.for_key(user_id_val).execute(
+            INSERT_LISTING_STMT,
+            (shards.index_for(user_id_val), len(shards), user_id_val, listing_type_val, price_val, time_now, time_now)
         )
-        self.application.db.commit()
 
         # Error out if we fail to retrieve the newly created listing
-        if cursor.lastrowid is None:
+        if lastrowid is None:
             self.write_json({"result": False, "errors": ["Error while adding listing to db"]}, status_code=500)
             return
 
         listing = dict(
-            id=cursor.lastrowid,
+            id=lastrowid,
             user_id=user_id_val,
             listing_type=listing_type_val,
             price=price_val,
@@ -142,6 +565,8 @@ class ListingsHandler(BaseHandler):
             updated_at=time_now
         )
 
+        self.application.count_listings([listing])
+        self.application.notify_changes(lastrowid)
         self.write_json({"result": True, "listing": listing})
 
     def _validate_user_id(self, user_id, errors):
@@ -176,6 +601,249 @@ class ListingsHandler(BaseHandler):
             return price
 
 
+# /listings/batch
+# only POST supported, body is a JSON array of listings
+class ListingsBatchHandler(ListingsHandler):
+    SUPPORTED_METHODS = ("POST",)
+
+    @tornado.gen.coroutine
+    def post(self):
+        try:
+            items = serialization.loads(self.request.body)
+        except:
+            logging.exception("Error while parsing batch body")
+            self.write_json({"result": False, "errors": "invalid JSON body"}, status_code=400)
+            return
+
+        if not isinstance(items, list):
+            self.write_json({"result": False, "errors": "body must be a JSON array"}, status_code=400)
+            return
+
+        if len(items) > MAX_BATCH_SIZE:
+            self.write_json({"result": False, "errors": "batch size must be at most {}".format(MAX_BATCH_SIZE)}, status_code=400)
+            return
+
+        # Validating every item with the same rules as POST /listings, collecting errors per item
+        time_now = int(time.time() * 1e6) # Converting current time to microseconds
+        rows = []
+        item_errors = []
+        for index, item in enumerate(items):
+            errors = []
+            if not isinstance(item, dict):
+                item_errors.append({"index": index, "errors": ["item must be a JSON object"]})
+                continue
+            for field in ("user_id", "listing_type", "price"):
+                if item.get(field) is None:
+                    errors.append("missing {}".format(field))
+            if len(errors) > 0:
+                item_errors.append({"index": index, "errors": errors})
+                continue
+
+            user_id_val = self._validate_user_id(str(item["user_id"]), errors)
+            listing_type_val = self._validate_listing_type(str(item["listing_type"]), errors)
+            price_val = self._validate_price(str(item["price"]), errors)
+            if len(errors) > 0:
+                item_errors.append({"index": index, "errors": errors})
+                continue
+            rows.append((user_id_val, listing_type_val, price_val, time_now, time_now))
+
+        # The batch is all-or-nothing, end if any item is invalid
+        if len(item_errors) > 0:
+            self.write_json({"result": False, "errors": item_errors}, status_code=400)
+            return
+
+        # Proceed to store the listings of every shard in one transaction per shard
+        shards = self.application.shards
+        rows_by_shard = {}
+        for position, row in enumerate(rows):
+            index = shards.index_for(row[0])
+            rows_by_shard.setdefault(index, []).append((position, (index, len(shards)) + row))
+        shard_ids = yield [
+            shards.databases[index].execute_many(
+                INSERT_LISTING_STMT, [args for _, args in shard_rows], id_step=len(shards))
+            for index, shard_rows in rows_by_shard.items()
+        ]
+        ids = [None] * len(rows)
+        for shard_rows, new_ids in zip(rows_by_shard.values(), shard_ids):
+            for (position, _), id in zip(shard_rows, new_ids):
+                ids[position] = id
+
+        listings = []
+        for id, row in zip(ids, rows):
+            listings.append(dict(
+                id=id,
+                user_id=row[0],
+                listing_type=row[1],
+                price=row[2],
+                created_at=row[3],
+                updated_at=row[4]
+            ))
+
+        self.application.count_listings(listings)
+        self.application.notify_changes(*[new_ids[-1] for new_ids in shard_ids if new_ids])
+        self.write_json({"result": True, "listings": listings})
+
+
+# /listings/export
+# only GET supported, streams every listing as newline-delimited JSON
+class ListingsExportHandler(BaseHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        # Parsing user_id and since (updated_at, in microseconds) filters
+        filters = {}
+        for param in ("user_id", "since"):
+            value = self.get_argument(param, None)
+            if value is not None:
+                try:
+                    filters[param] = int(value)
+                    # User ids must be SQLite integers, since is clamped to them below
+                    if param == "user_id" and not MIN_INTEGER <= filters[param] <= MAX_INTEGER:
+                        raise ValueError(value)
+                except:
+                    self.write_json({"result": False, "errors": "invalid {}".format(param)}, status_code=400)
+                    return
+        if "since" in filters:
+            filters["since"] = min(max(filters["since"], MIN_INTEGER), MAX_INTEGER)
+
+        # Building select statement
+        select_stmt = "SELECT {} FROM listings".format(",".join(LISTING_FIELDS))
+        conditions = []
+        args = []
+        if "user_id" in filters:
+            conditions.append("user_id=?")
+            args.append(filters["user_id"])
+        if "since" in filters:
+            conditions.append("updated_at>?")
+            args.append(filters["since"])
+        if conditions:
+            select_stmt += " WHERE " + " AND ".join(conditions)
+        select_stmt += " ORDER BY id"
+
+        # A user's listings all live on one shard, other exports merge every shard by id
+        shards = self.application.shards
+        if "user_id" in filters:
+            stream = shards.for_key(filters["user_id"]).stream(select_stmt, args)
+        else:
+            stream = shards.stream(select_stmt, args, sort_key=id_order)
+
+        yield self.write_ndjson(stream, LISTING_FIELDS)
+
+
+# /listings/stats
+# only GET supported, returns the count and price statistics of all listings, overall
+# and per listing_type, or of one user's listings with user_id
+class ListingsStatsHandler(BaseHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        # Parsing user_id param
+        user_id = self.get_argument("user_id", None)
+        if user_id is not None:
+            try:
+                user_id = int(user_id)
+            except:
+                self.write_json({"result": False, "errors": "invalid user_id"}, status_code=400)
+                return
+
+        # Parsing percentiles param, a comma separated list of numbers between 0 and 100
+        percentiles_arg = self.get_argument("percentiles", "50,90,99")
+        try:
+            percentiles = [float(p) for p in percentiles_arg.split(",") if p.strip()]
+            if not percentiles or any(p < 0 or p > 100 for p in percentiles):
+                raise ValueError(percentiles_arg)
+        except:
+            logging.exception("Error while parsing percentiles: {}".format(percentiles_arg))
+            self.write_json({"result": False, "errors": "invalid percentiles"}, status_code=400)
+            return
+
+        # The stats are loaded in the background at startup, then kept in memory
+        # Until a load has succeeded there are no stats to serve, only partial ones
+        yield self.application.stats_attempted.wait()
+        if not self.application.stats_loaded.is_set():
+            self.set_header("Retry-After", str(int(STATS_RETRY_DELAY)))
+            self.write_json({"result": False, "errors": "stats not loaded yet"}, status_code=503)
+            return
+        stats = self.application.stats
+        if user_id is not None:
+            self.write_json({"result": True, "user_id": user_id, "stats": stats.user_summary(user_id, percentiles)})
+            return
+        self.write_json({"result": True, "stats": stats.summary(percentiles)})
+
+
+# /listings/version
+# only GET supported, returns the current data version, which changes on every write
+class ListingsVersionHandler(BaseHandler):
+    def get(self):
+        self.write_json({"result": True, "version": self.application.data_version})
+
+
+# /listings/changes
+# only GET supported, returns rows committed after `since`, in commit order
+class ListingsChangesHandler(BaseHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        # Parsing since param: either a resume token from a previous response,
+        # or a plain updated_at in microseconds (defaults to the beginning of time)
+        shards = self.application.shards
+        since = self.get_argument("since", "0")
+        updated_after = None
+        try:
+            if since.isdigit():
+                updated_after = int(since)
+            else:
+                try:
+                    marks = decode_since(since)
+                except ValueError:
+                    # Tokens of the former (updated_at, id) ordered feed resume from their updated_at
+                    updated_after = decode_cursor(since)[0] - 1
+            if updated_after is not None:
+                # Rows are never updated after the largest updated_at SQLite stores
+                updated_after = min(updated_after, MAX_INTEGER)
+            elif len(marks) != len(shards):
+                raise ValueError("since has {} shards, not {}".format(len(marks), len(shards)))
+            elif not all(MIN_INTEGER <= mark <= MAX_INTEGER for mark in marks):
+                raise ValueError("since is out of range")
+        except:
+            logging.exception("Error while parsing since: {}".format(since))
+            self.write_json({"result": False, "errors": "invalid since"}, status_code=400)
+            return
+
+        # Parsing limit and wait (long-polling timeout, in seconds) params
+        try:
+            limit = int(self.get_argument("limit", 100))
+            wait = float(self.get_argument("wait", 0))
+        except:
+            self.write_json({"result": False, "errors": "invalid limit or wait"}, status_code=400)
+            return
+        limit = max(1, min(limit, MAX_CHANGES_LIMIT))
+        wait = max(0.0, min(wait, MAX_CHANGES_WAIT))
+
+        # Finding where every shard's feed starts
+        if updated_after is not None and updated_after > 0:
+            starts = yield [db.query(CHANGES_START_STMT, (updated_after,)) for db in shards]
+            marks = [rows[0][0] for rows in starts]
+        elif updated_after is not None:
+            marks = [0] * len(shards)
+
+        # Every shard returns its first limit changes after its mark, merged by id
+        shard_args = [(mark, limit) for mark in marks]
+        results = yield shards.query_each(CHANGES_STMT, shard_args, sort_key=id_order, limit=limit)
+
+        # Long-polling: wait for a commit on this node, re-checking the db periodically
+        io_loop = tornado.ioloop.IOLoop.current()
+        deadline = io_loop.time() + wait
+        while not results and io_loop.time() < deadline:
+            timeout = min(deadline - io_loop.time(), CHANGES_POLL_INTERVAL)
+            yield self.application.changes.wait(timeout=datetime.timedelta(seconds=timeout))
+            results = yield shards.query_each(CHANGES_STMT, shard_args, sort_key=id_order, limit=limit)
+
+        listings = [dict(zip(LISTING_FIELDS, row)) for row in results]
+        for listing in listings:
+            marks[shards.index_for(listing["id"])] = listing["id"]
+
+        # The resume token holds the last id returned from every shard
+        self.write_json({"result": True, "listings": listings, "next_since": encode_since(marks)})
+
+
 # /listings/ping
 class PingHandler(tornado.web.RequestHandler):
     @tornado.gen.coroutine
@@ -184,10 +852,27 @@ class PingHandler(tornado.web.RequestHandler):
 
 
 def make_app(options):
-    return App([
+    serialization.use_backend(options.json_backend)
+    handlers = [
+        (r"/metrics", MetricsHandler),
         (r"/listings/ping", PingHandler),
         (r"/listings", ListingsHandler),
-    ], debug=options.debug)
+        (r"/listings/batch", ListingsBatchHandler),
+        (r"/listings/export", ListingsExportHandler),
+        (r"/listings/stats", ListingsStatsHandler),
+        (r"/listings/version", ListingsVersionHandler),
+        (r"/listings/changes", ListingsChangesHandler),
+    ]
+    return App(
+        handlers,
+        db_path=options.db_path,
+        db_pool_size=options.db_pool_size,
+        db_shards=options.db_shards,
+        group_commit_window_ms=options.group_commit_window_ms,
+        group_commit_max_batch=options.group_commit_max_batch,
+        version_refresh_ms=options.version_refresh_ms,
+        debug=options.debug
+    )
 
 
 if __name__ == "__main__":
@@ -195,8 +880,27 @@ if __name__ == "__main__":
     # Specify the port number to start the web app on (default value is port 6000)
     tornado.options.define("port", default=6000)
     # Specify whether the app should run in debug mode
-    # Debug mode restarts the app automatically on file changes
-    tornado.options.define("debug", default=True)
+    # Debug mode restarts the app automatically on file changes, only use it in development
+    tornado.options.define("debug", default=False)
+    # Define the process model options (processes, reuse_port, shutdown_timeout, max_restarts)
+    serving.define_options()
+    # Specify the SQLite database file
+    tornado.options.define("db_path", default="listings.db")
+    # Specify the number of threads (and SQLite connections) serving queries
+    tornado.options.define("db_pool_size", default=4)
+    # Specify the number of db files listings are sharded over by user_id (cannot change once data exists)
+    # With more than one shard, db_path is a template: listings.db becomes listings.0.db, listings.1.db, ...
+    tornado.options.define("db_shards", default=1)
+    # Specify the JSON backend: orjson, ujson, json, or auto to pick the fastest installed one
+    tornado.options.define("json_backend", default="auto")
+    # Specify how long (in ms) inserts may wait to be committed together with others (0 disables group commit)
+    tornado.options.define("group_commit_window_ms", default=0)
+    # Specify the maximum number of inserts committed in one group commit transaction
+    tornado.options.define("group_commit_max_batch", default=128)
+    # Specify how often (in ms) the data version behind ETags and the listing stats are re-read
+    # from the db, so that writes made by other processes are noticed (0 disables, only safe with
+    # a single process)
+    tornado.options.define("version_refresh_ms", default=1000)
 
     # Read settings/options from command line
     tornado.options.parse_command_line()
@@ -204,10 +908,5 @@ if __name__ == "__main__":
     # Access the settings defined
     options = tornado.options.options
 
-    # Create web app
-    app = make_app(options)
-    app.listen(options.port)
-    logging.info("Starting listing service. PORT: {}, DEBUG: {}".format(options.port, options.debug))
-
-    # Start event loop
-    tornado.ioloop.IOLoop.instance().start()
+    # Create web app(s) and start event loop(s)
+    serving.serve(make_app, options, "listing service")
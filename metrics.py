@@ -0,0 +1,191 @@
+import bisect
+import threading
+import time
+import tornado.web
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+# Histogram with fixed buckets: observe() is a bisect plus two increments
+class Histogram(object):
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            series = [(label_values, list(values)) for label_values, values in self._series.items()]
+        for label_values, values in series:
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values[:-1]):
+                cumulative += count
+                bucket_labels = dict(labels, le=_format_value(bound))
+                yield self.name + "_bucket", bucket_labels, cumulative
+            yield self.name + "_sum", labels, values[-1]
+            yield self.name + "_count", labels, cumulative
+
+
+# Metric whose samples are read from a callback at scrape time
+# fn returns either a single value or a dict of label values tuple -> value
+class Collector(object):
+
+    def __init__(self, name, help, type, fn, labels=()):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = labels
+        self.fn = fn
+
+    def samples(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+# Per-application set of metrics, rendered in the Prometheus text format
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels), "counter")
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets), "histogram")
+
+    def collector(self, name, help, type, fn, labels=()):
+        return self._register(Collector(name, help, type, fn, labels), type)
+
+    def _register(self, metric, type):
+        self._metrics.append((metric, type))
+        return metric
+
+    def render(self):
+        lines = []
+        for metric, type in self._metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, type))
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_str = ",".join('{}="{}"'.format(key, _escape(val)) for key, val in labels.items())
+                    lines.append("{}{{{}}} {}".format(name, label_str, _format_value(value)))
+                else:
+                    lines.append("{} {}".format(name, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+# Request count and latency per handler and status code, fed from Application.log_request
+class RequestMetrics(object):
+
+    def __init__(self, registry):
+        self.latency = registry.histogram(
+            "http_request_duration_seconds",
+            "HTTP request latency by handler and status code",
+            labels=("handler", "code")
+        )
+
+    def observe(self, handler):
+        self.latency.observe(handler.request.request_time(), type(handler).__name__, str(handler.get_status()))
+
+
+# SQLite operation latency, passed to db.Database as its observer
+class DatabaseMetrics(object):
+
+    def __init__(self, registry):
+        self.latency = registry.histogram(
+            "sqlite_operation_duration_seconds",
+            "SQLite query and commit latency by operation",
+            labels=("operation",)
+        )
+
+    def __call__(self, operation, seconds):
+        self.latency.observe(seconds, operation)
+
+
+# Upstream fetch latency and errors, passed to upstream.Upstream
+class UpstreamMetrics(object):
+
+    def __init__(self, registry):
+        self.latency = registry.histogram(
+            "upstream_request_duration_seconds",
+            "Upstream fetch latency by upstream and path",
+            labels=("upstream", "path")
+        )
+        self.errors = registry.counter(
+            "upstream_request_errors_total",
+            "Upstream fetches that failed or returned a 5xx status",
+            labels=("upstream", "path")
+        )
+
+    def track(self, upstream, path, future):
+        start = time.monotonic()
+
+        def done(future):
+            self.latency.observe(time.monotonic() - start, upstream, path)
+            error = future.exception()
+            if error is None:
+                # raise_error=False fetches report failures on the response instead
+                error = future.result().code >= 500
+            if error:
+                self.errors.inc(upstream, path)
+
+        future.add_done_callback(done)
+        return future
+
+
+# /metrics
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(self.application.metrics.render())
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -1,17 +1,342 @@
 import tornado.web
 import tornado.log
 import tornado.options
+import tornado.ioloop
+import datetime
+import hashlib
 import logging
-import json
-import urllib
-from tornado.httpclient import AsyncHTTPClient
+import math
+import os
+from admission import AdmissionControl, Rejected
+from breaker import CircuitBreaker, CircuitOpen
+from cache import ResponseCache
+from coalesce import SingleFlight
+from replica import UserReplica
+from metrics import Registry, RequestMetrics, UpstreamMetrics, MetricsHandler
+from upstream import Upstream, make_http_client
+from writebehind import QueueFull, WriteQueue
+import serialization
+import serving
+
+
+# Spool file of the name write queue in write_spool_dir
+# Every forked process has a spool of its own, named after its task id, which a restarted
+# process takes over. Changing the number of processes leaves the spools of the missing
+# task ids unread.
+def write_spool_path(write_spool_dir, name):
+    task_id = serving.current_task_id()
+    if task_id is None:
+        return os.path.join(write_spool_dir, name + ".spool")
+    return os.path.join(write_spool_dir, "{}.{}.spool".format(name, task_id))
+
+
+class App(tornado.web.Application):
+
+    def __init__(self, handlers, listing_service_urls=("http://localhost:6555",),
+                 user_service_urls=("http://localhost:6524",), upstream_max_clients=100,
+                 upstream_curl=True, cache_ttl=0, cache_max_entries=1000,
+                 cache_max_bytes=64 * 1024 * 1024, cache_stale_ttl=0, coalesce_reads=True, user_replica=True,
+                 admission_max_reads=64, admission_max_writes=32, admission_max_queue=256,
+                 admission_queue_timeout_ms=1000, upstream_connect_timeout_ms=1000,
+                 listing_service_timeout_ms=5000, user_service_timeout_ms=5000, upstream_hedge=False,
+                 upstream_hedge_min_delay_ms=5, breaker_error_rate=0.5, breaker_min_requests=20,
+                 breaker_window_ms=10000, breaker_open_ms=5000, write_queue_max_size=10000,
+                 write_batch_size=100, write_batch_window_ms=5, write_max_retries=5, write_retry_delay_ms=100,
+                 write_spool_dir=None, write_sync_timeout_ms=5000, reads=None, **kwargs):
+        super().__init__(handlers, **kwargs)
+
+        # Initialising admission control, reads and writes get separate slots and
+        # queues so that polling reads cannot starve writes (0 means no limit)
+        admission_queue_timeout = admission_queue_timeout_ms / 1000.0
+        self.admission = {
+            "read": AdmissionControl(admission_max_reads, admission_max_queue, admission_queue_timeout),
+            "write": AdmissionControl(admission_max_writes, admission_max_queue, admission_queue_timeout),
+        }
+
+        # Initialising metrics, served on /metrics
+        self.metrics = Registry()
+        self.request_metrics = RequestMetrics(self.metrics)
+        upstream_metrics = UpstreamMetrics(self.metrics)
+
+        # Initialising request coalescing, shared by handlers and upstream GETs
+        self.flights = SingleFlight() if coalesce_reads else None
+
+        # Initialising the shared upstream client and the downstream services it calls,
+        # each with its own deadlines and circuit breaker (breaker_error_rate 0 disables them)
+        self.http_client = make_http_client(max_clients=upstream_max_clients, use_curl=upstream_curl)
+
+        def upstream(name, urls, timeout_ms):
+            breaker = None
+            if breaker_error_rate > 0:
+                breaker = CircuitBreaker(
+                    breaker_error_rate, breaker_min_requests, breaker_window_ms / 1000.0, breaker_open_ms / 1000.0)
+            return Upstream(
+                name, urls, self.http_client, flights=self.flights, metrics=upstream_metrics,
+                connect_timeout=upstream_connect_timeout_ms / 1000.0, request_timeout=timeout_ms / 1000.0,
+                breaker=breaker, hedge=upstream_hedge, hedge_min_delay=upstream_hedge_min_delay_ms / 1000.0)
+
+        self.listing_service = upstream("listing_service", listing_service_urls, listing_service_timeout_ms)
+        self.user_service = upstream("user_service", user_service_urls, user_service_timeout_ms)
+
+        # Initialising the reads pages are built from, over HTTP to the services above unless
+        # the services run in this process (see embedded.py). Writes always go over HTTP.
+        self.reads = reads if reads is not None else UpstreamReads(self.listing_service, self.user_service)
+
+        # Initialising the GET /public-api/listings response cache, disabled when cache_ttl is 0
+        self.listings_cache = None
+        if cache_ttl > 0:
+            self.listings_cache = ResponseCache(
+                cache_ttl, max_entries=cache_max_entries, max_bytes=cache_max_bytes, stale_ttl=cache_stale_ttl)
+        # Last upstream data versions, (generation, expires_at, versions), only kept while the cache is on
+        self.cached_versions = None
+
+        # Initialising the write-behind queues POST /public-api/listings and /public-api/users
+        # go through, forwarded in batches to the upstream batch endpoints in the background
+        self.write_sync_timeout = write_sync_timeout_ms / 1000.0
+        self.write_queues = {}
+        for name, upstream, item_key in (("listings", self.listing_service, "listing"),
+                                         ("users", self.user_service, "user")):
+            self.write_queues[name] = WriteQueue(
+                name, upstream, "/{}/batch".format(name), name, item_key,
+                max_size=write_queue_max_size,
+                batch_size=write_batch_size,
+                batch_window=write_batch_window_ms / 1000.0,
+                max_retries=write_max_retries,
+                retry_delay=write_retry_delay_ms / 1000.0,
+                spool_path=write_spool_path(write_spool_dir, name) if write_spool_dir else None,
+                on_forwarded=self.invalidate_listings_cache
+            )
+            self.write_queues[name].start()
+
+        # Initialising the local users replica used to enrich listings, synced in the background
+        self.user_replica = None
+        if user_replica:
+            self.user_replica = UserReplica(self.user_service)
+            self.user_replica.start()
+
+        # Exposing cache, coalescing and replica counters as metrics too
+        if self.listings_cache is not None:
+            self.metrics.collector(
+                "listings_cache_events_total", "Listings response cache events", "counter",
+                lambda: {(event,): self.listings_cache.stats()[event]
+                         for event in ("hits", "misses", "evictions", "expirations", "invalidations", "stale_hits")},
+                labels=("event",)
+            )
+            self.metrics.collector(
+                "listings_cache_bytes", "Size of the cached listings responses", "gauge",
+                lambda: self.listings_cache.size_bytes
+            )
+        if self.flights is not None:
+            self.metrics.collector(
+                "coalesced_requests_total", "Requests that joined an in-flight identical request", "counter",
+                lambda: self.flights.coalesced
+            )
+        self.metrics.collector(
+            "admission_in_flight", "Requests admitted and still running", "gauge",
+            lambda: {(kind,): control.in_flight for kind, control in self.admission.items()},
+            labels=("kind",)
+        )
+        self.metrics.collector(
+            "admission_queued", "Requests waiting for admission", "gauge",
+            lambda: {(kind,): control.queued() for kind, control in self.admission.items()},
+            labels=("kind",)
+        )
+        self.metrics.collector(
+            "admission_rejected_total", "Requests rejected with 503 by admission control", "counter",
+            lambda: {(kind, reason): count
+                     for kind, control in self.admission.items()
+                     for reason, count in control.rejected.items()},
+            labels=("kind", "reason")
+        )
+        upstreams = (self.listing_service, self.user_service)
+        self.metrics.collector(
+            "upstream_hedged_requests_total", "Plain GETs sent to a second replica, and how many of those won",
+            "counter",
+            lambda: {key: value for upstream in upstreams for key, value in (
+                ((upstream.name, "hedged"), upstream.hedged), ((upstream.name, "won"), upstream.hedges_won))},
+            labels=("upstream", "event")
+        )
+        self.metrics.collector(
+            "upstream_circuit_open", "Whether the upstream circuit breaker is turning requests away", "gauge",
+            lambda: {(upstream.name,): int(upstream.breaker is not None and upstream.breaker.state == CircuitBreaker.OPEN)
+                     for upstream in upstreams},
+            labels=("upstream",)
+        )
+        self.metrics.collector(
+            "upstream_circuit_trips_total", "Times the upstream circuit breaker opened", "counter",
+            lambda: {(upstream.name,): upstream.breaker.trips if upstream.breaker is not None else 0
+                     for upstream in upstreams},
+            labels=("upstream",)
+        )
+        self.metrics.collector(
+            "write_queue_depth", "Writes accepted and not forwarded yet", "gauge",
+            lambda: {(name,): queue.depth() for name, queue in self.write_queues.items()},
+            labels=("queue",)
+        )
+        self.metrics.collector(
+            "write_queue_lag_seconds", "How long the oldest pending write has been waiting", "gauge",
+            lambda: {(name,): queue.lag() for name, queue in self.write_queues.items()},
+            labels=("queue",)
+        )
+        self.metrics.collector(
+            "write_queue_writes_total", "Writes accepted, forwarded and failed by the write queues", "counter",
+            lambda: {(name, event): getattr(queue, event)
+                     for name, queue in self.write_queues.items()
+                     for event in ("accepted", "forwarded", "failed")},
+            labels=("queue", "event")
+        )
+        self.metrics.collector(
+            "write_queue_retries_total", "Upstream batch forwards retried by the write queues", "counter",
+            lambda: {(name,): queue.retries for name, queue in self.write_queues.items()},
+            labels=("queue",)
+        )
+        if self.user_replica is not None:
+            self.metrics.collector(
+                "user_replica_users", "Users held in the local users replica", "gauge",
+                lambda: len(self.user_replica)
+            )
+
+    def close(self):
+        for queue in self.write_queues.values():
+            queue.stop()
+        if self.user_replica is not None:
+            self.user_replica.stop()
+        self.http_client.close()
+
+    def log_request(self, handler):
+        super().log_request(handler)
+        self.request_metrics.observe(handler)
+
+    def retry_after(self):
+        # Whole seconds until every upstream circuit breaker lets requests through again, at least 1
+        return max(1, int(math.ceil(max(self.listing_service.retry_after(), self.user_service.retry_after()))))
+
+    def single_flight(self, key, fn, *args):
+        # Runs fn(*args), sharing the call with concurrent callers of the same key when coalescing is on
+        if self.flights is None:
+            return fn(*args)
+        return self.flights.do(key, fn, *args)
+
+    @tornado.gen.coroutine
+    def data_versions(self):
+        # Resolves to the (listing_service, user_service) data versions, or None if they
+        # cannot be fetched. With the response cache on, they are reused for as long as
+        # cached responses stay fresh, and dropped along with them on writes.
+        cache = self.listings_cache
+        if cache is not None and self.cached_versions is not None:
+            generation, expires_at, versions = self.cached_versions
+            if generation == cache.generation and expires_at > cache.clock():
+                return versions
+
+        generation = cache.generation if cache is not None else None
+        try:
+            versions = yield self.reads.versions()
+        except CircuitOpen:
+            return None
+        except Exception:
+            logging.exception("Error while fetching upstream data versions")
+            return None
+
+        if cache is not None and generation == cache.generation:
+            self.cached_versions = (generation, cache.clock() + cache.ttl, versions)
+        return versions
+
+    def invalidate_listings_cache(self, *args):
+        # Called once a write through this node has reached its upstream
+        if self.listings_cache is not None:
+            self.listings_cache.clear()
 
 
 class BaseHandler(tornado.web.RequestHandler):
+    # Whether requests wait for an admission control slot before running, see App.admission
+    admission_controlled = True
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        self.admission_control = None
+        if not self.admission_controlled:
+            return
+        control = self.application.admission["read" if self.request.method in ("GET", "HEAD") else "write"]
+        try:
+            yield control.acquire()
+        except Rejected as e:
+            # Shedding load: rejecting fast, rather than running late
+            self.set_header("Retry-After", str(e.retry_after))
+            self.write_json({"result": False, "errors": "service overloaded"}, status_code=503)
+            self.finish()
+            return
+        self.admission_control = control
+
+    def on_finish(self):
+        if self.admission_control is not None:
+            self.admission_control.release()
+            self.admission_control = None
+
+    def pretty_json_requested(self):
+        # Compact output unless ?pretty=1 is passed
+        return self.get_argument("pretty", "0").lower() in ("1", "true")
+
     def write_json(self, obj, status_code=200):
+        body = serialization.dumps(obj, pretty=self.pretty_json_requested())
+        self.write_encoded_json(body, status_code=status_code)
+
+    def write_encoded_json(self, body, status_code=200):
         self.set_header("Content-Type", "application/json")
         self.set_status(status_code)
-        self.write(json.dumps((obj), indent=4))
+        if status_code != 200:
+            # Errors are never cached
+            self.clear_header("Etag")
+        self.write(body)
+
+    def async_write_requested(self):
+        # Writes are answered once forwarded, unless the client asks not to wait
+        # with a "Prefer: respond-async" header or ?async=1
+        return ("respond-async" in self.request.headers.get("Prefer", "")
+                or self.get_argument("async", "0").lower() in ("1", "true"))
+
+    @tornado.gen.coroutine
+    def submit_write(self, queue_name, item):
+        # Queues item for forwarding, then answers with the stored item, or with 202 and a
+        # tracking id when the client asked not to wait or forwarding takes too long
+        queue = self.application.write_queues[queue_name]
+        try:
+            tracking_id = queue.submit(item)
+        except QueueFull:
+            self.set_header("Retry-After", "1")
+            self.write_json({"result": False, "errors": "write queue full"}, status_code=503)
+            return
+
+        status = None
+        if not self.async_write_requested():
+            try:
+                status = yield tornado.gen.with_timeout(
+                    datetime.timedelta(seconds=self.application.write_sync_timeout), queue.wait(tracking_id))
+            except tornado.gen.TimeoutError:
+                pass
+
+        if status is None:
+            self.set_header("Location", "/public-api/writes/{}/{}".format(queue_name, tracking_id))
+            self.write_json({"result": True, "tracking_id": tracking_id, "status": "queued"}, status_code=202)
+        elif status["status"] == "forwarded":
+            self.write_json(dict(status, result=True, tracking_id=tracking_id))
+        else:
+            # Validation errors from the upstream come per item, anything else is a service error
+            status_code = 400 if isinstance(status["errors"], list) else 500
+            self.write_json({"result": False, "tracking_id": tracking_id, "errors": status["errors"]},
+                            status_code=status_code)
+
+    def write_unavailable(self):
+        # Fast answer while an upstream circuit breaker is open
+        self.set_header("Retry-After", str(self.application.retry_after()))
+        self.write_json({"result": False, "errors": "service unavailable"}, status_code=503)
+
+    def write_upstream(self, response):
+        # Relays an upstream JSON response as is, erroring out if the service could not be reached
+        if response.code == 599 or response.body is None:
+            logging.error("Error while calling upstream {}: {}".format(response.effective_url, response.error))
+            self.write_json({"result": False, "errors": "service error"}, status_code=500)
+            return
+        self.write_encoded_json(response.body, status_code=response.code)
 
 
 # /public-api/listings
@@ -34,63 +359,68 @@ class PublicListings(BaseHandler):
             self.write_json({"result": False, "errors": "invalid page_size"}, status_code=400)
             return
 
-        # return generators from relevant endpoints
-        listings_generator, users_generator = yield [*multiple_async_http_requests(page_num, page_size)]
-
-        # Pull data from /listings API
-        listings_API = json.loads(listings_generator.body)
-        listings = listings_API.get("listings")
-
-        # Pull data from /users API
-        users_API = json.loads(users_generator.body)
-        users = users_API.get("users")
-
-        # error out if key doesn't exist
-        if (listings is None) or (users is None):
-            logging.exception("key error during API dict access")
-            self.write_json({"result": False, "errors": "service error"}, status_code=500)
-            return
-
-        # Parsing user_id param
-        user_id = self.get_argument("user_id", None)
-        if user_id is not None:
-            try:
-                user_id = int(user_id)
-            except:
-                self.write_json({"result": False, "errors": "invalid user_id"}, status_code=400)
+        # Parsing user_id, min_price, max_price and listing_type params, the filters
+        # themselves are applied by listing_service
+        filters = {}
+        for param in ("user_id", "min_price", "max_price"):
+            value = self.get_argument(param, None)
+            if value is not None:
+                try:
+                    filters[param] = int(value)
+                except:
+                    self.write_json({"result": False, "errors": "invalid {}".format(param)}, status_code=400)
+                    return
+
+        listing_type = self.get_argument("listing_type", None)
+        if listing_type is not None:
+            errors = []
+            filters["listing_type"] = self._validate_listing_type(listing_type, errors)
+            if len(errors) > 0:
+                self.write_json({"result": False, "errors": errors}, status_code=400)
                 return
 
-        # display listings from /listings with merged users from /users
-        '''
-        Assumptions:
-        For every property listing in /listings endpoint,
-        there is a corresponding user_id in /users.
-        If there is a listing with no corresponding user: throw error
-        '''
-        for i in range(len(listings)):
-            try:
-                user_id_no = listings[i].pop("user_id")
-                listings[i]["user"] = users[i]
-            except IndexError:
-                logging.exception("check databases, every listing needs corresponding name and user_id")
-                self.write_json({"result": False, "errors": "invalid user_id"}, status_code=400)
-                return None
-
-        # Adding user_id filter clause if param is specified 
-        if user_id is not None:
-            user_id = int(user_id)
-
-            # follows behaviour from listing_service.py, if user_id is 0, return empty listings
-            if user_id is 0:
-                listings = []
-            else:
-                try:
-                    listings = listings[-(user_id)]
-                except IndexError:
-                # follows behaviour from listing_service.py, if user_id does not exist, return empty listings
-                    listings = []
+        cache_key = (
+            page_num, page_size, filters.get("user_id"), filters.get("listing_type"),
+            filters.get("min_price"), filters.get("max_price"), self.pretty_json_requested()
+        )
+
+        # Answering with 304 before any upstream call for the page when the client
+        # already has it, pages are tagged with both upstreams' data versions
+        # The versions are only fetched up front for conditional requests, pages
+        # otherwise learn them from the upstream responses they are built from
+        if "If-None-Match" in self.request.headers:
+            versions = yield self.application.data_versions()
+            if versions is not None:
+                self.set_header("Etag", version_etag(versions, cache_key))
+                if self.check_etag_header():
+                    self.set_status(304)
+                    return
+
+        # Serving the page from the response cache when possible
+        cache = self.application.listings_cache
+        if cache is not None:
+            entry = cache.get(cache_key)
+            if entry is not None:
+                self.write_tagged(*entry)
+                return
 
-        self.write_json({"result": True, "listings": listings})
+        # Concurrent identical reads share a single fetch and merge
+        status_code, etag, body = yield self.application.single_flight(
+            ("public_listings",) + cache_key,
+            build_listings_page, self.application, *cache_key
+        )
+        if status_code == 503:
+            self.set_header("Retry-After", str(self.application.retry_after()))
+        self.write_tagged(etag, body, status_code=status_code)
+
+    def write_tagged(self, etag, body, status_code=200):
+        # Pages keep the ETag of the versions they were built from, which may be older
+        # than the current ones: the client then simply gets a full response next time
+        if etag is not None:
+            self.set_header("Etag", etag)
+        else:
+            self.clear_header("Etag")
+        self.write_encoded_json(body, status_code=status_code)
 
     @tornado.gen.coroutine
     def post(self):
@@ -106,10 +436,11 @@ class PublicListings(BaseHandler):
             self.write_json({"result": False, "errors": errors}, status_code=400)
             return
 
-        http_client = AsyncHTTPClient()
-        body = urllib.parse.urlencode(data)
-        response = http_client.fetch("http://localhost:6555/listings", method='POST', body=body)
-        self.write_json(data)
+        yield self.submit_write("listings", {
+            "user_id": user_id_val,
+            "listing_type": listing_type_val,
+            "price": price_val,
+        })
 
     def _validate_user_id(self, user_id, errors):
         try:
@@ -143,19 +474,183 @@ class PublicListings(BaseHandler):
             return price
 
 
-def multiple_async_http_requests(page_num, page_size):
-    http_client = AsyncHTTPClient()
-    if page_num and page_size:
-        listings_response = http_client.fetch("http://localhost:6555/listings?page_num={}&page_size={}".format(page_num, page_size))
-        user_response = http_client.fetch("http://localhost:6524/users?page_num={}&page_size={}".format(page_num, page_size))
-    elif page_num:
-        listings_response = http_client.fetch("http://localhost:6555/listings?page_num={}".format(page_num))
-        user_response = http_client.fetch("http://localhost:6524/users?page_num={}".format(page_num))
-    elif page_size:
-        listings_response = http_client.fetch("http://localhost:6555/listings?page_size={}".format(page_size))
-        user_response = http_client.fetch("http://localhost:6524/users?page_size={}".format(page_size))
-    # GET http_response from /listings & /users
-    return listings_response, user_response
+# Fetches and merges one page of public listings, resolving to (status_code, etag, encoded body)
+# The result may be shared by coalesced requests, so only the encoded body leaves this function
+@tornado.gen.coroutine
+def build_listings_page(app, page_num, page_size, user_id=None, listing_type=None,
+                        min_price=None, max_price=None, pretty=False):
+    cache = app.listings_cache
+    generation = cache.generation if cache is not None else None
+    cache_key = (page_num, page_size, user_id, listing_type, min_price, max_price, pretty)
+
+    # Pull the page from /listings, then only the users appearing on it from /users
+    # When an upstream fails, or its circuit breaker is open, the last page built
+    # is served instead for as long as the cache keeps it around (see cache_stale_ttl)
+    try:
+        listings, users, versions = yield multiple_async_http_requests(
+            app, page_num, page_size, user_id=user_id, listing_type=listing_type,
+            min_price=min_price, max_price=max_price)
+    except CircuitOpen as e:
+        logging.warning("Not fetching listings and users: {}".format(e))
+        stale = cache.get_stale(cache_key) if cache is not None else None
+        if stale is not None:
+            return (200,) + stale
+        return 503, None, serialization.dumps({"result": False, "errors": "service unavailable"}, pretty=pretty)
+    except Exception:
+        logging.exception("Error while fetching listings and users")
+        stale = cache.get_stale(cache_key) if cache is not None else None
+        if stale is not None:
+            return (200,) + stale
+        return 500, None, serialization.dumps({"result": False, "errors": "service error"}, pretty=pretty)
+
+    # error out if key doesn't exist
+    if (listings is None) or (users is None):
+        logging.error("key error during API dict access")
+        return 500, None, serialization.dumps({"result": False, "errors": "service error"}, pretty=pretty)
+
+    # display listings from /listings with merged users from /users, joined on user id
+    '''
+    Assumptions:
+    For every property listing in /listings endpoint,
+    there is a corresponding user_id in /users.
+    If there is a listing with no corresponding user: throw error
+    '''
+    users_by_id = {user["id"]: user for user in users}
+    for listing in listings:
+        user = users_by_id.get(listing.pop("user_id"))
+        if user is None:
+            logging.error("check databases, every listing needs corresponding name and user_id")
+            return 400, None, serialization.dumps({"result": False, "errors": "invalid user_id"}, pretty=pretty)
+        listing["user"] = user
+
+    body = serialization.dumps({"result": True, "listings": listings}, pretty=pretty)
+    etag = version_etag(versions, cache_key) if None not in versions else None
+    if cache is not None:
+        cache.set(cache_key, (etag, body), len(body), generation=generation)
+    return 200, etag, body
+
+
+# Strong ETag for a page computed from the upstream data versions and the page's cache key
+def version_etag(versions, cache_key):
+    digest = hashlib.sha1(tornado.escape.utf8(repr(cache_key))).hexdigest()[:16]
+    return '"{}-{}"'.format(".".join(str(version) for version in versions), digest)
+
+
+# Pages are fetched from upstreams in columnar form, as MessagePack when it is installed,
+# which is smaller and cheaper to encode and decode than a JSON object per row
+UPSTREAM_PAGE_HEADERS = {"Accept": serialization.MSGPACK_CONTENT_TYPES[0]} if serialization.binary_available() else None
+
+
+def upstream_page(response, key):
+    # The rows of a columnar upstream page, None if the page has no such key
+    body = serialization.loads_response(response.body, response.headers.get("Content-Type"))
+    return serialization.rows(body.get(key))
+
+
+def upstream_version(response):
+    # The data version an upstream response reflects, None if it does not say
+    version = response.headers.get("X-Data-Version")
+    return int(version) if version is not None else None
+
+
+# Reads publicapi_service makes from listing_service and user_service, over HTTP
+# embedded.LocalReads has the same coroutines and runs the services' queries in-process instead
+# Pages and lookups come with the data version of the service they were read from, a
+# version the results reflect at least (None if unknown)
+class UpstreamReads(object):
+
+    def __init__(self, listing_service, user_service):
+        self.listing_service = listing_service
+        self.user_service = user_service
+
+    @tornado.gen.coroutine
+    def versions(self):
+        # The (listing_service, user_service) data versions
+        responses = yield [
+            self.listing_service.fetch("/listings/version"),
+            self.user_service.fetch("/users/version"),
+        ]
+        return tuple(serialization.loads(response.body)["version"] for response in responses)
+
+    @tornado.gen.coroutine
+    def listings_page(self, page_num, page_size, filters):
+        # One GET /listings page as (list of dicts, version), passing the filters that are set along
+        # The list is None if the response holds no listings
+        query = {"page_num": page_num, "page_size": page_size, "format": "columnar"}
+        for param, value in filters.items():
+            if value is not None:
+                query[param] = value
+        response = yield self.listing_service.fetch("/listings", query, headers=UPSTREAM_PAGE_HEADERS)
+        return upstream_page(response, "listings"), upstream_version(response)
+
+    @tornado.gen.coroutine
+    def users_by_ids(self, ids):
+        # The users with the given ids as (list of dicts, version), in one lookup
+        # The list is None if the response holds no users
+        response = yield self.user_service.fetch(
+            "/users", {"ids": ",".join(str(id) for id in ids), "format": "columnar"}, headers=UPSTREAM_PAGE_HEADERS)
+        return upstream_page(response, "users"), upstream_version(response)
+
+
+@tornado.gen.coroutine
+def multiple_async_http_requests(app, page_num, page_size, user_id=None, listing_type=None,
+                                 min_price=None, max_price=None):
+    # Resolves to (listings, users, versions), versions being the (listing_service, user_service)
+    # data versions the page reflects at least, either of them None if unknown
+    # Get the page of listings, passing the filters along
+    filters = {"user_id": user_id, "listing_type": listing_type, "min_price": min_price, "max_price": max_price}
+    listings, listings_version = yield app.reads.listings_page(page_num, page_size, filters)
+
+    # Look the distinct users of that page up in the local replica first
+    user_ids = sorted(set(listing["user_id"] for listing in listings or []))
+    users = []
+    users_version = None
+    if app.user_replica is not None:
+        users_version = app.user_replica.version()
+        missing_ids = []
+        for id in user_ids:
+            user = app.user_replica.get(id)
+            if user is None:
+                missing_ids.append(id)
+            else:
+                users.append(user.to_dict())
+        user_ids = missing_ids
+    if not user_ids:
+        return listings, users, (listings_version, users_version)
+
+    # Get the remaining users, in one lookup
+    fetched_users, fetched_version = yield app.reads.users_by_ids(user_ids)
+    if fetched_users is None:
+        return listings, None, (listings_version, None)
+    if app.user_replica is not None:
+        app.user_replica.add(fetched_users)
+        if users:
+            # Users from both reflect the older of the two versions
+            if None in (fetched_version, users_version):
+                fetched_version = None
+            else:
+                fetched_version = min(fetched_version, users_version)
+    return listings, users + fetched_users, (listings_version, fetched_version)
+
+
+# /public-api/listings/batch
+# only POST supported, the JSON array body is forwarded to listing_service
+class PublicListingsBatch(BaseHandler):
+    @tornado.gen.coroutine
+    def post(self):
+        try:
+            response = yield self.application.listing_service.fetch(
+                "/listings/batch",
+                method='POST',
+                body=self.request.body,
+                headers={"Content-Type": "application/json"},
+                raise_error=False
+            )
+        except CircuitOpen:
+            self.write_unavailable()
+            return
+        self.application.invalidate_listings_cache()
+        self.write_upstream(response)
 
 
 # /public-api/users
@@ -173,10 +668,7 @@ class PublicUsers(BaseHandler):
             self.write_json({"result": False, "errors": errors}, status_code=400)
             return
 
-        http_client = AsyncHTTPClient()
-        body = urllib.parse.urlencode(data)
-        response = http_client.fetch("http://localhost:6524/users", method='POST', body=body)
-        self.write_json(data)
+        yield self.submit_write("users", {"name": name_val})
 
     # assumptions: we only want strings that only have letters in them, "dan99" or 95 are not valid names
     # also allows for white spaces in case of e.g ("Daniel <space> Radcliffe")
@@ -190,6 +682,76 @@ class PublicUsers(BaseHandler):
             return None
 
 
+# /public-api/users/batch
+# only POST supported, the JSON array body is forwarded to user_service
+class PublicUsersBatch(BaseHandler):
+    @tornado.gen.coroutine
+    def post(self):
+        try:
+            response = yield self.application.user_service.fetch(
+                "/users/batch",
+                method='POST',
+                body=self.request.body,
+                headers={"Content-Type": "application/json"},
+                raise_error=False
+            )
+        except CircuitOpen:
+            self.write_unavailable()
+            return
+        self.application.invalidate_listings_cache()
+        self.write_upstream(response)
+
+
+# /public-api/cache
+# only GET supported, reports the listings response cache, request coalescing and users replica counters
+class PublicCacheStats(BaseHandler):
+    # Monitoring keeps working while the service sheds load
+    admission_controlled = False
+
+    @tornado.gen.coroutine
+    def get(self):
+        cache = self.application.listings_cache
+        flights = self.application.flights
+        replica = self.application.user_replica
+        self.write_json({
+            "result": True,
+            "enabled": cache is not None,
+            "cache": cache.stats() if cache is not None else None,
+            "coalescing": flights.stats() if flights is not None else None,
+            "user_replica": replica.stats() if replica is not None else None,
+            "upstreams": {
+                upstream.name: upstream.stats()
+                for upstream in (self.application.listing_service, self.application.user_service)
+            },
+        })
+
+
+# /public-api/writes
+# only GET supported, reports the depth, lag and counters of the write queues
+class PublicWritesStats(BaseHandler):
+    # Monitoring keeps working while the service sheds load
+    admission_controlled = False
+
+    @tornado.gen.coroutine
+    def get(self):
+        self.write_json({
+            "result": True,
+            "queues": {name: queue.stats() for name, queue in self.application.write_queues.items()},
+        })
+
+
+# /public-api/writes/(listings|users)/<tracking_id>
+# only GET supported, reports the status of a write accepted with a tracking id
+class PublicWriteStatus(BaseHandler):
+    @tornado.gen.coroutine
+    def get(self, queue_name, tracking_id):
+        status = self.application.write_queues[queue_name].status(tracking_id)
+        if status is None:
+            self.write_json({"result": False, "errors": "unknown tracking_id"}, status_code=404)
+            return
+        self.write_json(dict(status, result=True, tracking_id=tracking_id))
+
+
 # /public-api/ping
 class PingHandler(tornado.web.RequestHandler):
     @tornado.gen.coroutine
@@ -197,12 +759,114 @@ class PingHandler(tornado.web.RequestHandler):
         self.write("pong!")
 
 
-def make_app(options):
-    return tornado.web.Application([
+def define_options(parser=tornado.options.options):
+    # Specify the maximum number of concurrent upstream requests, further requests queue in the client
+    parser.define("upstream_max_clients", default=100)
+    # Specify whether to use the keep-alive curl client for upstream requests (needs pycurl)
+    parser.define("upstream_curl", default=True)
+    # Specify how long (in milliseconds) connecting to an upstream may take
+    parser.define("upstream_connect_timeout_ms", default=1000)
+    # Specify how long (in milliseconds) a listing_service request may take in total
+    parser.define("listing_service_timeout_ms", default=5000)
+    # Specify how long (in milliseconds) a user_service request may take in total
+    parser.define("user_service_timeout_ms", default=5000)
+    # Specify whether slow upstream GETs are also sent to a second replica, after their recent p95 latency
+    parser.define("upstream_hedge", default=False)
+    # Specify the shortest delay (in milliseconds) before a GET is hedged
+    parser.define("upstream_hedge_min_delay_ms", default=5)
+    # Specify the share of failed upstream requests that opens its circuit breaker (0 disables the breakers)
+    parser.define("breaker_error_rate", default=0.5)
+    # Specify how many recent requests the error rate needs before the breaker may open
+    parser.define("breaker_min_requests", default=20)
+    # Specify the window (in milliseconds) over which the error rate is measured
+    parser.define("breaker_window_ms", default=10000)
+    # Specify how long (in milliseconds) an open breaker turns requests away before letting a trial one through
+    parser.define("breaker_open_ms", default=5000)
+    # Specify how long (in seconds) GET /public-api/listings responses stay cached (0 disables the cache)
+    parser.define("cache_ttl", default=0.0)
+    # Specify the maximum number of cached responses, least recently used ones are evicted first
+    parser.define("cache_max_entries", default=1000)
+    # Specify the maximum total size (in bytes) of cached responses
+    parser.define("cache_max_bytes", default=64 * 1024 * 1024)
+    # Specify how long (in seconds) expired responses are kept to be served when upstreams fail
+    parser.define("cache_stale_ttl", default=0.0)
+    # Specify whether concurrent identical reads share a single upstream fetch
+    parser.define("coalesce_reads", default=True)
+    # Specify whether to keep a local replica of users (synced from /users/changes) to enrich listings
+    parser.define("user_replica", default=True)
+    # Specify the maximum number of writes of each kind waiting to be forwarded, further ones get a 503
+    parser.define("write_queue_max_size", default=10000)
+    # Specify the maximum number of writes forwarded in one upstream batch request
+    parser.define("write_batch_size", default=100)
+    # Specify how long (in milliseconds) to wait for a batch of writes to fill up
+    parser.define("write_batch_window_ms", default=5)
+    # Specify how many times a failed batch of writes is retried before its writes fail
+    parser.define("write_max_retries", default=5)
+    # Specify the delay (in milliseconds) before the first retry, doubling with every retry
+    parser.define("write_retry_delay_ms", default=100)
+    # Specify a directory to spool accepted writes to, so they are forwarded after a restart (off by default)
+    parser.define("write_spool_dir", default=None)
+    # Specify how long (in milliseconds) a write waits to be forwarded before getting a 202 with its tracking id
+    parser.define("write_sync_timeout_ms", default=5000)
+    # Specify the maximum number of GET requests running at once (0 means no limit)
+    parser.define("admission_max_reads", default=64)
+    # Specify the maximum number of POST requests running at once (0 means no limit)
+    parser.define("admission_max_writes", default=32)
+    # Specify how many more requests of each kind may wait for a slot, further ones get a 503
+    parser.define("admission_max_queue", default=256)
+    # Specify how long (in milliseconds) a request may wait for a slot before getting a 503
+    parser.define("admission_queue_timeout_ms", default=1000)
+
+
+# reads replaces the HTTP reads from listing_service and user_service, see App
+def make_app(options, reads=None):
+    serialization.use_backend(options.json_backend)
+    handlers = [
+        (r"/metrics", MetricsHandler),
         (r"/public-api/ping", PingHandler),
         (r"/public-api/listings", PublicListings),
+        (r"/public-api/listings/batch", PublicListingsBatch),
         (r"/public-api/users", PublicUsers),
-    ], debug=options.debug)
+        (r"/public-api/users/batch", PublicUsersBatch),
+        (r"/public-api/cache", PublicCacheStats),
+        (r"/public-api/writes", PublicWritesStats),
+        (r"/public-api/writes/(listings|users)/([0-9a-f]+)", PublicWriteStatus),
+    ]
+    return App(
+        handlers,
+        listing_service_urls=options.listing_service_urls,
+        user_service_urls=options.user_service_urls,
+        upstream_max_clients=options.upstream_max_clients,
+        upstream_curl=options.upstream_curl,
+        cache_ttl=options.cache_ttl,
+        cache_max_entries=options.cache_max_entries,
+        cache_max_bytes=options.cache_max_bytes,
+        cache_stale_ttl=options.cache_stale_ttl,
+        coalesce_reads=options.coalesce_reads,
+        user_replica=options.user_replica,
+        admission_max_reads=options.admission_max_reads,
+        admission_max_writes=options.admission_max_writes,
+        admission_max_queue=options.admission_max_queue,
+        admission_queue_timeout_ms=options.admission_queue_timeout_ms,
+        upstream_connect_timeout_ms=options.upstream_connect_timeout_ms,
+        listing_service_timeout_ms=options.listing_service_timeout_ms,
+        user_service_timeout_ms=options.user_service_timeout_ms,
+        upstream_hedge=options.upstream_hedge,
+        upstream_hedge_min_delay_ms=options.upstream_hedge_min_delay_ms,
+        breaker_error_rate=options.breaker_error_rate,
+        breaker_min_requests=options.breaker_min_requests,
+        breaker_window_ms=options.breaker_window_ms,
+        breaker_open_ms=options.breaker_open_ms,
+        write_queue_max_size=options.write_queue_max_size,
+        write_batch_size=options.write_batch_size,
+        write_batch_window_ms=options.write_batch_window_ms,
+        write_max_retries=options.write_max_retries,
+        write_retry_delay_ms=options.write_retry_delay_ms,
+        write_spool_dir=options.write_spool_dir,
+        write_sync_timeout_ms=options.write_sync_timeout_ms,
+        reads=reads,
+        debug=options.debug
+    )
 
 
 if __name__ == "__main__":
@@ -210,8 +874,18 @@ if __name__ == "__main__":
     # Specify the port number to start the web app on (default value is port 6000)
     tornado.options.define("port", default=6000)
     # Specify whether the app should run in debug mode
-    # Debug mode restarts the app automatically on file changes
-    tornado.options.define("debug", default=True)
+    # Debug mode restarts the app automatically on file changes, only use it in development
+    tornado.options.define("debug", default=False)
+    # Define the process model options (processes, reuse_port, shutdown_timeout, max_restarts)
+    serving.define_options()
+    # Specify the JSON backend: orjson, ujson, json, or auto to pick the fastest installed one
+    tornado.options.define("json_backend", default="auto")
+    # Specify the base URLs of the listing_service replicas, requests are spread round-robin
+    tornado.options.define("listing_service_urls", default=["http://localhost:6555"], multiple=True)
+    # Specify the base URLs of the user_service replicas, requests are spread round-robin
+    tornado.options.define("user_service_urls", default=["http://localhost:6524"], multiple=True)
+    # Define the upstream, cache, write queue and admission control options
+    define_options()
 
     # Read settings/options from command line
     tornado.options.parse_command_line()
@@ -219,10 +893,5 @@ if __name__ == "__main__":
     # Access the settings defined
     options = tornado.options.options
 
-    # Create web app
-    app = make_app(options)
-    app.listen(options.port)
-    logging.info("Starting publicapi service. PORT: {}, DEBUG: {}".format(options.port, options.debug))
-
-    # Start event loop
-    tornado.ioloop.IOLoop.instance().start()
\ No newline at end of file
+    # Create web app(s) and start event loop(s)
+    serving.serve(make_app, options, "publicapi service")
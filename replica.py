@@ -0,0 +1,110 @@
+import logging
+import tornado.gen
+import tornado.ioloop
+import serialization
+
+
+class UserRecord(object):
+    __slots__ = ("id", "name", "created_at", "updated_at")
+
+    def __init__(self, id, name, created_at, updated_at):
+        self.id = id
+        self.name = name
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+# Local, read-only copy of user_service's users, keyed by id
+# It is warmed with a full pass over GET /users/changes at startup, then kept
+# current by long-polling the same feed for users updated since the last sync.
+class UserReplica(object):
+
+    def __init__(self, user_service, page_size=1000, wait=15, retry_delay=1.0):
+        self.user_service = user_service
+        self.page_size = page_size
+        self.wait = wait
+        self.retry_delay = retry_delay
+        self.since = "0"
+        self.max_id = 0  # highest user id pulled from the feed
+        self.ready = False
+        self.syncs = 0
+        self.sync_errors = 0
+        self._users = {}
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._users)
+
+    def get(self, id):
+        return self._users.get(id)
+
+    def add(self, users):
+        # Adds users fetched some other way, without moving the sync position
+        for user in users:
+            self._put(user)
+
+    def start(self):
+        tornado.ioloop.IOLoop.current().add_callback(self._run)
+
+    def stop(self):
+        self._stopped = True
+
+    @tornado.gen.coroutine
+    def _run(self):
+        while not self._stopped:
+            try:
+                # Only long-poll once warm, the initial pass reads pages back to back
+                got_full_page = yield self.sync(wait=self.wait if self.ready else 0)
+            except Exception:
+                self.sync_errors += 1
+                logging.exception("Error while syncing users replica, retrying in {}s".format(self.retry_delay))
+                yield tornado.gen.sleep(self.retry_delay)
+                continue
+            if not got_full_page and not self.ready:
+                logging.info("Users replica warmed with {} users".format(len(self._users)))
+                self.ready = True
+
+    @tornado.gen.coroutine
+    def sync(self, wait=0):
+        # Pulls one page of changes, resolving to whether the page was full (more may follow)
+        response = yield self.user_service.fetch(
+            "/users/changes",
+            {"since": self.since, "limit": self.page_size, "wait": wait},
+            request_timeout=wait + 10
+        )
+        body = serialization.loads(response.body)
+        users = body.get("users") or []
+        for user in users:
+            self._put(user)
+            self.max_id = max(self.max_id, user["id"])
+        self.since = body.get("next_since", self.since)
+        self.syncs += 1
+        return len(users) == self.page_size
+
+    def version(self):
+        # user_service data version (its highest user id) the replica has caught up with,
+        # None until warm
+        return self.max_id if self.ready else None
+
+    def stats(self):
+        return {
+            "users": len(self._users),
+            "ready": self.ready,
+            "syncs": self.syncs,
+            "sync_errors": self.sync_errors,
+        }
+
+    def _put(self, user):
+        current = self._users.get(user["id"])
+        # Never let an older copy of a user overwrite a newer one
+        if current is not None and current.updated_at > user["updated_at"]:
+            return
+        self._users[user["id"]] = UserRecord(user["id"], user["name"], user["created_at"], user["updated_at"])
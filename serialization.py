@@ -0,0 +1,114 @@
+import json
+import logging
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Pluggable JSON encoding/decoding shared by all services
+# Output is compact by default; pretty output (indented) is meant for humans only.
+# A faster encoder is used when one is installed: orjson, then ujson, falling back
+# to the standard library json module. Encoded values may be str or bytes.
+# When msgpack is installed, responses can also be encoded as MessagePack, a compact
+# binary equivalent of JSON, for clients sending Accept: application/msgpack.
+BACKENDS = ("orjson", "ujson", "json")
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack")
+
+_backend = None
+_dumps = None
+_dumps_pretty = None
+_loads = None
+
+
+def use_backend(name="auto"):
+    # Selects the backend by name, "auto" picks the fastest installed one
+    global _backend, _dumps, _dumps_pretty, _loads
+    candidates = BACKENDS if name == "auto" else (name,)
+    for candidate in candidates:
+        try:
+            _dumps, _dumps_pretty, _loads = _load(candidate)
+        except ImportError:
+            if name != "auto":
+                raise
+            continue
+        _backend = candidate
+        logging.info("Using {} for JSON serialization".format(candidate))
+        return _backend
+    raise ValueError("unknown JSON backend: {}".format(name))
+
+
+def backend():
+    return _backend
+
+
+def dumps(obj, pretty=False):
+    if pretty:
+        return _dumps_pretty(obj)
+    return _dumps(obj)
+
+
+def loads(data):
+    return _loads(data)
+
+
+def binary_available():
+    return msgpack is not None
+
+
+def binary_accepted(accept):
+    # Whether a request's Accept header asks for MessagePack, and it can be produced
+    return msgpack is not None and any(content_type in (accept or "") for content_type in MSGPACK_CONTENT_TYPES)
+
+
+def dumps_binary(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def loads_response(body, content_type):
+    # Decodes a response body according to its Content-Type, MessagePack or JSON
+    if msgpack is not None and (content_type or "").split(";")[0].strip() in MSGPACK_CONTENT_TYPES:
+        return msgpack.unpackb(body, raw=False)
+    return _loads(body)
+
+
+def columns(fields, rows):
+    # Columnar form of rows (sequences in fields order): one list of values per field,
+    # transposed without building a dict per row
+    if not rows:
+        return {field: [] for field in fields}
+    return {field: list(values) for field, values in zip(fields, zip(*rows))}
+
+
+def rows(columns):
+    # Row form (one dict per row) of a columnar result, None stays None
+    if columns is None:
+        return None
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+def _load(name):
+    if name == "orjson":
+        import orjson
+        return (
+            orjson.dumps,
+            lambda obj: orjson.dumps(obj, option=orjson.OPT_INDENT_2),
+            orjson.loads
+        )
+    if name == "ujson":
+        import ujson
+        return (
+            ujson.dumps,
+            lambda obj: ujson.dumps(obj, indent=4),
+            ujson.loads
+        )
+    if name == "json":
+        return (
+            lambda obj: json.dumps(obj, separators=(",", ":")),
+            lambda obj: json.dumps(obj, indent=4),
+            json.loads
+        )
+    raise ImportError("unsupported JSON backend: {}".format(name))
+
+
+use_backend("json")
@@ -0,0 +1,258 @@
+import errno
+import logging
+import os
+import signal
+import sys
+import tornado.gen
+import tornado.httpserver
+import tornado.httputil
+import tornado.ioloop
+import tornado.netutil
+import tornado.options
+
+
+# Interval (in seconds) at which a shutdown checks whether in-flight requests are done
+DRAIN_POLL_INTERVAL = 0.05
+
+
+# Task id (0 to processes - 1) of this process when serve() forked it, None otherwise
+# A restarted child gets the task id of the one it replaces
+_task_id = None
+
+
+def current_task_id():
+    return _task_id
+
+
+def define_options(parser=tornado.options.options):
+    # Specify the number of server processes, 0 starts one per CPU core
+    # Every process runs its own IOLoop and opens its own db connections after the fork
+    parser.define("processes", default=1)
+    # Specify whether every process binds its own socket with SO_REUSEPORT (Linux, BSD)
+    # instead of all processes sharing one socket bound before the fork
+    parser.define("reuse_port", default=False)
+    # Specify how long (in seconds) in-flight requests get to finish on SIGTERM/SIGINT
+    parser.define("shutdown_timeout", default=10.0)
+    # Specify how many times crashed processes are restarted before giving up
+    parser.define("max_restarts", default=100)
+
+
+# Runs make_app(options) on options.port, in one or more processes
+# With more than one process, the parent only supervises: it forks the children,
+# restarts the ones that crash, and forwards SIGTERM/SIGINT to them. Each child
+# builds its own app (and so its own SQLite connections) after the fork.
+def serve(make_app, options, name):
+    serve_apps(lambda options: [make_app(options)], [options.port], options, name)
+
+
+# Like serve(), for several apps sharing each process and IOLoop
+# make_apps(options) returns one app per port, the first one listens on ports[0], and so on
+def serve_apps(make_apps, ports, options, name):
+    processes = options.processes
+    if processes <= 0:
+        processes = os.cpu_count() or 1
+
+    # Autoreload restarts the process on file changes and cannot work across forks
+    if processes > 1 and options.debug:
+        logging.warning("Debug mode is not supported with multiple processes, disabling it")
+        options.debug = False
+
+    sockets = None
+    if processes == 1 or not options.reuse_port:
+        sockets = [tornado.netutil.bind_sockets(port) for port in ports]
+
+    global _task_id
+    task_id = None
+    if processes > 1:
+        task_id = _fork_processes(processes, options.max_restarts)
+        _task_id = task_id
+        if sockets is None:
+            sockets = [tornado.netutil.bind_sockets(port, reuse_port=True) for port in ports]
+
+    logging.info("Starting {}. PORT: {}, DEBUG: {}, PROCESS: {}".format(
+        name, ", ".join(str(port) for port in ports), options.debug, task_id if task_id is not None else "main"))
+
+    apps = make_apps(options)
+    servers = []
+    trackers = []
+    for app, port_sockets in zip(apps, sockets):
+        tracker = RequestTracker(app)
+        server = tornado.httpserver.HTTPServer(tracker)
+        server.add_sockets(port_sockets)
+        servers.append(server)
+        trackers.append(tracker)
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    stopping = []
+
+    def shutdown():
+        if stopping:
+            return
+        stopping.append(True)
+        # Stop accepting connections, then give in-flight requests time to finish
+        logging.info("Stopping {}, waiting up to {}s for {} in-flight requests".format(
+            name, options.shutdown_timeout, sum(tracker.in_flight for tracker in trackers)))
+        for server in servers:
+            server.stop()
+        drain(trackers, io_loop.time() + options.shutdown_timeout)
+
+    @tornado.gen.coroutine
+    def drain(trackers, deadline):
+        # Stops the IOLoop once every request is done, or at the deadline
+        while any(tracker.in_flight for tracker in trackers) and io_loop.time() < deadline:
+            yield tornado.gen.sleep(DRAIN_POLL_INTERVAL)
+        io_loop.stop()
+
+    def handle_signal(signum, frame):
+        io_loop.add_callback_from_signal(shutdown)
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    io_loop.start()
+    for app in apps:
+        close = getattr(app, "close", None)
+        if close is not None:
+            close()
+
+
+# Server side wrapper of an app counting the requests in flight, from their headers
+# being read to their response being finished, or their connection closing
+class RequestTracker(tornado.httputil.HTTPServerConnectionDelegate):
+
+    def __init__(self, app):
+        self.app = app
+        self.in_flight = 0
+
+    def start_request(self, server_conn, request_conn):
+        # Called as soon as a connection may carry a request, idle keep-alive
+        # connections included: requests only count once their headers arrive
+        connection = _TrackedConnection(self, request_conn)
+        return _TrackedRequest(connection, self.app.start_request(server_conn, connection))
+
+    def on_close(self, server_conn):
+        self.app.on_close(server_conn)
+
+
+class _TrackedRequest(tornado.httputil.HTTPMessageDelegate):
+
+    def __init__(self, connection, delegate):
+        self.connection = connection
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        self.connection.start()
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        self.delegate.finish()
+
+    def on_connection_close(self):
+        self.connection.done()
+        self.delegate.on_connection_close()
+
+
+# The request connection as handlers see it, noting when the response is finished
+class _TrackedConnection(object):
+
+    def __init__(self, tracker, connection):
+        self._tracker = tracker
+        self._connection = connection
+        self._started = False
+        self._done = False
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            self._tracker.in_flight += 1
+
+    def done(self):
+        if self._started and not self._done:
+            self._done = True
+            self._tracker.in_flight -= 1
+
+    def set_close_callback(self, callback):
+        def on_close():
+            self.done()
+            if callback is not None:
+                callback()
+        self._connection.set_close_callback(on_close)
+
+    def finish(self):
+        try:
+            return self._connection.finish()
+        finally:
+            self.done()
+
+
+# Forks num_processes children and supervises them, returning the task id (0 to
+# num_processes - 1) in each child. The parent never returns: it exits once all
+# children are gone.
+def _fork_processes(num_processes, max_restarts):
+    children = {}
+    stopping = []
+
+    def start_child(task_id):
+        pid = os.fork()
+        if pid == 0:
+            # Children handle signals themselves, see serve()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            return task_id
+        children[pid] = task_id
+        return None
+
+    def forward_signal(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    signal.signal(signal.SIGTERM, forward_signal)
+    signal.signal(signal.SIGINT, forward_signal)
+
+    for i in range(num_processes):
+        task_id = start_child(i)
+        if task_id is not None:
+            return task_id
+
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        task_id = children.pop(pid, None)
+        if task_id is None:
+            continue
+
+        if os.WIFSIGNALED(status):
+            logging.warning("Child {} (pid {}) killed by signal {}".format(task_id, pid, os.WTERMSIG(status)))
+        elif os.WEXITSTATUS(status) != 0:
+            logging.warning("Child {} (pid {}) exited with status {}".format(task_id, pid, os.WEXITSTATUS(status)))
+        else:
+            logging.info("Child {} (pid {}) exited normally".format(task_id, pid))
+            continue
+
+        # Restart crashed children, unless we are shutting down
+        if stopping:
+            continue
+        restarts += 1
+        if restarts > max_restarts:
+            logging.error("Too many child restarts, giving up")
+            forward_signal(signal.SIGTERM, None)
+            continue
+        new_id = start_child(task_id)
+        if new_id is not None:
+            return new_id
+
+    sys.exit(0)
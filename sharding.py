@@ -0,0 +1,126 @@
+import collections
+import heapq
+import itertools
+import os
+import tornado.gen
+
+
+# Rows of one table spread over several db.Database shards by an integer key
+# Row with key k lives on shard k % len(shards). Ids stay unique across shards by
+# giving every shard its own residue class: shard i only hands out ids congruent to
+# i modulo the number of shards (see next_id_sql), so a row's id also tells its shard.
+# Queries on a single key go to one shard, other queries run on every shard and
+# their (individually ordered) results are merged.
+class ShardSet(object):
+
+    def __init__(self, databases):
+        if not databases:
+            raise ValueError("at least one shard is required")
+        self.databases = list(databases)
+
+    def __len__(self):
+        return len(self.databases)
+
+    def __iter__(self):
+        return iter(self.databases)
+
+    def index_for(self, key):
+        return key % len(self.databases)
+
+    def for_key(self, key):
+        return self.databases[self.index_for(key)]
+
+    @tornado.gen.coroutine
+    def query(self, stmt, args=(), sort_key=None, reverse=False, offset=0, limit=None):
+        # Runs stmt on every shard concurrently, resolving to the rows of all shards
+        # merged by sort_key (which every shard's stmt must already be ordered by),
+        # skipping the first offset rows and keeping at most limit rows
+        results = yield [db.query(stmt, args) for db in self.databases]
+        if len(results) == 1:
+            rows = results[0]
+        else:
+            rows = heapq.merge(*results, key=sort_key, reverse=reverse)
+        stop = offset + limit if limit is not None else None
+        return list(itertools.islice(rows, offset, stop))
+
+    @tornado.gen.coroutine
+    def query_each(self, stmt, shard_args, sort_key=None, limit=None):
+        # Same as query, with its own args for every shard, in shard order
+        results = yield [db.query(stmt, args) for db, args in zip(self.databases, shard_args)]
+        if len(results) == 1:
+            rows = results[0]
+        else:
+            rows = heapq.merge(*results, key=sort_key)
+        return list(itertools.islice(rows, limit))
+
+    def stream(self, stmt, args=(), sort_key=None, chunk_size=1000):
+        # Iterates stmt over every shard lazily, merged by sort_key, see MergedStream
+        streams = [db.stream(stmt, args, chunk_size=chunk_size) for db in self.databases]
+        if len(streams) == 1:
+            return streams[0]
+        return MergedStream(streams, sort_key, chunk_size)
+
+    def close(self):
+        for db in self.databases:
+            db.close()
+
+
+# Database file paths of a shard set, a single shard keeps the path as is
+# listings.db with 4 shards is stored in listings.0.db to listings.3.db
+def shard_paths(path, num_shards):
+    if num_shards == 1:
+        return [path]
+    root, ext = os.path.splitext(path)
+    return ["{}.{}{}".format(root, index, ext) for index in range(num_shards)]
+
+
+# SQL expression handing out the next id of a shard, taking two parameters: the
+# shard index and the number of shards
+# Shard i's ids are i + N, i + 2N, ... Writes to a shard are serialised by SQLite's
+# write lock, and MAX(id) is a lookup of the last rowid, so this stays cheap.
+def next_id_sql(table):
+    return "(SELECT IFNULL(MAX(id), ?) + ? FROM {})".format(table)
+
+
+# k-way merge of several ordered QueryStreams, with the same next_chunk()/close()
+# interface
+# Rows are only emitted while every stream that is not exhausted has rows buffered,
+# since the next smallest row may otherwise still be on its way.
+class MergedStream(object):
+
+    def __init__(self, streams, sort_key, chunk_size=1000):
+        self.streams = streams
+        self.sort_key = sort_key
+        self.chunk_size = chunk_size
+        self._buffers = [collections.deque() for _ in streams]
+        self._exhausted = [False] * len(streams)
+
+    @tornado.gen.coroutine
+    def next_chunk(self):
+        # Resolves to the next list of rows, an empty list once every stream is exhausted
+        while True:
+            refill = [i for i, buffer in enumerate(self._buffers) if not buffer and not self._exhausted[i]]
+            if refill:
+                chunks = yield [self.streams[i].next_chunk() for i in refill]
+                for i, chunk in zip(refill, chunks):
+                    if chunk:
+                        self._buffers[i].extend(chunk)
+                    else:
+                        self._exhausted[i] = True
+
+            rows = []
+            while len(rows) < self.chunk_size:
+                if any(not buffer and not exhausted for buffer, exhausted in zip(self._buffers, self._exhausted)):
+                    break
+                candidates = [i for i, buffer in enumerate(self._buffers) if buffer]
+                if not candidates:
+                    break
+                i = min(candidates, key=lambda i: self.sort_key(self._buffers[i][0]))
+                rows.append(self._buffers[i].popleft())
+
+            if rows or all(self._exhausted):
+                return rows
+
+    def close(self):
+        for stream in self.streams:
+            stream.close()
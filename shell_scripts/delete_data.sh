@@ -6,6 +6,7 @@ cd ..
 # remove databases...
 # NOTE: NEVER DO THIS IN PRODUCTION, USE TRASH ... RM REMOVES DATABASE FILES ENTIRELY
 # SEE: https://www.codesandnotes.com/tools-and-workflow/use-trash-instead-of-rm/
-rm -f listings.db && rm -f users.db
-
+rm -f listings.db listings.db-wal listings.db-shm && rm -f users.db users.db-wal users.db-shm
 
+# remove listing shards, when running with --db_shards
+rm -f listings.[0-9]*.db listings.[0-9]*.db-wal listings.[0-9]*.db-shm
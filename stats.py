@@ -0,0 +1,110 @@
+import math
+
+
+# Mergeable quantile sketch over positive numbers, with a bounded relative error
+# Values are counted in logarithmic buckets, bucket i holding the values in
+# (gamma^(i-1), gamma^i], so every quantile is estimated within relative_accuracy
+# of an actual value, using one counter per distinct bucket. Sketches with the same
+# accuracy merge by adding up their counters.
+class PriceSketch(object):
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}  # bucket index -> count
+
+    def add(self, value):
+        index = int(math.ceil(math.log(max(value, 1)) / self._log_gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("cannot merge sketches of different accuracies")
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def quantiles(self, qs):
+        # Estimates of every quantile in qs (each between 0 and 1), None when empty
+        if self.count == 0:
+            return [None for _ in qs]
+        indexes = sorted(self.buckets)
+        estimates = []
+        for q in qs:
+            rank = q * (self.count - 1)
+            seen = 0
+            for index in indexes:
+                seen += self.buckets[index]
+                if seen > rank:
+                    break
+            # Middle of the bucket, never outside of the values actually seen
+            estimate = 2 * self.gamma ** index / (self.gamma + 1)
+            estimates.append(min(max(estimate, self.min), self.max))
+        return estimates
+
+    def summary(self, percentiles=(50, 90, 99)):
+        estimates = self.quantiles([p / 100.0 for p in percentiles])
+        return {
+            "count": self.count,
+            "avg_price": round(self.sum / self.count, 2) if self.count else None,
+            "min_price": self.min,
+            "max_price": self.max,
+            "percentiles": {
+                "p{:g}".format(p): int(round(estimate)) if estimate is not None else None
+                for p, estimate in zip(percentiles, estimates)
+            },
+        }
+
+
+# Price aggregates of listings overall, per listing_type and per user_id
+# Listings are only ever added, so every aggregate is updated in place, and reading
+# one costs the same however many listings there are.
+class ListingStats(object):
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.overall = PriceSketch(relative_accuracy)
+        self.by_listing_type = {}
+        self.by_user = {}
+
+    def add(self, user_id, listing_type, price):
+        self.overall.add(price)
+        self._sketch(self.by_listing_type, listing_type).add(price)
+        self._sketch(self.by_user, user_id).add(price)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        summary = self.overall.summary(percentiles)
+        summary["users"] = len(self.by_user)
+        summary["by_listing_type"] = {
+            listing_type: sketch.summary(percentiles)
+            for listing_type, sketch in sorted(self.by_listing_type.items())
+        }
+        return summary
+
+    def user_summary(self, user_id, percentiles=(50, 90, 99)):
+        sketch = self.by_user.get(user_id)
+        if sketch is None:
+            sketch = PriceSketch(self.relative_accuracy)
+        return sketch.summary(percentiles)
+
+    def _sketch(self, sketches, key):
+        sketch = sketches.get(key)
+        if sketch is None:
+            sketch = sketches[key] = PriceSketch(self.relative_accuracy)
+        return sketch
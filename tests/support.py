@@ -0,0 +1,190 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import types
+import tornado.httpserver
+import tornado.testing
+import listing_service
+import publicapi_service
+import user_service
+from sharding import shard_paths
+from upstream import make_http_client
+
+
+# Options accepted by the three services' make_app and embedded.make_apps, with their command line defaults
+DEFAULT_OPTIONS = dict(
+    debug=False,
+    json_backend="auto",
+    # listing_service, user_service
+    db_path=None,
+    db_pool_size=4,
+    db_shards=1,
+    group_commit_window_ms=0,
+    group_commit_max_batch=128,
+    version_refresh_ms=1000,
+    # user_service
+    user_cache_ttl=60.0,
+    user_cache_max_entries=100000,
+    user_cache_max_bytes=32 * 1024 * 1024,
+    # publicapi_service
+    listing_service_urls=["http://localhost:6555"],
+    user_service_urls=["http://localhost:6524"],
+    upstream_max_clients=100,
+    upstream_curl=True,
+    cache_ttl=0.0,
+    cache_max_entries=1000,
+    cache_max_bytes=64 * 1024 * 1024,
+    cache_stale_ttl=0.0,
+    coalesce_reads=True,
+    user_replica=False,
+    admission_max_reads=64,
+    admission_max_writes=32,
+    admission_max_queue=256,
+    admission_queue_timeout_ms=1000,
+    upstream_connect_timeout_ms=1000,
+    listing_service_timeout_ms=5000,
+    user_service_timeout_ms=5000,
+    upstream_hedge=False,
+    upstream_hedge_min_delay_ms=5,
+    breaker_error_rate=0.5,
+    breaker_min_requests=20,
+    breaker_window_ms=10000,
+    breaker_open_ms=5000,
+    write_queue_max_size=10000,
+    write_batch_size=100,
+    write_batch_window_ms=5,
+    write_max_retries=5,
+    write_retry_delay_ms=100,
+    write_spool_dir=None,
+    write_sync_timeout_ms=5000,
+    # embedded
+    listing_port=6555,
+    user_port=6524,
+    listing_db_path=None,
+    user_db_path=None,
+)
+
+
+def service_options(**overrides):
+    options = dict(DEFAULT_OPTIONS)
+    options.update(overrides)
+    return types.SimpleNamespace(**options)
+
+
+# Synthetic data, written straight to the db files (schema must already exist)
+# Listing i (1-based) belongs to user (i % num_users) + 1, and rows are created
+# one microsecond apart starting at BASE_TIME.
+BASE_TIME = 1500000000000000
+
+
+def seed_users(db_path, num_users, chunk_size=100000):
+    _seed(
+        db_path,
+        "INSERT INTO users (id, name, created_at, updated_at) VALUES (?, ?, ?, ?)",
+        ((i, "User {}".format(_letters(i)), BASE_TIME + i, BASE_TIME + i) for i in range(1, num_users + 1)),
+        chunk_size
+    )
+
+
+def seed_listings(db_path, num_listings, num_users, num_shards=1, chunk_size=100000):
+    # With shards, db_path is the listing_service db_path template and ids follow
+    # the shard's residue class, as handed out by sharding.next_id_sql
+    for index, path in enumerate(shard_paths(db_path, num_shards)):
+        _seed(
+            path,
+            "INSERT INTO listings (id, user_id, listing_type, price, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (i * num_shards + index, (i % num_users) + 1, "rent" if i % 2 else "sale", 1000 + (i * 7919) % 100000, BASE_TIME + i, BASE_TIME + i)
+                for i in range(1, num_listings + 1)
+                if ((i % num_users) + 1) % num_shards == index
+            ),
+            chunk_size
+        )
+
+
+def _seed(db_path, stmt, rows, chunk_size):
+    conn = sqlite3.connect(db_path)
+    try:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                conn.executemany(stmt, chunk)
+                chunk = []
+        if chunk:
+            conn.executemany(stmt, chunk)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _letters(i):
+    # User names must be alphabetical
+    letters = ""
+    while True:
+        i, rem = divmod(i, 26)
+        letters += chr(ord("a") + rem)
+        if i == 0:
+            return letters
+
+
+# Value of a sample in a Prometheus text exposition, 0 when it is missing
+# Label values must be given in the order the metric has its labels
+def metric_value(text, name, **labels):
+    label_str = ",".join('{}="{}"'.format(key, value) for key, value in labels.items())
+    series = "{}{{{}}}".format(name, label_str) if labels else name
+    for line in text.splitlines():
+        if line.startswith(series + " "):
+            return float(line.split(" ")[-1])
+    return 0.0
+
+
+# Seeded listing_service and user_service, each on its own port, with publicapi_service
+# in front of them, all talking HTTP like separate processes would
+class ServicesTestCase(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp(prefix="services-")
+        self.apps = []
+        self.servers = []
+        self.client = make_http_client(use_curl=False)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        for app in self.apps:
+            app.close()
+        self.client.close()
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def listen(self, app):
+        sock, port = tornado.testing.bind_unused_port()
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets([sock])
+        self.apps.append(app)
+        self.servers.append(server)
+        return "http://127.0.0.1:{}".format(port)
+
+    def start_services(self, num_users=10, num_listings=40, **public_options):
+        listing_db_path = os.path.join(self.tmp_dir, "listings.db")
+        user_db_path = os.path.join(self.tmp_dir, "users.db")
+        listing_service.make_app(service_options(db_path=listing_db_path)).close()
+        user_service.make_app(service_options(db_path=user_db_path)).close()
+        seed_users(user_db_path, num_users)
+        seed_listings(listing_db_path, num_listings, num_users)
+        self.listing_app = listing_service.make_app(service_options(db_path=listing_db_path, version_refresh_ms=0))
+        self.user_app = user_service.make_app(service_options(db_path=user_db_path, version_refresh_ms=0))
+        self.listing_url = self.listen(self.listing_app)
+        self.user_url = self.listen(self.user_app)
+        public_options.setdefault("upstream_curl", False)
+        self.public_app = publicapi_service.make_app(service_options(
+            listing_service_urls=[self.listing_url], user_service_urls=[self.user_url], **public_options))
+        self.public_url = self.listen(self.public_app)
+
+    def upstream_calls(self, app, handler):
+        # Requests a service has answered with 200, for one of its handlers
+        text = app.metrics.render()
+        return metric_value(text, "http_request_duration_seconds_count", handler=handler, code="200")
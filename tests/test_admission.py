@@ -0,0 +1,86 @@
+import json
+import tornado.testing
+import publicapi_service
+from admission import AdmissionControl, Rejected
+from support import service_options
+
+
+class AdmissionControlTest(tornado.testing.AsyncTestCase):
+
+    @tornado.testing.gen_test
+    def test_queued_callers_are_admitted_in_order(self):
+        control = AdmissionControl(1, max_queue=2, queue_timeout=5)
+        yield control.acquire()
+        first, second = control.acquire(), control.acquire()
+        self.assertFalse(first.done())
+        control.release()
+        self.assertTrue(first.done())
+        self.assertFalse(second.done())
+        control.release()
+        yield [first, second]
+        self.assertEqual(control.stats()["admitted"], 3)
+
+    @tornado.testing.gen_test
+    def test_full_queue_is_rejected_straight_away(self):
+        control = AdmissionControl(1, max_queue=1, queue_timeout=5)
+        yield control.acquire()
+        queued = control.acquire()
+        with self.assertRaises(Rejected) as raised:
+            yield control.acquire()
+        self.assertEqual(raised.exception.reason, "queue_full")
+        self.assertEqual(raised.exception.retry_after, 5)
+        control.release()
+        yield queued
+
+    @tornado.testing.gen_test
+    def test_waiting_past_the_timeout_is_rejected(self):
+        control = AdmissionControl(1, max_queue=1, queue_timeout=0.05)
+        yield control.acquire()
+        with self.assertRaises(Rejected) as raised:
+            yield control.acquire()
+        self.assertEqual(raised.exception.reason, "timeout")
+        self.assertEqual(control.queued(), 0)
+        # The slot freed later goes to nobody
+        control.release()
+        self.assertEqual(control.in_flight, 0)
+
+    @tornado.testing.gen_test
+    def test_zero_means_no_limit(self):
+        control = AdmissionControl(0)
+        yield [control.acquire() for _ in range(100)]
+        self.assertEqual(control.in_flight, 100)
+
+
+class PublicApiAdmissionTest(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        # Upstreams are never reached: reads are shed before, and writes are only queued
+        return publicapi_service.make_app(service_options(
+            listing_service_urls=["http://127.0.0.1:9"],
+            user_service_urls=["http://127.0.0.1:9"],
+            upstream_curl=False,
+            admission_max_reads=1,
+            admission_max_queue=0,
+        ))
+
+    def tearDown(self):
+        self._app.close()
+        super().tearDown()
+
+    def test_reads_are_shed_without_starving_writes(self):
+        # Holding the only read slot, as a slow read would
+        self.io_loop.run_sync(self._app.admission["read"].acquire)
+
+        response = self.fetch("/public-api/listings")
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers["Retry-After"], "1")
+        self.assertEqual(json.loads(response.body), {"result": False, "errors": "service overloaded"})
+
+        response = self.fetch("/public-api/users", method="POST", body=json.dumps({"name": "Ada"}),
+                              headers={"Prefer": "respond-async"})
+        self.assertEqual(response.code, 202)
+
+        response = self.fetch("/public-api/cache")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self._app.admission["read"].rejected["queue_full"], 1)
+        self.assertEqual(self._app.admission["write"].in_flight, 0)
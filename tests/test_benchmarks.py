@@ -0,0 +1,320 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import urllib.parse
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.testing
+import listing_service
+import publicapi_service
+import user_service
+from support import seed_listings, seed_users, service_options, BASE_TIME
+
+
+# In-process load tests for every endpoint
+# The three services are started on ephemeral ports inside the test's IOLoop,
+# against synthetic datasets written straight to temporary db files. Every test
+# drives concurrent requests at one endpoint and reports one JSON line:
+#   {"rows": ..., "endpoint": ..., "requests": ..., "concurrency": ...,
+#    "errors": ..., "throughput_rps": ..., "p50_ms": ..., "p99_ms": ...}
+#
+# Environment variables:
+#   BENCH_ROWS         comma separated listings dataset sizes (default 1000)
+#   BENCH_REQUESTS     requests per endpoint (default 200)
+#   BENCH_CONCURRENCY  requests in flight at once (default 10)
+#   BENCH_OUTPUT       file the JSON lines are appended to (default stdout)
+#   BENCH_TIMEOUT      seconds every test may run for (default 120)
+#   BENCH_SHARDS       number of listing_service db shards (default 1)
+DATASET_SIZES = [int(size) for size in os.environ.get("BENCH_ROWS", "1000").split(",") if size.strip()]
+REQUESTS = int(os.environ.get("BENCH_REQUESTS", 200))
+CONCURRENCY = int(os.environ.get("BENCH_CONCURRENCY", 10))
+OUTPUT = os.environ.get("BENCH_OUTPUT")
+TIMEOUT = float(os.environ.get("BENCH_TIMEOUT", 120))
+SHARDS = int(os.environ.get("BENCH_SHARDS", 1))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def report(result):
+    line = json.dumps(result, sort_keys=True)
+    if OUTPUT:
+        with open(OUTPUT, "a") as f:
+            f.write(line + "\n")
+    else:
+        sys.stdout.write(line + "\n")
+
+
+class EndpointBenchmarks(object):
+    # Number of listings, set on the generated classes below
+    rows = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.num_users = max(cls.rows // 10, 1)
+        cls.tmp_dir = tempfile.mkdtemp(prefix="bench-")
+        cls.listings_db = os.path.join(cls.tmp_dir, "listings.db")
+        cls.users_db = os.path.join(cls.tmp_dir, "users.db")
+
+        # Creating the schemas through the services themselves, then seeding
+        listing_service.make_app(service_options(db_path=cls.listings_db, db_shards=SHARDS)).close()
+        user_service.make_app(service_options(db_path=cls.users_db)).close()
+        seed_listings(cls.listings_db, cls.rows, cls.num_users, num_shards=SHARDS)
+        seed_users(cls.users_db, cls.num_users)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def setUp(self):
+        super().setUp()
+        self.apps = []
+        self.servers = []
+        listing_port = self.start(listing_service.make_app(service_options(db_path=self.listings_db, db_shards=SHARDS)))
+        user_port = self.start(user_service.make_app(service_options(db_path=self.users_db)))
+        self.public_port = self.start(publicapi_service.make_app(service_options(
+            listing_service_urls=["http://127.0.0.1:{}".format(listing_port)],
+            user_service_urls=["http://127.0.0.1:{}".format(user_port)],
+        )))
+        self.listing_port = listing_port
+        self.user_port = user_port
+        # A dedicated client so that its limits are not shared with publicapi's upstream client
+        self.client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=CONCURRENCY)
+
+    def tearDown(self):
+        self.client.close()
+        for server in self.servers:
+            server.stop()
+        for app in self.apps:
+            app.close()
+        super().tearDown()
+
+    def start(self, app):
+        sock, port = tornado.testing.bind_unused_port()
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets([sock])
+        self.apps.append(app)
+        self.servers.append(server)
+        return port
+
+    def url(self, port, path, **query):
+        url = "http://127.0.0.1:{}{}".format(port, path)
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        return url
+
+    @tornado.gen.coroutine
+    def run_load(self, endpoint, make_request, requests=REQUESTS, concurrency=CONCURRENCY):
+        # make_request(i) returns the HTTPRequest (or URL) of the i-th request
+        latencies = []
+        errors = []
+        next_index = [0]
+
+        @tornado.gen.coroutine
+        def worker():
+            while next_index[0] < requests:
+                i = next_index[0]
+                next_index[0] += 1
+                start = time.perf_counter()
+                response = yield self.client.fetch(make_request(i), raise_error=False)
+                latencies.append(time.perf_counter() - start)
+                if response.code >= 400:
+                    errors.append(response.code)
+
+        start = time.perf_counter()
+        yield [worker() for _ in range(concurrency)]
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        report({
+            "rows": self.rows,
+            "shards": SHARDS,
+            "endpoint": endpoint,
+            "requests": requests,
+            "concurrency": concurrency,
+            "errors": len(errors),
+            "throughput_rps": round(requests / elapsed, 1) if elapsed > 0 else None,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        })
+        self.assertEqual(errors, [], "{} failed with status codes {}".format(endpoint, sorted(set(errors))))
+
+    def post(self, url, body, content_type="application/x-www-form-urlencoded"):
+        return tornado.httpclient.HTTPRequest(url, method="POST", body=body, headers={"Content-Type": content_type})
+
+    # listing_service
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_listings_first_page(self):
+        url = self.url(self.listing_port, "/listings", page_num=1, page_size=10)
+        yield self.run_load("GET /listings?page_num=1", lambda i: url)
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_listings_deep_page(self):
+        # OFFSET pagination half way into the table
+        url = self.url(self.listing_port, "/listings", page_num=max(self.rows // 20, 1), page_size=10)
+        yield self.run_load("GET /listings?page_num=deep", lambda i: url)
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_listings_cursor_first_page(self):
+        url = self.url(self.listing_port, "/listings", cursor="", page_size=10)
+        yield self.run_load("GET /listings?cursor=", lambda i: url)
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_listings_cursor_deep_page(self):
+        # Keyset pagination resuming half way into the table
+        middle = max(self.rows // 2, 1)
+        cursor = listing_service.encode_cursor(BASE_TIME + middle, middle)
+        url = self.url(self.listing_port, "/listings", cursor=cursor, page_size=10)
+        yield self.run_load("GET /listings?cursor=deep", lambda i: url)
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_listings_by_user(self):
+        yield self.run_load(
+            "GET /listings?user_id",
+            lambda i: self.url(self.listing_port, "/listings", user_id=(i % self.num_users) + 1, page_size=10)
+        )
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_listings_columnar(self):
+        url = self.url(self.listing_port, "/listings", format="columnar", page_size=100)
+        yield self.run_load("GET /listings?format=columnar&page_size=100", lambda i: url)
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_listings_filtered(self):
+        # listing_type and a price range matching about a tenth of the table
+        url = self.url(self.listing_port, "/listings", listing_type="rent", min_price=10000, max_price=30000, page_size=10)
+        yield self.run_load("GET /listings?listing_type&min_price&max_price", lambda i: url)
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_listings_not_modified(self):
+        # Conditional GETs answered with 304 from the data version
+        url = self.url(self.listing_port, "/listings", page_num=1, page_size=10)
+        response = yield self.client.fetch(url)
+        headers = {"If-None-Match": response.headers["Etag"]}
+        yield self.run_load(
+            "GET /listings (If-None-Match)",
+            lambda i: tornado.httpclient.HTTPRequest(url, headers=headers)
+        )
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_listings_export_by_user(self):
+        yield self.run_load(
+            "GET /listings/export?user_id",
+            lambda i: self.url(self.listing_port, "/listings/export", user_id=(i % self.num_users) + 1)
+        )
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_listings_stats(self):
+        yield self.run_load(
+            "GET /listings/stats",
+            lambda i: self.url(self.listing_port, "/listings/stats") if i % 2 else
+            self.url(self.listing_port, "/listings/stats", user_id=(i % self.num_users) + 1)
+        )
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_listings_changes(self):
+        url = self.url(self.listing_port, "/listings/changes", since=BASE_TIME + max(self.rows - 100, 0), limit=100)
+        yield self.run_load("GET /listings/changes", lambda i: url)
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_listings_create(self):
+        yield self.run_load(
+            "POST /listings",
+            lambda i: self.post(
+                self.url(self.listing_port, "/listings"),
+                urllib.parse.urlencode({"user_id": (i % self.num_users) + 1, "listing_type": "rent", "price": 1000 + i})
+            )
+        )
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_listings_batch_create(self):
+        batch = json.dumps([
+            {"user_id": (i % self.num_users) + 1, "listing_type": "sale", "price": 1000 + i} for i in range(100)
+        ])
+        yield self.run_load(
+            "POST /listings/batch (100 items)",
+            lambda i: self.post(self.url(self.listing_port, "/listings/batch"), batch, "application/json")
+        )
+
+    # user_service
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_users_first_page(self):
+        url = self.url(self.user_port, "/users", page_num=1, page_size=10)
+        yield self.run_load("GET /users?page_num=1", lambda i: url)
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_users_by_ids(self):
+        yield self.run_load(
+            "GET /users?ids (10 ids)",
+            lambda i: self.url(self.user_port, "/users", ids=",".join(
+                str(((i * 10 + j) % self.num_users) + 1) for j in range(10)
+            ))
+        )
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_user_by_id(self):
+        yield self.run_load(
+            "GET /users/<id>",
+            lambda i: self.url(self.user_port, "/users/{}".format((i % self.num_users) + 1))
+        )
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_users_create(self):
+        yield self.run_load(
+            "POST /users",
+            lambda i: self.post(self.url(self.user_port, "/users"), urllib.parse.urlencode({"name": "Bench User"}))
+        )
+
+    # publicapi_service
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_public_listings(self):
+        # Every request differs, so neither the cache nor coalescing hides the join
+        yield self.run_load(
+            "GET /public-api/listings",
+            lambda i: self.url(self.public_port, "/public-api/listings", page_num=(i % 50) + 1, page_size=10)
+        )
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_public_listings_not_modified(self):
+        url = self.url(self.public_port, "/public-api/listings", page_num=1, page_size=10)
+        response = yield self.client.fetch(url)
+        headers = {"If-None-Match": response.headers["Etag"]}
+        yield self.run_load(
+            "GET /public-api/listings (If-None-Match)",
+            lambda i: tornado.httpclient.HTTPRequest(url, headers=headers)
+        )
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_public_listings_by_user(self):
+        yield self.run_load(
+            "GET /public-api/listings?user_id",
+            lambda i: self.url(self.public_port, "/public-api/listings", user_id=(i % self.num_users) + 1)
+        )
+
+    @tornado.testing.gen_test(timeout=TIMEOUT)
+    def test_public_listings_create(self):
+        yield self.run_load(
+            "POST /public-api/listings",
+            lambda i: self.post(
+                self.url(self.public_port, "/public-api/listings"),
+                json.dumps({"user_id": (i % self.num_users) + 1, "listing_type": "rent", "price": 1000 + i}),
+                "application/json"
+            )
+        )
+
+
+# One test class per dataset size
+for _rows in DATASET_SIZES:
+    _name = "TestBenchmarks{}Rows".format(_rows)
+    globals()[_name] = type(_name, (EndpointBenchmarks, tornado.testing.AsyncTestCase), {"rows": _rows})
@@ -0,0 +1,93 @@
+import json
+import unittest
+import tornado.testing
+from cache import ResponseCache
+from support import ServicesTestCase
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test_entries_expire_after_the_ttl(self):
+        clock = FakeClock()
+        cache = ResponseCache(10, clock=clock)
+        cache.set("page", "body", 4)
+        clock.now = 9.9
+        self.assertEqual(cache.get("page"), "body")
+        clock.now = 10
+        self.assertIsNone(cache.get("page"))
+        self.assertEqual((cache.hits, cache.misses, cache.expirations), (1, 1, 1))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = ResponseCache(60, max_entries=2, clock=FakeClock())
+        cache.set("a", "A", 1)
+        cache.set("b", "B", 1)
+        cache.get("a")
+        cache.set("c", "C", 1)
+        self.assertEqual([cache.get(key) for key in ("a", "b", "c")], ["A", None, "C"])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_entries_are_evicted_by_size(self):
+        cache = ResponseCache(60, max_bytes=10, clock=FakeClock())
+        cache.set("a", "A", 4)
+        cache.set("b", "B", 4)
+        cache.set("c", "C", 4)
+        self.assertEqual([cache.get(key) for key in ("a", "b", "c")], [None, "B", "C"])
+        self.assertEqual(cache.size_bytes, 8)
+        # Never fits, never cached
+        cache.set("huge", "H", 11)
+        self.assertIsNone(cache.get("huge"))
+        self.assertEqual(cache.size_bytes, 8)
+
+    def test_stale_entries_are_kept_for_stale_ttl(self):
+        clock = FakeClock()
+        cache = ResponseCache(10, stale_ttl=5, clock=clock)
+        cache.set("page", "body", 4)
+        clock.now = 12
+        self.assertIsNone(cache.get("page"))
+        self.assertEqual(cache.get_stale("page"), "body")
+        clock.now = 15
+        self.assertIsNone(cache.get_stale("page"))
+        self.assertEqual(cache.stale_hits, 1)
+
+    def test_values_computed_before_an_invalidation_are_dropped(self):
+        cache = ResponseCache(60, clock=FakeClock())
+        cache.set("a", "A", 1)
+        cache.set("b", "B", 1)
+        generation = cache.generation
+        cache.invalidate(["a"])
+        self.assertEqual((cache.get("a"), cache.get("b")), (None, "B"))
+        cache.set("a", "old A", 1, generation=generation)
+        self.assertIsNone(cache.get("a"))
+        cache.clear()
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.size_bytes, cache.invalidations), (0, 2))
+
+
+class PublicListingsCacheTest(ServicesTestCase):
+
+    @tornado.testing.gen_test
+    def test_pages_are_cached_until_a_write(self):
+        self.start_services(cache_ttl=60)
+        url = self.public_url + "/public-api/listings?page_size=5"
+        first = yield self.client.fetch(url)
+        second = yield self.client.fetch(url)
+        self.assertEqual(second.body, first.body)
+        self.assertEqual(self.upstream_calls(self.listing_app, "ListingsHandler"), 1)
+
+        # Forwarding a write drops the cached pages
+        response = yield self.client.fetch(self.public_url + "/public-api/listings", method="POST",
+                                           body=json.dumps({"user_id": 1, "listing_type": "rent", "price": 5}))
+        listing = json.loads(response.body)["listing"]
+        third = yield self.client.fetch(url)
+        self.assertEqual(json.loads(third.body)["listings"][0]["id"], listing["id"])
+        self.assertEqual(self.upstream_calls(self.listing_app, "ListingsHandler"), 2)
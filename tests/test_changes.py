@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import tornado.testing
+import listing_service
+import user_service
+from sharding import shard_paths
+from support import BASE_TIME, seed_listings, seed_users, service_options
+
+
+# Commits a row stamped before the rows already read, as when a request stamps its row,
+# then waits on a group commit or a slower shard while later requests commit theirs
+def commit_late(db_path, stmt, args):
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(stmt, args)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+class ChangesTestCase(tornado.testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="changes-")
+        super().setUp()
+
+    def tearDown(self):
+        self._app.close()
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def get_changes(self, path, **args):
+        response = self.fetch(path + "?" + "&".join("{}={}".format(k, v) for k, v in args.items()))
+        self.assertEqual(response.code, 200)
+        return json.loads(response.body)
+
+    def read_all(self, path, key, since="0"):
+        # Follows next_since until a page comes back empty
+        rows = []
+        while True:
+            body = self.get_changes(path, since=since, limit=7)
+            rows.extend(body[key])
+            since = body["next_since"]
+            if not body[key]:
+                return rows, since
+
+
+class ListingsChangesTest(ChangesTestCase):
+
+    def get_app(self):
+        self.db_path = os.path.join(self.tmp_dir, "listings.db")
+        options = service_options(db_path=self.db_path, db_shards=2, version_refresh_ms=0)
+        listing_service.make_app(options).close()
+        seed_listings(self.db_path, 20, 5, num_shards=2)
+        return listing_service.make_app(options)
+
+    def test_listings_committed_late_are_not_missed(self):
+        listings, since = self.read_all("/listings/changes", "listings")
+        self.assertEqual(sorted(listing["updated_at"] for listing in listings), [BASE_TIME + i for i in range(1, 21)])
+
+        # One late listing per shard, older than every listing read
+        for index, path in enumerate(shard_paths(self.db_path, 2)):
+            commit_late(path, listing_service.INSERT_LISTING_STMT, (index, 2, index + 2, "rent", 5, BASE_TIME, BASE_TIME))
+        late, _ = self.read_all("/listings/changes", "listings", since)
+        self.assertEqual([(listing["user_id"], listing["updated_at"]) for listing in late],
+                         [(2, BASE_TIME), (3, BASE_TIME)])
+
+    def test_since_accepts_an_updated_at(self):
+        body = self.get_changes("/listings/changes", since=BASE_TIME + 15)
+        self.assertEqual(sorted(listing["updated_at"] for listing in body["listings"]),
+                         [BASE_TIME + i for i in range(16, 21)])
+        self.assertEqual(self.get_changes("/listings/changes", since=body["next_since"])["listings"], [])
+
+    def test_since_beyond_sqlite_integers(self):
+        body = self.get_changes("/listings/changes", since="9" * 20)
+        self.assertEqual(body["listings"], [])
+        commit_late(shard_paths(self.db_path, 2)[0], listing_service.INSERT_LISTING_STMT, (0, 2, 2, "rent", 5, 1, 1))
+        self.assertEqual(len(self.get_changes("/listings/changes", since=body["next_since"])["listings"]), 1)
+        token = listing_service.encode_since([2 ** 64, 0])
+        self.assertEqual(self.fetch("/listings/changes?since=" + token).code, 400)
+
+
+class UsersChangesTest(ChangesTestCase):
+
+    def get_app(self):
+        self.db_path = os.path.join(self.tmp_dir, "users.db")
+        options = service_options(db_path=self.db_path, version_refresh_ms=0)
+        user_service.make_app(options).close()
+        seed_users(self.db_path, 5)
+        return user_service.make_app(options)
+
+    def test_users_committed_late_are_not_missed(self):
+        users, since = self.read_all("/users/changes", "users")
+        self.assertEqual([user["id"] for user in users], [1, 2, 3, 4, 5])
+        commit_late(self.db_path, "INSERT INTO users (name, created_at, updated_at) VALUES (?, ?, ?)",
+                    ("Late", BASE_TIME, BASE_TIME))
+        late, _ = self.read_all("/users/changes", "users", since)
+        self.assertEqual([user["name"] for user in late], ["Late"])
+
+    def test_since_accepts_former_tokens(self):
+        # Tokens handed out before the feed was ordered by commit resume from their updated_at
+        body = self.get_changes("/users/changes", since=user_service.encode_cursor(BASE_TIME + 3, 3))
+        self.assertEqual([user["id"] for user in body["users"]], [3, 4, 5])
+        self.assertEqual(self.fetch("/users/changes?since=bm9wZQ==").code, 400)
+
+    def test_since_beyond_sqlite_integers(self):
+        self.assertEqual(self.get_changes("/users/changes", since="9" * 20)["users"], [])
+        self.assertEqual(self.fetch("/users/changes?since=" + user_service.encode_since(2 ** 64)).code, 400)
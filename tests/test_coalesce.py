@@ -0,0 +1,81 @@
+import json
+import unittest.mock
+import tornado.gen
+import tornado.locks
+import tornado.testing
+import listing_service
+from coalesce import SingleFlight
+from support import ServicesTestCase
+
+
+class SingleFlightTest(tornado.testing.AsyncTestCase):
+
+    @tornado.testing.gen_test
+    def test_concurrent_callers_share_one_call(self):
+        flights = SingleFlight()
+        release = tornado.locks.Event()
+        calls = []
+
+        @tornado.gen.coroutine
+        def work(value):
+            calls.append(value)
+            yield release.wait()
+            return [value]
+
+        futures = [flights.do("key", work, i) for i in range(3)]
+        other = flights.do("other", work, 9)
+        release.set()
+        results = yield futures + [other]
+        self.assertEqual(calls, [0, 9])
+        self.assertIs(results[0], results[1])
+        self.assertEqual(results, [[0], [0], [0], [9]])
+        self.assertEqual(flights.stats(), {"in_flight": 0, "started": 2, "coalesced": 2})
+
+        # Once a flight is done, the next caller starts a new one
+        result = yield flights.do("key", work, 5)
+        self.assertEqual(result, [5])
+
+    @tornado.testing.gen_test
+    def test_errors_are_shared(self):
+        flights = SingleFlight()
+        release = tornado.locks.Event()
+
+        @tornado.gen.coroutine
+        def fail():
+            yield release.wait()
+            raise ValueError("upstream down")
+
+        futures = [flights.do("key", fail) for _ in range(2)]
+        release.set()
+        for future in futures:
+            with self.assertRaises(ValueError):
+                yield future
+
+
+class PublicListingsCoalescingTest(ServicesTestCase):
+
+    @tornado.testing.gen_test
+    def test_identical_reads_share_one_upstream_fetch(self):
+        self.start_services(coalesce_reads=True)
+        # listing_service holds its answers until every public read has arrived
+        release = tornado.locks.Event()
+        query_listings = listing_service.query_listings
+
+        @tornado.gen.coroutine
+        def held_query_listings(*args, **kwargs):
+            yield release.wait()
+            results = yield query_listings(*args, **kwargs)
+            return results
+
+        with unittest.mock.patch("listing_service.query_listings", held_query_listings):
+            url = self.public_url + "/public-api/listings?page_size=5"
+            futures = [self.client.fetch(url) for _ in range(5)] + [self.client.fetch(url + "&page_num=2")]
+            while self.public_app.flights.coalesced < 4:
+                yield tornado.gen.sleep(0.01)
+            release.set()
+            responses = yield futures
+
+        bodies = [json.loads(response.body) for response in responses]
+        self.assertTrue(all(body == bodies[0] for body in bodies[:5]))
+        self.assertNotEqual(bodies[5], bodies[0])
+        self.assertEqual(self.upstream_calls(self.listing_app, "ListingsHandler"), 2)
@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import urllib.parse
+import tornado.testing
+import listing_service
+from db import Database
+from support import service_options
+
+
+INSERT_ITEM_STMT = "INSERT INTO items (name) VALUES (?)"
+
+
+class GroupCommitTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp(prefix="db-")
+        self.path = os.path.join(self.tmp_dir, "items.db")
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE items (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL)")
+        # Rolls back the whole transaction, like SQLITE_FULL or SQLITE_IOERR may
+        conn.execute(
+            "CREATE TRIGGER items_rollback BEFORE INSERT ON items WHEN NEW.name='rollback' "
+            + "BEGIN SELECT RAISE(ROLLBACK, 'rolled back'); END")
+        conn.commit()
+        conn.close()
+        self.operations = []
+        self.db = Database(self.path, group_commit_window=0.05, observer=lambda operation, _: self.operations.append(operation))
+
+    def tearDown(self):
+        self.db.close()
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def stored(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute("SELECT id, name FROM items ORDER BY id").fetchall()
+        finally:
+            conn.close()
+
+    @tornado.testing.gen_test
+    def test_writes_in_the_window_share_one_commit(self):
+        futures = [self.db.execute(INSERT_ITEM_STMT, ("item {}".format(i),)) for i in range(10)]
+        # Every write only resolves once the transaction holding all of them is committed
+        seen = []
+        for future in futures:
+            future.add_done_callback(lambda _: seen.append(len(self.stored())))
+        ids = yield futures
+        self.assertEqual(seen, [10] * 10)
+        self.assertEqual(self.stored(), [(id, "item {}".format(i)) for i, id in enumerate(ids)])
+        self.assertEqual(len(set(ids)), 10)
+        self.assertEqual(self.operations.count("commit"), 1)
+
+    @tornado.testing.gen_test
+    def test_a_failing_write_is_rolled_back_on_its_own(self):
+        first = self.db.execute(INSERT_ITEM_STMT, ("first",))
+        bad = self.db.execute(INSERT_ITEM_STMT, (None,))
+        last = self.db.execute(INSERT_ITEM_STMT, ("last",))
+        first_id = yield first
+        with self.assertRaises(sqlite3.IntegrityError):
+            yield bad
+        last_id = yield last
+        self.assertEqual(self.stored(), [(first_id, "first"), (last_id, "last")])
+
+    @tornado.testing.gen_test
+    def test_a_rolled_back_transaction_fails_every_write(self):
+        futures = [self.db.execute(INSERT_ITEM_STMT, (name,)) for name in ("first", "rollback", "last")]
+        for future in futures:
+            with self.assertRaises(sqlite3.Error):
+                yield future
+        self.assertEqual(self.stored(), [])
+
+        # The writer's connection is usable again
+        id = yield self.db.execute(INSERT_ITEM_STMT, ("after",))
+        self.assertEqual(self.stored(), [(id, "after")])
+
+
+class GroupCommitPostTest(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="group-commit-")
+        self.db_path = os.path.join(self.tmp_dir, "listings.db")
+        return listing_service.make_app(service_options(
+            db_path=self.db_path, group_commit_window_ms=50, version_refresh_ms=0))
+
+    def tearDown(self):
+        self._app.close()
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    @tornado.testing.gen_test
+    def test_concurrent_posts_get_the_ids_they_were_stored_with(self):
+        bodies = [urllib.parse.urlencode({"user_id": i % 3 + 1, "listing_type": "rent", "price": 100 + i}) for i in range(8)]
+        responses = yield [self.http_client.fetch(self.get_url("/listings"), method="POST", body=body) for body in bodies]
+        listings = [json.loads(response.body)["listing"] for response in responses]
+        self.assertEqual(len(set(listing["id"] for listing in listings)), 8)
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            stored = dict(conn.execute("SELECT id, price FROM listings").fetchall())
+        finally:
+            conn.close()
+        self.assertEqual(stored, {listing["id"]: listing["price"] for listing in listings})
@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+import tempfile
+import tornado.httpserver
+import tornado.options
+import tornado.testing
+import embedded
+import listing_service
+import publicapi_service
+import user_service
+from upstream import make_http_client
+from support import seed_listings, seed_users, service_options
+
+
+class EmbeddedTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp(prefix="embedded-")
+        self.listing_db_path = os.path.join(self.tmp_dir, "listings.db")
+        self.user_db_path = os.path.join(self.tmp_dir, "users.db")
+        listing_service.make_app(service_options(db_path=self.listing_db_path)).close()
+        user_service.make_app(service_options(db_path=self.user_db_path)).close()
+        seed_users(self.user_db_path, 10)
+        seed_listings(self.listing_db_path, 40, 10)
+
+        # publicapi_service, listing_service and user_service in this process, on their own ports
+        socks_and_ports = [tornado.testing.bind_unused_port() for _ in range(3)]
+        public_port, listing_port, user_port = [port for _, port in socks_and_ports]
+        self.apps = embedded.make_apps(service_options(
+            listing_db_path=self.listing_db_path, user_db_path=self.user_db_path,
+            listing_port=listing_port, user_port=user_port, upstream_curl=False, version_refresh_ms=0))
+        self.servers = []
+        for app, (sock, _) in zip(self.apps, socks_and_ports):
+            server = tornado.httpserver.HTTPServer(app)
+            server.add_sockets([sock])
+            self.servers.append(server)
+        self.client = make_http_client(use_curl=False)
+        self.public_url = "http://127.0.0.1:{}".format(public_port)
+        self.listing_url = "http://127.0.0.1:{}".format(listing_port)
+        self.user_url = "http://127.0.0.1:{}".format(user_port)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        for app in self.apps:
+            app.close()
+        self.client.close()
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    @tornado.testing.gen_test
+    def test_reads_run_in_process(self):
+        # The same pages as publicapi_service calling the services over HTTP
+        http_app = publicapi_service.make_app(service_options(
+            listing_service_urls=[self.listing_url], user_service_urls=[self.user_url], upstream_curl=False))
+        self.apps.append(http_app)
+        sock, port = tornado.testing.bind_unused_port()
+        server = tornado.httpserver.HTTPServer(http_app)
+        server.add_sockets([sock])
+        self.servers.append(server)
+        http_url = "http://127.0.0.1:{}".format(port)
+
+        path = "/public-api/listings?page_size=5&page_num=2&listing_type=rent"
+        embedded_response = yield self.client.fetch(self.public_url + path)
+        body = json.loads(embedded_response.body)
+        self.assertEqual(len(body["listings"]), 5)
+        self.assertTrue(all(listing["listing_type"] == "rent" and listing["user"]["name"].startswith("User ")
+                            for listing in body["listings"]))
+
+        # Only the HTTP app made listing_service and user_service serve GETs
+        metrics = yield self.client.fetch(self.listing_url + "/metrics")
+        self.assertNotIn(b'handler="ListingsHandler"', metrics.body)
+        http_response = yield self.client.fetch(http_url + path)
+        self.assertEqual(json.loads(http_response.body), body)
+        self.assertEqual(embedded_response.headers["Etag"], http_response.headers["Etag"])
+        metrics = yield self.client.fetch(self.listing_url + "/metrics")
+        self.assertIn(b'handler="ListingsHandler"', metrics.body)
+
+    @tornado.testing.gen_test
+    def test_writes_reach_the_local_services(self):
+        response = yield self.client.fetch(
+            self.public_url + "/public-api/users", method="POST", body=json.dumps({"name": "Grace"}))
+        user = json.loads(response.body)["user"]
+        response = yield self.client.fetch(self.public_url + "/public-api/listings", method="POST",
+                                           body=json.dumps({"user_id": user["id"], "listing_type": "sale", "price": 99}))
+        self.assertEqual(response.code, 200)
+
+        response = yield self.client.fetch(self.public_url + "/public-api/listings?user_id={}".format(user["id"]))
+        listings = json.loads(response.body)["listings"]
+        self.assertEqual([(listing["price"], listing["user"]["name"]) for listing in listings], [(99, "Grace")])
+
+    @tornado.testing.gen_test
+    def test_command_line_options_build_the_apps(self):
+        # The options as embedded.py defines and parses them, not the test defaults
+        parser = tornado.options.OptionParser()
+        embedded.define_options(parser)
+        parser.parse_command_line([
+            "embedded.py", "--listing_db_path=" + self.listing_db_path, "--user_db_path=" + self.user_db_path,
+            "--upstream_curl=false", "--user_replica=false", "--version_refresh_ms=0"])
+        public_app, listing_app, user_app = embedded.make_apps(parser)
+        self.apps.extend([public_app, listing_app, user_app])
+        self.assertIsNotNone(user_app.user_cache)
+        users, version = yield public_app.reads.users_by_ids([2, 1])
+        self.assertEqual(version, 10)
+        self.assertEqual([user["id"] for user in users], [2, 1])
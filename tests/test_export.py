@@ -0,0 +1,81 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import tornado.testing
+import listing_service
+import user_service
+from support import BASE_TIME, seed_listings, seed_users, service_options
+
+
+class ExportTestCase(tornado.testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="export-")
+        super().setUp()
+
+    def tearDown(self):
+        self._app.close()
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def export(self, path, **args):
+        response = self.fetch(path + "?" + "&".join("{}={}".format(k, v) for k, v in args.items()))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Type"], "application/x-ndjson")
+        return [json.loads(line) for line in response.body.splitlines()]
+
+
+class ListingsExportTest(ExportTestCase):
+
+    def get_app(self):
+        db_path = os.path.join(self.tmp_dir, "listings.db")
+        options = service_options(db_path=db_path, db_shards=2, version_refresh_ms=0)
+        listing_service.make_app(options).close()
+        seed_listings(db_path, 20, 5, num_shards=2)
+        return listing_service.make_app(options)
+
+    def test_rows_have_the_listing_fields_in_id_order(self):
+        rows = self.export("/listings/export")
+        self.assertEqual(len(rows), 20)
+        self.assertEqual([row["id"] for row in rows], sorted(row["id"] for row in rows))
+        for row in rows:
+            self.assertEqual(tuple(row), listing_service.LISTING_FIELDS)
+
+    def test_filters(self):
+        rows = self.export("/listings/export", user_id=2, since=BASE_TIME + 5)
+        self.assertTrue(rows)
+        self.assertEqual(set(row["user_id"] for row in rows), {2})
+        self.assertTrue(all(row["updated_at"] > BASE_TIME + 5 for row in rows))
+
+    def test_since_beyond_sqlite_integers(self):
+        self.assertEqual(self.export("/listings/export", since=2 ** 64), [])
+        self.assertEqual(len(self.export("/listings/export", since=-2 ** 64)), 20)
+        response = self.fetch("/listings/export?user_id={}".format(2 ** 64))
+        self.assertEqual(response.code, 400)
+
+
+class UsersExportTest(ExportTestCase):
+
+    def get_app(self):
+        db_path = os.path.join(self.tmp_dir, "users.db")
+        options = service_options(db_path=db_path, version_refresh_ms=0)
+        user_service.make_app(options).close()
+        seed_users(db_path, 12)
+        return user_service.make_app(options)
+
+    def test_rows_have_the_user_fields_in_id_order(self):
+        rows = self.export("/users/export")
+        self.assertEqual([row["id"] for row in rows], list(range(1, 13)))
+        for row in rows:
+            self.assertEqual(tuple(row), user_service.USER_FIELDS)
+        self.assertEqual([row["id"] for row in self.export("/users/export", since=BASE_TIME + 9)], [10, 11, 12])
+
+    def test_since_beyond_sqlite_integers(self):
+        self.assertEqual(self.export("/users/export", since=2 ** 64), [])
+        self.assertEqual(len(self.export("/users/export", since=-2 ** 64)), 12)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import tornado.testing
+import listing_service
+from support import seed_listings, service_options
+
+
+class ListingFiltersTest(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="filters-")
+        db_path = os.path.join(self.tmp_dir, "listings.db")
+        listing_service.make_app(service_options(db_path=db_path, version_refresh_ms=0)).close()
+        seed_listings(db_path, 60, 5)
+        conn = sqlite3.connect(db_path)
+        try:
+            self.rows = conn.execute("SELECT id, user_id, listing_type, price FROM listings ORDER BY id DESC").fetchall()
+        finally:
+            conn.close()
+        return listing_service.make_app(service_options(db_path=db_path, version_refresh_ms=0))
+
+    def tearDown(self):
+        self._app.close()
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def get_ids(self, query):
+        response = self.fetch("/listings?page_size=100&" + query)
+        self.assertEqual(response.code, 200)
+        return [listing["id"] for listing in json.loads(response.body)["listings"]]
+
+    def expected_ids(self, user_id=None, listing_type=None, min_price=None, max_price=None):
+        # Seeded listings are created in id order, so newest first is highest id first
+        return [
+            id for id, row_user_id, row_listing_type, price in self.rows
+            if (user_id is None or row_user_id == user_id)
+            and (listing_type is None or row_listing_type == listing_type)
+            and (min_price is None or price >= min_price)
+            and (max_price is None or price <= max_price)
+        ]
+
+    def test_filters_match_the_listings(self):
+        cases = [
+            {"user_id": 2},
+            {"listing_type": "sale"},
+            {"min_price": 30000},
+            {"max_price": 30000},
+            {"min_price": 20000, "max_price": 60000, "listing_type": "rent"},
+            {"user_id": 3, "min_price": 50000},
+        ]
+        for filters in cases:
+            query = "&".join("{}={}".format(name, value) for name, value in filters.items())
+            self.assertEqual(self.get_ids(query), self.expected_ids(**filters), filters)
+
+    def test_price_bounds_beyond_sqlite_integers(self):
+        huge = 10 ** 20
+        self.assertEqual(self.get_ids("min_price=-{}".format(huge)), self.expected_ids())
+        self.assertEqual(self.get_ids("max_price={}".format(huge)), self.expected_ids())
+        self.assertEqual(self.get_ids("min_price={}".format(huge)), [])
+        self.assertEqual(self.get_ids("max_price=-{}&listing_type=rent".format(huge)), [])
+        self.assertEqual(self.get_ids("min_price=40000&max_price={}".format(huge)), self.expected_ids(min_price=40000))
+        self.assertEqual(self.fetch("/listings?user_id={}".format(huge)).code, 400)
@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import tornado.escape
+import tornado.testing
+import listing_service
+import serialization
+import user_service
+from support import seed_listings, seed_users, service_options
+
+
+class ColumnarFormatTest(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="formats-")
+        db_path = os.path.join(self.tmp_dir, "listings.db")
+        listing_service.make_app(service_options(db_path=db_path, version_refresh_ms=0)).close()
+        seed_listings(db_path, 50, 5)
+        return listing_service.make_app(service_options(db_path=db_path, version_refresh_ms=0))
+
+    def tearDown(self):
+        self._app.close()
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def get_json(self, path):
+        response = self.fetch(path)
+        self.assertEqual(response.code, 200)
+        return json.loads(response.body)
+
+    def test_columnar_page_holds_the_same_listings(self):
+        for query in ("page_size=7&page_num=2", "page_size=7&cursor=", "user_id=3&listing_type=rent"):
+            rows = self.get_json("/listings?" + query)
+            columnar = self.get_json("/listings?format=columnar&" + query)
+            self.assertEqual(list(columnar["listings"]), list(listing_service.LISTING_FIELDS))
+            self.assertEqual(serialization.rows(columnar["listings"]), rows["listings"])
+            self.assertEqual(columnar.get("next_cursor"), rows.get("next_cursor"))
+
+    def test_empty_columnar_page(self):
+        body = self.get_json("/listings?format=columnar&user_id=0")
+        self.assertEqual(body["listings"], {field: [] for field in listing_service.LISTING_FIELDS})
+
+    def test_unknown_format_is_rejected(self):
+        self.assertEqual(self.fetch("/listings?format=csv").code, 400)
+
+    @unittest.skipUnless(serialization.binary_available(), "msgpack is not installed")
+    def test_msgpack_is_negotiated_with_accept(self):
+        headers = {"Accept": "application/msgpack"}
+        response = self.fetch("/listings?format=columnar", headers=headers)
+        self.assertEqual(response.headers["Content-Type"], "application/msgpack")
+        self.assertEqual(response.headers["Vary"], "Accept")
+        body = serialization.loads_response(response.body, response.headers["Content-Type"])
+        self.assertEqual(body, self.get_json("/listings?format=columnar"))
+        # Each representation has its own ETag
+        self.assertNotEqual(response.headers["Etag"], self.fetch("/listings?format=columnar").headers["Etag"])
+
+
+    def test_compact_unless_pretty_is_requested(self):
+        compact = self.fetch("/listings?page_size=3").body
+        pretty = self.fetch("/listings?page_size=3&pretty=1").body
+        self.assertNotIn(b"\n", compact)
+        self.assertNotIn(b": ", compact)
+        self.assertRegex(pretty, rb'\n +"listings"')
+        self.assertEqual(json.loads(pretty), json.loads(compact))
+
+
+# Every JSON backend installed here, each encoding compact and pretty output
+class JsonBackendsTest(unittest.TestCase):
+
+    OBJ = {"result": True, "listings": [{"id": 1, "listing_type": "rent", "price": 10, "name": "Zoë"}], "next": None}
+
+    def setUp(self):
+        self.previous = serialization.backend()
+
+    def tearDown(self):
+        serialization.use_backend(self.previous)
+
+    def test_compact_and_pretty_output(self):
+        tested = []
+        for name in serialization.BACKENDS:
+            try:
+                serialization.use_backend(name)
+            except ImportError:
+                continue
+            tested.append(name)
+            with self.subTest(backend=name):
+                compact = tornado.escape.utf8(serialization.dumps(self.OBJ))
+                pretty = tornado.escape.utf8(serialization.dumps(self.OBJ, pretty=True))
+                self.assertNotIn(b"\n", compact)
+                self.assertNotIn(b": ", compact)
+                self.assertNotIn(b", ", compact)
+                self.assertIn(b"\n ", pretty)
+                self.assertLess(len(compact), len(pretty))
+                for body in (compact, pretty):
+                    self.assertEqual(serialization.loads(body), self.OBJ)
+                    self.assertEqual(json.loads(body), self.OBJ)
+        self.assertIn("json", tested)
+
+    def test_auto_picks_an_installed_backend(self):
+        self.assertIn(serialization.use_backend("auto"), serialization.BACKENDS)
+        # A backend asked for by name must be installed
+        with self.assertRaises(ImportError):
+            serialization.use_backend("yaml")
+
+
+class UsersColumnarFormatTest(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="formats-")
+        db_path = os.path.join(self.tmp_dir, "users.db")
+        user_service.make_app(service_options(db_path=db_path, version_refresh_ms=0)).close()
+        seed_users(db_path, 20)
+        return user_service.make_app(service_options(db_path=db_path, version_refresh_ms=0))
+
+    def tearDown(self):
+        self._app.close()
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_columnar_pages_and_lookups(self):
+        for query in ("page_size=5", "cursor=&page_size=5", "ids=4,2,99,4"):
+            rows = json.loads(self.fetch("/users?" + query).body)
+            columnar = json.loads(self.fetch("/users?format=columnar&" + query).body)
+            self.assertEqual(serialization.rows(columnar["users"]), rows["users"])
+        self.assertEqual(columnar["users"]["id"], [4, 2])
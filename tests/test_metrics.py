@@ -0,0 +1,86 @@
+import json
+import unittest
+import tornado.testing
+from metrics import Registry
+from support import ServicesTestCase, metric_value
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_counter_exposition(self):
+        registry = Registry()
+        counter = registry.counter("jobs_total", "Jobs run", labels=("queue", "state"))
+        counter.inc("default", "done")
+        counter.inc("default", "done", amount=2)
+        counter.inc('say "hi"\\\n', "failed")
+        self.assertEqual(registry.render().splitlines(), [
+            "# HELP jobs_total Jobs run",
+            "# TYPE jobs_total counter",
+            'jobs_total{queue="default",state="done"} 3',
+            'jobs_total{queue="say \\"hi\\"\\\\\\n",state="failed"} 1',
+        ])
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = Registry()
+        histogram = registry.histogram("latency_seconds", "Latency", labels=("op",), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, "read")
+        self.assertEqual(registry.render().splitlines(), [
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            # Bounds are inclusive, the value at 0.1 falls in its bucket
+            'latency_seconds_bucket{op="read",le="0.1"} 2',
+            'latency_seconds_bucket{op="read",le="1.0"} 3',
+            'latency_seconds_bucket{op="read",le="+Inf"} 4',
+            'latency_seconds_sum{op="read"} 2.65',
+            'latency_seconds_count{op="read"} 4',
+        ])
+
+    def test_collectors_are_read_at_scrape_time(self):
+        registry = Registry()
+        state = {"size": 1}
+        registry.collector("cache_entries", "Entries cached", "gauge", lambda: state["size"])
+        registry.collector("replica_ready", "Whether warm", "gauge", lambda: {("users",): True}, labels=("name",))
+        state["size"] = 5
+        self.assertEqual(registry.render(), "\n".join([
+            "# HELP cache_entries Entries cached",
+            "# TYPE cache_entries gauge",
+            "cache_entries 5",
+            "# HELP replica_ready Whether warm",
+            "# TYPE replica_ready gauge",
+            'replica_ready{name="users"} 1',
+        ]) + "\n")
+
+
+class MetricsEndpointTest(ServicesTestCase):
+
+    @tornado.testing.gen_test
+    def test_requests_are_counted_per_handler_and_code(self):
+        self.start_services()
+        for url in (self.listing_url, self.user_url, self.public_url):
+            response = yield self.client.fetch(url + "/metrics")
+            self.assertEqual(response.headers["Content-Type"], "text/plain; version=0.0.4")
+
+        for _ in range(3):
+            yield self.client.fetch(self.public_url + "/public-api/listings?page_size=5")
+        response = yield self.client.fetch(self.public_url + "/public-api/listings?page_size=abc", raise_error=False)
+        self.assertEqual(response.code, 400)
+
+        response = yield self.client.fetch(self.public_url + "/metrics")
+        text = response.body.decode()
+        lines = text.splitlines()
+        self.assertIn("# TYPE http_request_duration_seconds histogram", lines)
+        self.assertEqual(metric_value(text, "http_request_duration_seconds_count",
+                                      handler="PublicListings", code="200"), 3)
+        self.assertEqual(metric_value(text, "http_request_duration_seconds_count",
+                                      handler="PublicListings", code="400"), 1)
+        self.assertEqual(metric_value(text, "http_request_duration_seconds_bucket",
+                                      handler="PublicListings", code="200", le="+Inf"), 3)
+        # Upstream fetches made for those pages are tracked too
+        self.assertGreater(metric_value(text, "upstream_request_duration_seconds_count",
+                                        upstream="listing_service", path="/listings"), 0)
+        self.assertEqual(self.upstream_calls(self.listing_app, "ListingsHandler"), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import itertools
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import listing_service
+from support import service_options
+
+
+# Checks with EXPLAIN QUERY PLAN that every combination of GET /listings filters,
+# in both page_num and cursor mode, is served by an index search. Only unfiltered
+# page_num pages, which have no WHERE clause at all, walk the created_at index, and
+# stop after offset + page_size rows. Only price ranges on their own sort the
+# matching rows (read from a covering index), everything else comes in
+# (created_at, id) order.
+class ListingsQueryPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="plans-")
+        db_path = os.path.join(self.tmp_dir, "listings.db")
+        # Creating the schema and indexes through the service itself
+        listing_service.make_app(service_options(db_path=db_path, version_refresh_ms=0)).close()
+        self.conn = sqlite3.connect(db_path)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def plan(self, filters, after, offset):
+        select_stmt, args = listing_service.listings_query(filters, after)
+        args.append(10)
+        if offset:
+            select_stmt += " OFFSET ?"
+            args.append(20)
+        return [row[3] for row in self.conn.execute("EXPLAIN QUERY PLAN " + select_stmt, args)]
+
+    def test_every_filter_combination_uses_an_index(self):
+        values = {"user_id": 1, "listing_type": "rent", "min_price": 1000, "max_price": 5000}
+        for mask in itertools.product((False, True), repeat=len(values)):
+            filters = {name: value for (name, value), on in zip(sorted(values.items()), mask) if on}
+            for after, offset in ((None, False), (None, True), ((1500000000000000, 42), False)):
+                plan = self.plan(filters, after, offset)
+                description = "filters={} after={} offset={}: {}".format(filters, after, offset, plan)
+                self.assertTrue(plan, description)
+                price_only = set(filters) <= {"min_price", "max_price"} and filters
+                for step in plan:
+                    if not price_only:
+                        self.assertNotIn("TEMP B-TREE", step, description)
+                    if "listings" not in step:
+                        continue
+                    if filters or after is not None:
+                        self.assertTrue(step.startswith("SEARCH"), description)
+                    else:
+                        self.assertIn("USING INDEX idx_listings_created_at_filters", step, description)
+
+    def test_user_id_filter_uses_user_id_index(self):
+        for filters in ({"user_id": 1}, {"user_id": 1, "listing_type": "sale"}):
+            plan = self.plan(filters, None, False)
+            self.assertIn("idx_listings_user_id_created_at_filters", plan[0], plan)
+
+    def test_listing_type_filter_uses_listing_type_index(self):
+        plan = self.plan({"listing_type": "sale", "min_price": 10}, None, False)
+        self.assertIn("idx_listings_listing_type_created_at", plan[0], plan)
+
+    def test_price_range_uses_covering_price_index(self):
+        for filters in ({"min_price": 10}, {"max_price": 10}, {"min_price": 10, "max_price": 20}):
+            plan = self.plan(filters, None, False)
+            self.assertIn("COVERING INDEX idx_listings_price_covering", plan[0], plan)
+
+    def test_change_feed_searches_by_id_and_updated_at(self):
+        plan = [row[3] for row in self.conn.execute("EXPLAIN QUERY PLAN " + listing_service.CHANGES_STMT, (0, 10))]
+        self.assertEqual(plan, ["SEARCH listings USING INTEGER PRIMARY KEY (rowid>?)"])
+        plan = [row[3] for row in self.conn.execute("EXPLAIN QUERY PLAN " + listing_service.CHANGES_START_STMT, (0,))]
+        self.assertIn("SEARCH listings USING COVERING INDEX idx_listings_updated_at (updated_at>?)", plan)
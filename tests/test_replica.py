@@ -0,0 +1,80 @@
+import json
+import unittest
+import urllib.parse
+import tornado.gen
+import tornado.testing
+from support import ServicesTestCase
+
+
+class UserReplicaTest(ServicesTestCase):
+
+    @tornado.gen.coroutine
+    def wait_for(self, condition, timeout=3.0):
+        deadline = self.io_loop.time() + timeout
+        while not condition():
+            if self.io_loop.time() > deadline:
+                self.fail("Timed out waiting for the users replica")
+            yield tornado.gen.sleep(0.01)
+
+    @tornado.gen.coroutine
+    def start_replica(self, num_users=10):
+        self.start_services(num_users=num_users, user_replica=True)
+        self.replica = self.public_app.user_replica
+        yield self.wait_for(lambda: self.replica.ready)
+
+    @tornado.gen.coroutine
+    def get_page(self, query):
+        response = yield self.client.fetch(self.public_url + "/public-api/listings?" + query)
+        return json.loads(response.body)
+
+    @tornado.testing.gen_test
+    def test_initial_sync_pulls_every_user(self):
+        # Several feed pages are needed to warm the replica
+        self.start_services(num_users=25, user_replica=True)
+        self.replica = self.public_app.user_replica
+        self.replica.page_size = 10
+        yield self.wait_for(lambda: self.replica.ready)
+        self.assertEqual(len(self.replica), 25)
+        self.assertEqual(self.replica.max_id, 25)
+        self.assertEqual(self.replica.version(), 25)
+        self.assertEqual(self.replica.get(7).name, "User h")
+
+        # Pages are then enriched from the replica alone
+        body = yield self.get_page("page_size=20")
+        self.assertTrue(body["listings"])
+        for listing in body["listings"]:
+            self.assertEqual(listing["user"]["name"], self.replica.get(listing["user"]["id"]).name)
+        self.assertEqual(self.upstream_calls(self.user_app, "UsersHandler"), 0)
+
+    @tornado.testing.gen_test
+    def test_long_poll_catches_up_with_writes(self):
+        yield self.start_replica()
+        syncs = self.replica.syncs
+        response = yield self.client.fetch(self.user_url + "/users", method="POST",
+                                           body=urllib.parse.urlencode({"name": "newcomer"}))
+        user = json.loads(response.body)["user"]
+
+        # The pending long-poll is woken by the commit, not by its timeout
+        yield self.wait_for(lambda: self.replica.get(user["id"]) is not None, timeout=self.replica.wait / 2)
+        self.assertEqual(self.replica.get(user["id"]).name, "newcomer")
+        self.assertEqual(self.replica.max_id, user["id"])
+        self.assertEqual(self.replica.syncs, syncs + 1)
+
+    @tornado.testing.gen_test
+    def test_missing_users_are_fetched_by_ids(self):
+        yield self.start_replica()
+        # A user the replica has not caught up with yet
+        del self.replica._users[3]
+        body = yield self.get_page("user_id=3&page_size=5")
+        self.assertTrue(body["listings"])
+        self.assertEqual(set(listing["user"]["name"] for listing in body["listings"]), {"User d"})
+        self.assertEqual(self.upstream_calls(self.user_app, "UsersHandler"), 1)
+        self.assertEqual(self.replica.get(3).name, "User d")
+
+        # It is then served from the replica
+        yield self.get_page("user_id=3&page_size=5")
+        self.assertEqual(self.upstream_calls(self.user_app, "UsersHandler"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
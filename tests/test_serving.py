@@ -0,0 +1,42 @@
+import tornado.concurrent
+import tornado.gen
+import tornado.httpserver
+import tornado.testing
+import tornado.web
+import serving
+from upstream import make_http_client
+
+
+class SlowHandler(tornado.web.RequestHandler):
+
+    @tornado.gen.coroutine
+    def get(self):
+        self.application.started.set_result(None)
+        yield self.application.release
+        self.write("done")
+
+
+class RequestTrackerTest(tornado.testing.AsyncTestCase):
+
+    @tornado.testing.gen_test
+    def test_counts_requests_until_their_response_is_finished(self):
+        app = tornado.web.Application([(r"/slow", SlowHandler)])
+        app.started = tornado.concurrent.Future()
+        app.release = tornado.concurrent.Future()
+        tracker = serving.RequestTracker(app)
+        sock, port = tornado.testing.bind_unused_port()
+        server = tornado.httpserver.HTTPServer(tracker)
+        server.add_sockets([sock])
+        client = make_http_client(use_curl=False)
+        try:
+            self.assertEqual(tracker.in_flight, 0)
+            response = client.fetch("http://127.0.0.1:{}/slow".format(port))
+            yield app.started
+            self.assertEqual(tracker.in_flight, 1)
+            app.release.set_result(None)
+            response = yield response
+            self.assertEqual(response.body, b"done")
+            self.assertEqual(tracker.in_flight, 0)
+        finally:
+            server.stop()
+            client.close()
@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import tornado.gen
+import tornado.httpserver
+import tornado.testing
+import listing_service
+from sharding import shard_paths
+from upstream import make_http_client
+from support import seed_listings, service_options
+
+NUM_SHARDS = 3
+
+
+# The same listings, in one db file and sharded over NUM_SHARDS files
+# Ids differ between the two layouts, listings are compared by their other fields
+class ShardedListingsTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp(prefix="sharding-")
+        self.db_path = os.path.join(self.tmp_dir, "sharded", "listings.db")
+        os.makedirs(os.path.dirname(self.db_path))
+        baseline_path = os.path.join(self.tmp_dir, "listings.db")
+        self.apps = []
+        self.servers = []
+        self.urls = []
+        for db_path, num_shards in ((baseline_path, 1), (self.db_path, NUM_SHARDS)):
+            options = service_options(db_path=db_path, db_shards=num_shards, version_refresh_ms=0)
+            listing_service.make_app(options).close()
+            seed_listings(db_path, 90, 7, num_shards=num_shards)
+            app = listing_service.make_app(options)
+            sock, port = tornado.testing.bind_unused_port()
+            server = tornado.httpserver.HTTPServer(app)
+            server.add_sockets([sock])
+            self.apps.append(app)
+            self.servers.append(server)
+            self.urls.append("http://127.0.0.1:{}".format(port))
+        self.client = make_http_client(use_curl=False)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        for app in self.apps:
+            app.close()
+        self.client.close()
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    @tornado.gen.coroutine
+    def get_both(self, path):
+        # Pages of the baseline and of the sharded service, without ids
+        pages = []
+        for url in self.urls:
+            response = yield self.client.fetch(url + path)
+            body = json.loads(response.body)
+            listings = [(listing["created_at"], listing["user_id"], listing["listing_type"], listing["price"])
+                        for listing in body["listings"]]
+            pages.append((listings, body.get("next_cursor")))
+        return pages
+
+    @tornado.testing.gen_test
+    def test_pages_match_a_single_file(self):
+        for filters in ("", "&listing_type=rent", "&min_price=20000&max_price=70000", "&user_id=4"):
+            for page_size in (1, 7, 100):
+                for page_num in range(1, 90 // page_size + 2):
+                    path = "/listings?page_size={}&page_num={}{}".format(page_size, page_num, filters)
+                    (baseline, _), (sharded, _) = yield self.get_both(path)
+                    self.assertEqual(sharded, baseline, path)
+
+    @tornado.testing.gen_test
+    def test_cursor_pages_match_a_single_file(self):
+        for filters in ("", "&listing_type=sale", "&max_price=50000"):
+            walked = []
+            cursors = ["", ""]
+            while True:
+                pages = []
+                for url, cursor in zip(self.urls, cursors):
+                    response = yield self.client.fetch(url + "/listings?page_size=8&cursor={}{}".format(cursor, filters))
+                    body = json.loads(response.body)
+                    pages.append(([listing["created_at"] for listing in body["listings"]], body["next_cursor"]))
+                (baseline, baseline_cursor), (sharded, sharded_cursor) = pages
+                self.assertEqual(sharded, baseline, filters)
+                walked.extend(sharded)
+                if baseline_cursor is None:
+                    self.assertIsNone(sharded_cursor)
+                    break
+                cursors = [baseline_cursor, sharded_cursor]
+            self.assertEqual(walked, sorted(walked, reverse=True))
+            self.assertEqual(len(walked), len(set(walked)))
+
+    def shard_of(self, id):
+        for index, path in enumerate(shard_paths(self.db_path, NUM_SHARDS)):
+            conn = sqlite3.connect(path)
+            try:
+                if conn.execute("SELECT 1 FROM listings WHERE id=?", (id,)).fetchone():
+                    return index
+            finally:
+                conn.close()
+        return None
+
+    @tornado.testing.gen_test
+    def test_writes_go_to_the_shard_of_their_user(self):
+        url = self.urls[1]
+        listings = []
+        for user_id in (1, 2, 3):
+            response = yield self.client.fetch(
+                url + "/listings", method="POST", body="user_id={}&listing_type=rent&price=10".format(user_id))
+            listings.append(json.loads(response.body)["listing"])
+        response = yield self.client.fetch(url + "/listings/batch", method="POST", body=json.dumps(
+            [{"user_id": user_id, "listing_type": "sale", "price": 20} for user_id in (4, 5, 6, 7, 8)]))
+        listings.extend(json.loads(response.body)["listings"])
+
+        for listing in listings:
+            index = listing["user_id"] % NUM_SHARDS
+            self.assertEqual(self.shard_of(listing["id"]), index, listing)
+            # Ids tell their shard
+            self.assertEqual(listing["id"] % NUM_SHARDS, index, listing)
+        self.assertEqual(len(set(listing["id"] for listing in listings)), len(listings))
+
+    def test_shard_count_cannot_change(self):
+        with self.assertRaises(ValueError):
+            listing_service.make_app(service_options(db_path=self.db_path, db_shards=2, version_refresh_ms=0))
@@ -0,0 +1,50 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest.mock
+import tornado.gen
+import tornado.testing
+import listing_service
+from db import Database
+from support import seed_listings, service_options
+
+
+class StatsLoadFailureTest(tornado.testing.AsyncHTTPTestCase):
+
+    def setUp(self):
+        # The initial stats load fails until the patch is stopped
+        self.stream_patch = unittest.mock.patch.object(
+            Database, "stream", side_effect=sqlite3.OperationalError("disk I/O error"))
+        self.stream_patch.start()
+        self.addCleanup(self.stream_patch.stop)
+        self.retry_patch = unittest.mock.patch("listing_service.STATS_RETRY_DELAY", 0.05)
+        self.retry_patch.start()
+        self.addCleanup(self.retry_patch.stop)
+        super().setUp()
+
+    def get_app(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="stats-")
+        db_path = os.path.join(self.tmp_dir, "listings.db")
+        options = service_options(db_path=db_path, version_refresh_ms=0)
+        listing_service.make_app(options).close()
+        seed_listings(db_path, 10, 5)
+        return listing_service.make_app(options)
+
+    def tearDown(self):
+        self._app.close()
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_unavailable_until_loaded(self):
+        response = self.fetch("/listings/stats")
+        self.assertEqual(response.code, 503)
+        self.assertIn("Retry-After", response.headers)
+
+        # Without periodic refreshes, the load is retried on its own
+        self.stream_patch.stop()
+        self.io_loop.run_sync(lambda: tornado.gen.sleep(0.2))
+        response = self.fetch("/listings/stats")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)["stats"]["count"], 10)
@@ -0,0 +1,260 @@
+import importlib.util
+import json
+import time
+import unittest
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.testing
+import tornado.web
+import publicapi_service
+from breaker import CircuitBreaker, CircuitOpen
+from upstream import Upstream, make_http_client
+from support import service_options
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_on_error_rate_and_recovers_after_a_trial(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(error_rate=0.5, min_requests=4, window=10, open_for=5, clock=clock)
+        for failed in (False, True, False):
+            token = breaker.allow()
+            self.assertIsNotNone(token)
+            breaker.record(token, failed)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record(breaker.allow(), True)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertIsNone(breaker.allow())
+        self.assertEqual(breaker.retry_after(), 5)
+
+        # A single trial once open_for is over, a failed one reopens the breaker
+        clock.now = 5
+        trial = breaker.allow()
+        self.assertIsNotNone(trial)
+        self.assertIsNone(breaker.allow())
+        breaker.record(trial, True)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        clock.now = 10
+        breaker.record(breaker.allow(), False)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.trips, 2)
+
+    def test_only_the_trial_decides_while_half_open(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(error_rate=0.5, min_requests=2, window=10, open_for=5, clock=clock)
+        early = breaker.allow()
+        breaker.record(breaker.allow(), True)
+        breaker.record(breaker.allow(), True)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        # The outcome of a call started before the breaker opened is not the trial's
+        clock.now = 5
+        trial = breaker.allow()
+        breaker.record(early, False)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertIsNone(breaker.allow())
+        breaker.record(trial, False)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        # Nor does it count once the breaker is closed again
+        breaker.record(early, True)
+        self.assertEqual(breaker.stats()["recent_calls"], 0)
+
+    def test_old_outcomes_leave_the_window(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(error_rate=0.5, min_requests=2, window=10, clock=clock)
+        breaker.record(breaker.allow(), True)
+        clock.now = 11
+        breaker.record(breaker.allow(), False)
+        breaker.record(breaker.allow(), False)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.stats()["recent_failures"], 0)
+
+
+# Stand-in for listing_service and user_service, answering pages in columnar form (at
+# data version 1) after `delay` seconds, or with a 500 while `failing` is set
+class MakeHttpClientTest(unittest.TestCase):
+
+    @unittest.skipIf(importlib.util.find_spec("pycurl") is not None, "pycurl is installed")
+    def test_falling_back_without_pycurl_is_logged(self):
+        with self.assertLogs(level="WARNING") as logs:
+            client = make_http_client()
+        try:
+            self.assertIsInstance(client, tornado.httpclient.AsyncHTTPClient)
+            self.assertNotEqual(type(client).__name__, "CurlAsyncHTTPClient")
+            self.assertIn("will not be pooled", logs.output[0])
+        finally:
+            client.close()
+
+
+class FakeService(tornado.web.RequestHandler):
+
+    @tornado.gen.coroutine
+    def get(self, path):
+        state = self.application.settings["state"]
+        state["calls"] += 1
+        state["paths"].append(path)
+        yield tornado.gen.sleep(state["delay"])
+        if state["failing"]:
+            self.set_status(500)
+            self.write({"result": False})
+            return
+        self.set_header("X-Data-Version", "1")
+        if path in ("listings/version", "users/version"):
+            self.write({"result": True, "version": 1})
+        elif path == "listings":
+            self.write({"result": True, "listings": {
+                "id": [1], "user_id": [1], "listing_type": ["rent"], "price": [10], "created_at": [1], "updated_at": [1]}})
+        else:
+            self.write({"result": True, "users": {"id": [1], "name": ["Ada"], "created_at": [1], "updated_at": [1]}})
+
+
+class UpstreamTestCase(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.servers = []
+        self.apps = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        for app in self.apps:
+            app.close()
+        super().tearDown()
+
+    def listen(self, app):
+        sock, port = tornado.testing.bind_unused_port()
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets([sock])
+        self.servers.append(server)
+        return port
+
+    def start_service(self, delay=0):
+        state = {"delay": delay, "failing": False, "calls": 0, "paths": []}
+        port = self.listen(tornado.web.Application([(r"/(.*)", FakeService)], state=state))
+        return "http://127.0.0.1:{}".format(port), state
+
+
+class HedgedFetchTest(UpstreamTestCase):
+
+    @tornado.testing.gen_test
+    def test_slow_replica_is_hedged(self):
+        slow_url, slow = self.start_service(delay=1)
+        fast_url, fast = self.start_service()
+        client = make_http_client(use_curl=False)
+        self.addCleanup(client.close)
+        upstream = Upstream("listing_service", [slow_url, fast_url], client, hedge=True)
+        # Recent GETs took about 10ms
+        upstream._latencies.extend([0.01] * Upstream.MIN_LATENCY_SAMPLES)
+        self.assertEqual(upstream.hedge_delay(), 0.01)
+
+        start = time.monotonic()
+        response = yield upstream.fetch("/listings/version")
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(json.loads(response.body)["version"], 1)
+        self.assertEqual((slow["calls"], fast["calls"]), (1, 1))
+        self.assertEqual((upstream.hedged, upstream.hedges_won), (1, 1))
+
+    @tornado.testing.gen_test
+    def test_hedge_goes_to_the_other_replica_despite_concurrent_requests(self):
+        slow_url, slow = self.start_service(delay=1)
+        fast_url, fast = self.start_service()
+        client = make_http_client(use_curl=False)
+        self.addCleanup(client.close)
+        upstream = Upstream("listing_service", [slow_url, fast_url], client, hedge=True)
+        upstream._latencies.extend([0.05] * Upstream.MIN_LATENCY_SAMPLES)
+
+        # The first request goes to the slow replica, the one started right after it takes
+        # the round-robin's next turn, back round to the slow replica for the next request
+        start = time.monotonic()
+        first = upstream.fetch("/listings/version")
+        second = upstream.fetch("/users/version")
+        responses = yield [first, second]
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual([json.loads(response.body)["version"] for response in responses], [1, 1])
+        self.assertEqual(slow["paths"], ["listings/version"])
+        self.assertIn("listings/version", fast["paths"])
+        self.assertEqual((upstream.hedged, upstream.hedges_won), (1, 1))
+
+    @tornado.testing.gen_test
+    def test_requests_fail_fast_once_the_breaker_is_open(self):
+        url, state = self.start_service()
+        state["failing"] = True
+        client = make_http_client(use_curl=False)
+        self.addCleanup(client.close)
+        upstream = Upstream("user_service", [url], client, breaker=CircuitBreaker(min_requests=2))
+        for _ in range(2):
+            response = yield upstream.fetch("/users", raise_error=False)
+            self.assertEqual(response.code, 500)
+        with self.assertRaises(CircuitOpen):
+            yield upstream.fetch("/users", raise_error=False)
+        self.assertEqual(state["calls"], 2)
+
+
+class PublicListingsDegradedTest(UpstreamTestCase):
+
+    @tornado.testing.gen_test
+    def test_stale_page_then_fast_503(self):
+        listing_url, listings = self.start_service()
+        user_url, _ = self.start_service()
+        app = publicapi_service.make_app(service_options(
+            listing_service_urls=[listing_url], user_service_urls=[user_url], upstream_curl=False,
+            cache_ttl=0.05, cache_stale_ttl=60, breaker_min_requests=2,
+        ))
+        self.apps.append(app)
+        port = self.listen(app)
+        client = make_http_client(use_curl=False)
+        self.addCleanup(client.close)
+        url = "http://127.0.0.1:{}/public-api/listings".format(port)
+
+        response = yield client.fetch(url)
+        fresh_body = response.body
+        yield tornado.gen.sleep(0.1)
+
+        # listing_service fails: the expired page is served while the breaker trips
+        listings["failing"] = True
+        response = yield client.fetch(url)
+        self.assertEqual(response.body, fresh_body)
+        self.assertEqual(app.listings_cache.stale_hits, 1)
+        self.assertEqual(app.listing_service.breaker.state, CircuitBreaker.OPEN)
+
+        # Pages never built before get a 503 without calling listing_service at all
+        calls = listings["calls"]
+        response = yield client.fetch(url + "?page_num=2", raise_error=False)
+        self.assertEqual(response.code, 503)
+        self.assertEqual(response.headers["Retry-After"], "5")
+        self.assertEqual(listings["calls"], calls)
+
+
+class PublicListingsVersionsTest(UpstreamTestCase):
+
+    @tornado.testing.gen_test
+    def test_versions_are_only_fetched_for_conditional_requests(self):
+        listing_url, listings = self.start_service()
+        user_url, users = self.start_service()
+        app = publicapi_service.make_app(service_options(
+            listing_service_urls=[listing_url], user_service_urls=[user_url], upstream_curl=False))
+        self.apps.append(app)
+        port = self.listen(app)
+        client = make_http_client(use_curl=False)
+        self.addCleanup(client.close)
+        url = "http://127.0.0.1:{}/public-api/listings".format(port)
+
+        # Pages are tagged from the versions the upstream responses come with
+        for _ in range(3):
+            response = yield client.fetch(url)
+        self.assertEqual((listings["paths"], users["paths"]), (["listings"] * 3, ["users"] * 3))
+
+        response = yield client.fetch(url, headers={"If-None-Match": response.headers["Etag"]}, raise_error=False)
+        self.assertEqual(response.code, 304)
+        self.assertEqual((listings["paths"][3:], users["paths"][3:]), (["listings/version"], ["users/version"]))
@@ -0,0 +1,86 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import tornado.testing
+import user_service
+from cache import ResponseCache
+from support import seed_users, service_options
+
+
+class UserLookupTest(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="lookups-")
+        db_path = os.path.join(self.tmp_dir, "users.db")
+        user_service.make_app(service_options(db_path=db_path, version_refresh_ms=0)).close()
+        seed_users(db_path, 20)
+        return user_service.make_app(service_options(db_path=db_path, version_refresh_ms=0))
+
+    def tearDown(self):
+        self._app.close()
+        super().tearDown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def get_json(self, path):
+        response = self.fetch(path)
+        self.assertEqual(response.code, 200)
+        return json.loads(response.body)
+
+    def test_point_lookups_are_cached(self):
+        cache = self._app.user_cache
+        first = self.get_json("/users/7")["user"]
+        self.assertEqual((first["id"], first["name"]), (7, "User h"))
+        self.assertEqual(self.get_json("/users/7")["user"], first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # Missing users are not cached
+        self.assertEqual(self.get_json("/users/99")["user"], [])
+        self.assertEqual(self.get_json("/users/99")["user"], [])
+        self.assertEqual(cache.stats()["entries"], 1)
+
+    def test_multi_get_keeps_request_order(self):
+        self.get_json("/users/5")
+        body = self.get_json("/users/9,5,99,9,3")
+        self.assertEqual([user["id"] for user in body["users"]], [9, 5, 3])
+        self.assertEqual(body["users"], self.get_json("/users?ids=9,5,99,9,3")["users"])
+        columnar = self.get_json("/users/9,5,3?format=columnar")["users"]
+        self.assertEqual(columnar["id"], [9, 5, 3])
+        self.assertEqual(self.fetch("/users/1,2?format=csv").code, 400)
+
+    def test_out_of_range_ids_are_not_found(self):
+        too_big = str(2 ** 64)
+        self.assertEqual(self.get_json("/users/" + too_big)["user"], [])
+        self.assertEqual([user["id"] for user in self.get_json("/users/{},2".format(too_big))["users"]], [2])
+        self.assertEqual(self.get_json("/users?ids=-{},3".format(too_big))["users"][0]["id"], 3)
+
+    def test_format_is_validated_for_single_ids(self):
+        self.assertEqual(self.fetch("/users/1?format=csv").code, 400)
+        self.assertEqual(self.get_json("/users/1?format=columnar")["user"]["id"], [1])
+
+    def test_writes_invalidate_cached_rows(self):
+        self.get_json("/users/1")
+        generation = self._app.user_cache.generation
+        response = self.fetch("/users/batch", method="POST", body=json.dumps([{"name": "Grace"}]))
+        user = json.loads(response.body)["users"][0]
+        self.assertEqual(self._app.user_cache.generation, generation + 1)
+        self.assertEqual(self.get_json("/users/{}".format(user["id"]))["user"], user)
+
+    def test_chunks_are_padded_to_a_few_statements(self):
+        ids = list(range(1, 22))
+        for count in (2, 3, 5, 17, 21):
+            results = self.io_loop.run_sync(lambda: user_service.query_users_by_ids(self._app.db, ids[:count]))
+            self.assertEqual([row["id"] for row in results], ids[:min(count, 20)])
+
+
+class ResponseCacheInvalidateTest(unittest.TestCase):
+
+    def test_invalidate_drops_keys_and_in_flight_values(self):
+        cache = ResponseCache(60)
+        cache.set(1, "a", 1)
+        cache.set(2, "b", 1)
+        generation = cache.generation
+        cache.invalidate([1])
+        self.assertEqual((cache.get(1), cache.get(2)), (None, "b"))
+        cache.set(1, "stale", 1, generation=generation)
+        self.assertIsNone(cache.get(1))
@@ -0,0 +1,187 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest.mock
+import tornado.httpserver
+import tornado.testing
+import tornado.web
+import publicapi_service
+from upstream import Upstream, make_http_client
+from writebehind import QueueFull, WriteQueue
+from support import service_options
+
+
+# Stand-in for the listing_service batch endpoint
+# Answers 500 to the first `failures` batches, rejects items priced below 1
+# the way the real endpoint does, and stores the others with increasing ids
+class FakeBatchService(tornado.web.RequestHandler):
+
+    def post(self):
+        state = self.application.settings["state"]
+        state["batches"].append(json.loads(self.request.body))
+        if state["failures"] > 0:
+            state["failures"] -= 1
+            self.set_status(500)
+            self.write({"result": False})
+            return
+        items = state["batches"][-1]
+        errors = [{"index": index, "errors": ["price must be greater than 0"]}
+                  for index, item in enumerate(items) if item["price"] < 1]
+        if errors:
+            self.set_status(400)
+            self.write({"result": False, "errors": errors})
+            return
+        listings = []
+        for item in items:
+            state["next_id"] += 1
+            listings.append(dict(item, id=state["next_id"]))
+        self.write({"result": True, "listings": listings})
+
+
+class WriteQueueTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.state = {"batches": [], "failures": 0, "next_id": 0}
+        app = tornado.web.Application([(r"/listings/batch", FakeBatchService)], state=self.state)
+        sock, port = tornado.testing.bind_unused_port()
+        self.server = tornado.httpserver.HTTPServer(app)
+        self.server.add_sockets([sock])
+        self.client = make_http_client(use_curl=False)
+        self.upstream = Upstream("listing_service", ["http://127.0.0.1:{}".format(port)], self.client)
+        self.tmp_dir = tempfile.mkdtemp(prefix="writes-")
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.stop()
+        self.server.stop()
+        self.client.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        super().tearDown()
+
+    def make_queue(self, start=True, **kwargs):
+        queue = WriteQueue("listings", self.upstream, "/listings/batch", "listings", "listing",
+                           retry_delay=0.01, **kwargs)
+        self.queues.append(queue)
+        if start:
+            queue.start()
+        return queue
+
+    @tornado.testing.gen_test
+    def test_writes_are_forwarded_in_one_batch(self):
+        queue = self.make_queue(batch_window=0.05)
+        tracking_ids = [queue.submit({"user_id": 1, "listing_type": "rent", "price": price}) for price in (10, 20, 30)]
+        self.assertEqual(queue.status(tracking_ids[0]), {"status": "queued"})
+        statuses = yield [queue.wait(tracking_id) for tracking_id in tracking_ids]
+        self.assertEqual([status["listing"]["id"] for status in statuses], [1, 2, 3])
+        self.assertEqual(len(self.state["batches"]), 1)
+        self.assertEqual(queue.stats()["depth"], 0)
+        self.assertEqual(queue.status(tracking_ids[2])["listing"]["price"], 30)
+
+    @tornado.testing.gen_test
+    def test_failed_batches_are_retried(self):
+        self.state["failures"] = 2
+        queue = self.make_queue()
+        status = yield queue.wait(queue.submit({"user_id": 1, "listing_type": "rent", "price": 10}))
+        self.assertEqual(status["status"], "forwarded")
+        self.assertEqual((queue.retries, queue.batches), (2, 3))
+
+    @tornado.testing.gen_test
+    def test_writes_fail_once_retries_run_out(self):
+        self.state["failures"] = 10
+        queue = self.make_queue(max_retries=1)
+        status = yield queue.wait(queue.submit({"user_id": 1, "listing_type": "rent", "price": 10}))
+        self.assertEqual(status, {"status": "failed", "errors": "service error"})
+        self.assertEqual(queue.failed, 1)
+
+    @tornado.testing.gen_test
+    def test_rejected_items_fail_alone(self):
+        queue = self.make_queue(batch_window=0.05)
+        bad = queue.submit({"user_id": 1, "listing_type": "rent", "price": 0})
+        good = queue.submit({"user_id": 1, "listing_type": "rent", "price": 10})
+        bad_status, good_status = yield [queue.wait(bad), queue.wait(good)]
+        self.assertEqual(bad_status, {"status": "failed", "errors": ["price must be greater than 0"]})
+        self.assertEqual(good_status["listing"]["id"], 1)
+
+    @tornado.testing.gen_test
+    def test_full_queue_refuses_writes(self):
+        queue = self.make_queue(start=False, max_size=1)
+        queue.submit({"user_id": 1, "listing_type": "rent", "price": 10})
+        with self.assertRaises(QueueFull):
+            queue.submit({"user_id": 1, "listing_type": "rent", "price": 10})
+
+    @tornado.testing.gen_test
+    def test_spooled_writes_survive_a_restart(self):
+        spool_path = os.path.join(self.tmp_dir, "listings.spool")
+        stopped = self.make_queue(start=False, spool_path=spool_path)
+        tracking_ids = [stopped.submit({"user_id": 1, "listing_type": "sale", "price": price}) for price in (10, 20)]
+        stopped.stop()
+
+        queue = self.make_queue(spool_path=spool_path)
+        self.assertEqual(queue.depth(), 2)
+        statuses = yield [queue.wait(tracking_id) for tracking_id in tracking_ids]
+        self.assertEqual([status["listing"]["price"] for status in statuses], [10, 20])
+        self.assertEqual(os.path.getsize(spool_path), 0)
+
+    @tornado.testing.gen_test
+    def test_spool_is_compacted_while_writes_are_pending(self):
+        spool_path = os.path.join(self.tmp_dir, "listings.spool")
+        queue = self.make_queue(start=False, spool_path=spool_path)
+        queue.SPOOL_COMPACT_MIN = 5
+        tracking_ids = [queue.submit({"user_id": 1, "listing_type": "sale", "price": price}) for price in range(1, 21)]
+        yield queue._forward([queue._queue.popleft() for _ in range(15)])
+
+        # Only the 5 writes still pending are left in the file, and come back after a restart
+        with open(spool_path, "rb") as f:
+            self.assertEqual(len(f.readlines()), 5)
+        queue.stop()
+        restarted = self.make_queue(start=False, spool_path=spool_path)
+        self.assertEqual([write.tracking_id for write in restarted._queue], tracking_ids[15:])
+
+    def test_forked_processes_spool_to_their_own_files(self):
+        self.assertEqual(publicapi_service.write_spool_path("spool", "users"), os.path.join("spool", "users.spool"))
+        with unittest.mock.patch("serving.current_task_id", return_value=3):
+            self.assertEqual(publicapi_service.write_spool_path("spool", "users"), os.path.join("spool", "users.3.spool"))
+
+
+class PublicWritesTest(tornado.testing.AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.state = {"batches": [], "failures": 0, "next_id": 0}
+        fake = tornado.web.Application([(r"/listings/batch", FakeBatchService)], state=self.state)
+        sock, port = tornado.testing.bind_unused_port()
+        self.fake_server = tornado.httpserver.HTTPServer(fake)
+        self.fake_server.add_sockets([sock])
+        return publicapi_service.make_app(service_options(
+            listing_service_urls=["http://127.0.0.1:{}".format(port)], upstream_curl=False))
+
+    def tearDown(self):
+        self._app.close()
+        self.fake_server.stop()
+        super().tearDown()
+
+    def post_listing(self, headers=None):
+        body = json.dumps({"user_id": 1, "listing_type": "rent", "price": 2500})
+        return self.fetch("/public-api/listings", method="POST", body=body, headers=headers)
+
+    def test_synchronous_write_returns_the_stored_listing(self):
+        response = self.post_listing()
+        self.assertEqual(response.code, 200)
+        body = json.loads(response.body)
+        self.assertEqual(body["listing"], {"id": 1, "user_id": 1, "listing_type": "rent", "price": 2500})
+        self.assertEqual(body["status"], "forwarded")
+
+    def test_asynchronous_write_is_tracked(self):
+        response = self.post_listing(headers={"Prefer": "respond-async"})
+        self.assertEqual(response.code, 202)
+        tracking_id = json.loads(response.body)["tracking_id"]
+        self.assertEqual(response.headers["Location"], "/public-api/writes/listings/{}".format(tracking_id))
+
+        self.io_loop.run_sync(lambda: self._app.write_queues["listings"].wait(tracking_id))
+        body = json.loads(self.fetch(response.headers["Location"]).body)
+        self.assertEqual((body["status"], body["listing"]["id"]), ("forwarded", 1))
+        stats = json.loads(self.fetch("/public-api/writes").body)["queues"]["listings"]
+        self.assertEqual((stats["accepted"], stats["forwarded"], stats["depth"]), (1, 1, 0))
+        self.assertEqual(self.fetch("/public-api/writes/listings/abc").code, 404)
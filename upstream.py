@@ -0,0 +1,197 @@
+import collections
+import itertools
+import logging
+import time
+import urllib.parse
+import tornado.ioloop
+from tornado.concurrent import Future, chain_future
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from breaker import CircuitOpen
+
+
+# Creates the HTTP client shared by all upstream calls of an application
+# The curl based client keeps connections alive and reuses them across requests,
+# so it is preferred whenever pycurl is installed. The simple client opens a new
+# connection per request, so falling back to it is logged as a warning. In both
+# cases max_clients caps the concurrent requests, anything above it queues inside the client.
+# The client is a dedicated instance rather than the per-IOLoop AsyncHTTPClient()
+# singleton, so its limits are never shared with (or exhausted by) other callers.
+def make_http_client(max_clients=100, use_curl=True):
+    if use_curl:
+        try:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+            return CurlAsyncHTTPClient(force_instance=True, max_clients=max_clients)
+        except ImportError:
+            logging.warning(
+                "pycurl is not installed, falling back to the simple HTTP client: "
+                "upstream connections will not be pooled, every request opens a new one"
+            )
+    return SimpleAsyncHTTPClient(force_instance=True, max_clients=max_clients)
+
+
+# A downstream service reachable through one or more replicas
+# Requests are spread across the replica base URLs in round-robin order.
+# When given a SingleFlight, concurrent identical plain GETs (no extra fetch
+# arguments but headers) share one upstream request and receive the same response object.
+# When given an UpstreamMetrics, every upstream request is timed.
+# connect_timeout and request_timeout (seconds) apply to every request that does not
+# set its own. When given a CircuitBreaker, requests fail with CircuitOpen while it is
+# open. With hedge on and several replicas, a plain GET still unanswered after the
+# recent p95 latency of plain GETs (at least hedge_min_delay) is sent to the replica
+# after the one it went to as well, and the first successful response wins.
+class Upstream(object):
+    # Latency samples kept for the hedging delay, and how many are needed before hedging
+    LATENCY_SAMPLES = 512
+    MIN_LATENCY_SAMPLES = 20
+
+    def __init__(self, name, urls, http_client, flights=None, metrics=None,
+                 connect_timeout=None, request_timeout=None, breaker=None, hedge=False, hedge_min_delay=0.005):
+        if not urls:
+            raise ValueError("at least one URL is required for upstream {}".format(name))
+        self.name = name
+        self.urls = [url.rstrip("/") for url in urls]
+        self.http_client = http_client
+        self.flights = flights
+        self.metrics = metrics
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.breaker = breaker
+        self.hedge = hedge and len(self.urls) > 1
+        self.hedge_min_delay = hedge_min_delay
+        self.hedged = 0
+        self.hedges_won = 0
+        self._replicas = itertools.cycle(range(len(self.urls)))
+        self._latencies = collections.deque(maxlen=self.LATENCY_SAMPLES)
+        self._new_samples = 0
+        self._p95 = None
+
+    def next_replica(self):
+        # Index of the replica the next request goes to
+        return next(self._replicas)
+
+    def url(self, replica, path, query=None):
+        url = self.urls[replica] + path
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        return url
+
+    def fetch(self, path, query=None, headers=None, **kwargs):
+        if self.flights is not None and not kwargs:
+            key = (self.name, path, urllib.parse.urlencode(query or {}), tuple(sorted((headers or {}).items())))
+            return self.flights.do(key, self._fetch, path, query, headers)
+        return self._fetch(path, query, headers, **kwargs)
+
+    def _fetch(self, path, query=None, headers=None, **kwargs):
+        token = None
+        if self.breaker is not None:
+            token = self.breaker.allow()
+            if token is None:
+                future = Future()
+                future.set_exception(CircuitOpen(self.name, self.breaker.retry_after()))
+                return future
+
+        # Only plain GETs are timed for the hedging delay, and hedged
+        plain = not kwargs
+        if headers is not None:
+            kwargs["headers"] = headers
+        kwargs.setdefault("connect_timeout", self.connect_timeout)
+        kwargs.setdefault("request_timeout", self.request_timeout)
+        if plain and self.hedge:
+            delay = self.hedge_delay()
+            if delay is not None:
+                return self._hedged_fetch(path, query, kwargs, delay, token)
+        return self._attempt(self.next_replica(), path, query, kwargs, plain, token)
+
+    def _attempt(self, replica, path, query, kwargs, plain, token):
+        start = time.monotonic()
+        future = self.http_client.fetch(self.url(replica, path, query), **kwargs)
+        if self.metrics is not None:
+            self.metrics.track(self.name, path, future)
+
+        def done(future):
+            failed = _failed(future)
+            if self.breaker is not None:
+                self.breaker.record(token, failed)
+            if plain and not failed:
+                self._latencies.append(time.monotonic() - start)
+                self._new_samples += 1
+
+        future.add_done_callback(done)
+        return future
+
+    def _hedged_fetch(self, path, query, kwargs, delay, token):
+        # Resolves like the first successful attempt, or like the last one if all of them fail
+        # A first attempt failing before the delay is over is retried on the next replica at once
+        # The hedge or retry goes to the replica after the first attempt's, picked explicitly:
+        # requests made in the meantime advance the round-robin, which could lead back to it
+        result = Future()
+        attempts = []
+        io_loop = tornado.ioloop.IOLoop.current()
+        replica = self.next_replica()
+
+        def hedge():
+            if result.done() or len(attempts) > 1:
+                return
+            hedge_token = None
+            if self.breaker is not None:
+                hedge_token = self.breaker.allow()
+                if hedge_token is None:
+                    return
+            self.hedged += 1
+            launch((replica + 1) % len(self.urls), hedge_token)
+
+        def launch(replica, token):
+            attempt = self._attempt(replica, path, query, kwargs, True, token)
+            attempts.append(attempt)
+            attempt.add_done_callback(done)
+
+        def done(attempt):
+            if result.done():
+                return
+            if not _failed(attempt):
+                if attempt is not attempts[0]:
+                    self.hedges_won += 1
+                io_loop.remove_timeout(timeout)
+                chain_future(attempt, result)
+            elif len(attempts) == 1:
+                io_loop.remove_timeout(timeout)
+                hedge()
+                if len(attempts) == 1:
+                    chain_future(attempt, result)
+            elif all(other.done() for other in attempts):
+                chain_future(attempt, result)
+
+        timeout = io_loop.call_later(delay, hedge)
+        launch(replica, token)
+        return result
+
+    def hedge_delay(self):
+        # Recent p95 latency of plain GETs (recomputed every 32 samples), None until there are enough of them
+        if len(self._latencies) < self.MIN_LATENCY_SAMPLES:
+            return None
+        if self._p95 is None or self._new_samples >= 32:
+            latencies = sorted(self._latencies)
+            self._p95 = latencies[int(0.95 * (len(latencies) - 1))]
+            self._new_samples = 0
+        return max(self._p95, self.hedge_min_delay)
+
+    def retry_after(self):
+        return self.breaker.retry_after() if self.breaker is not None else 0
+
+    def stats(self):
+        return {
+            "hedged": self.hedged,
+            "hedges_won": self.hedges_won,
+            "hedge_delay": self.hedge_delay() if self.hedge else None,
+            "breaker": self.breaker.stats() if self.breaker is not None else None,
+        }
+
+
+# Whether a finished fetch failed in a way that says something about the upstream's health
+# Connection errors, timeouts (599) and 5xx responses count, client errors (4xx) do not
+def _failed(future):
+    error = future.exception()
+    if error is not None:
+        code = getattr(error, "code", None)
+        return code is None or code >= 500
+    return future.result().code >= 500
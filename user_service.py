@@ -1,24 +1,162 @@
 import tornado.web
 import tornado.log
 import tornado.options
-import sqlite3
+import tornado.escape
+import tornado.iostream
+import tornado.locks
+import tornado.ioloop
 import logging
-import json
 import time
+import base64
+import hashlib
+import datetime
+from collections import OrderedDict
+from contextlib import closing
+from cache import ResponseCache
+from db import Database
+from metrics import Registry, RequestMetrics, DatabaseMetrics, MetricsHandler
+import serialization
+import serving
+
+
+# Maximum number of items accepted by a single batch request
+MAX_BATCH_SIZE = 10000
+# Maximum number of rows returned by a single change feed request
+MAX_CHANGES_LIMIT = 1000
+# Maximum number of seconds a change feed request may long-poll for
+MAX_CHANGES_WAIT = 60
+# Interval (in seconds) at which long-polling readers re-check the db, to also pick up
+# writes committed by other processes, which do not notify this one
+CHANGES_POLL_INTERVAL = 1.0
+# Maximum number of ids looked up by a single GET /users?ids= request
+MAX_LOOKUP_IDS = 10000
+# Ids bound per IN (...) query, kept below SQLite's host parameter limit
+LOOKUP_CHUNK_SIZE = 500
+# Range of SQLite integers, and so of user ids (and of any integer bound to a statement)
+MIN_ID = -2 ** 63
+MAX_ID = 2 ** 63 - 1
+# Rough per-row overhead (in bytes) of a cached user row, on top of its values
+CACHED_ROW_OVERHEAD = 100
 
 
 class App(tornado.web.Application):
 
-    def __init__(self, handlers, **kwargs):
+    def __init__(self, handlers, db_path="users.db", db_pool_size=4,
+                 group_commit_window_ms=0, group_commit_max_batch=128, version_refresh_ms=1000,
+                 user_cache_ttl=60.0, user_cache_max_entries=100000, user_cache_max_bytes=32 * 1024 * 1024, **kwargs):
         super().__init__(handlers, **kwargs)
 
-        # Initialising db connection
-        self.db = sqlite3.connect("users.db")
-        self.db.row_factory = sqlite3.Row
+        # Initialising metrics, served on /metrics
+        self.metrics = Registry()
+        self.request_metrics = RequestMetrics(self.metrics)
+
+        # Initialising the cache of user rows behind lookups by id, disabled when user_cache_ttl is 0
+        # Writes through this process drop the rows they touch, the ttl bounds how long rows
+        # changed by other processes can be served
+        self.user_cache = None
+        if user_cache_ttl > 0:
+            self.user_cache = ResponseCache(
+                user_cache_ttl, max_entries=user_cache_max_entries, max_bytes=user_cache_max_bytes)
+            self.metrics.collector(
+                "user_cache_events_total", "User rows cache events", "counter",
+                lambda: {(event,): self.user_cache.stats()[event]
+                         for event in ("hits", "misses", "evictions", "expirations", "invalidations")},
+                labels=("event",)
+            )
+            self.metrics.collector(
+                "user_cache_bytes", "Estimated size of the cached user rows", "gauge",
+                lambda: self.user_cache.size_bytes
+            )
+
+        # Initialising db access layer, queries run off the IOLoop thread
+        # A non-zero group commit window batches concurrent inserts into one transaction
+        self.db = Database(
+            db_path,
+            pool_size=db_pool_size,
+            group_commit_window=(group_commit_window_ms / 1000.0) if group_commit_window_ms > 0 else None,
+            group_commit_max_batch=group_commit_max_batch,
+            observer=DatabaseMetrics(self.metrics)
+        )
         self.init_db()
 
+        # Long-polling change feed readers wait on this until a write commits
+        self.changes = tornado.locks.Condition()
+
+        # Writes made by other processes only show up in data_version once it is re-read
+        self.version_refresh = None
+        if version_refresh_ms > 0:
+            self.version_refresh = tornado.ioloop.PeriodicCallback(self.refresh_version, version_refresh_ms)
+            self.version_refresh.start()
+
+    def log_request(self, handler):
+        super().log_request(handler)
+        self.request_metrics.observe(handler)
+
+    def notify_changes(self, last_id):
+        # Releases long-polling change feed readers, called once a write has committed
+        self.bump_version(last_id)
+        self.changes.notify_all()
+
+    def invalidate_users(self, ids):
+        # Drops the cached rows of users written by this process
+        if self.user_cache is not None:
+            self.user_cache.invalidate(ids)
+
+    @tornado.gen.coroutine
+    def lookup_users(self, ids):
+        # Rows of the users with the given (distinct) ids, in USER_FIELDS order and in the
+        # order of ids, taken from the user cache when there. Ids that do not exist are left out.
+        cache = self.user_cache
+        if cache is None:
+            results = yield query_users_by_ids(self.db, ids)
+            return results
+
+        rows_by_id = {}
+        missing_ids = []
+        for id in ids:
+            row = cache.get(id)
+            if row is None:
+                missing_ids.append(id)
+            else:
+                rows_by_id[id] = row
+        if missing_ids:
+            # Rows read before a write to them are not cached, see ResponseCache.invalidate
+            generation = cache.generation
+            results = yield query_users_by_ids(self.db, missing_ids)
+            for row in results:
+                row = tuple(row)
+                rows_by_id[row[0]] = row
+                cache.set(row[0], row, cached_row_size(row), generation=generation)
+        return [rows_by_id[id] for id in ids if id in rows_by_id]
+
+    def bump_version(self, version):
+        # Rows are only ever inserted, so the highest id changes on every write, and
+        # ids are handed out in commit order
+        if version is not None and version > self.data_version:
+            self.data_version = version
+
+    @tornado.gen.coroutine
+    def refresh_version(self):
+        try:
+            results = yield self.db.query("SELECT MAX(id) AS version FROM users")
+            self.bump_version(results[0]["version"])
+        except:
+            logging.exception("Error while refreshing data version")
+
+    def close(self):
+        # Flushes pending group commits and closes every db connection
+        if self.version_refresh is not None:
+            self.version_refresh.stop()
+        self.db.close()
+
     def init_db(self):
-        cursor = self.db.cursor()
+        # Schema setup and the initial data version read run once at startup, on a short-lived connection
+        with closing(self.db.connect()) as conn:
+            self._create_schema(conn)
+            self.data_version = conn.execute("SELECT MAX(id) FROM users").fetchone()[0] or 0
+
+    def _create_schema(self, conn):
+        cursor = conn.cursor()
 
         # Create table
         cursor.execute(
@@ -29,20 +167,185 @@ class App(tornado.web.Application):
             + "updated_at INTEGER NOT NULL"
             + ");"
         )
-        self.db.commit()
+
+        # Create index backing the (created_at, id) ordering used by pagination,
+        # so that both page_num and cursor pages are served by an index range scan
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS 'idx_users_created_at' "
+            + "ON 'users' (created_at, id);"
+        )
+
+        # Create index finding where the change feed starts when resuming from an updated_at
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS 'idx_users_updated_at' "
+            + "ON 'users' (updated_at, id);"
+        )
+        conn.commit()
 
 
 class BaseHandler(tornado.web.RequestHandler):
     def write_json(self, obj, status_code=200):
-        self.set_header("Content-Type", "application/json")
+        # Compact output unless ?pretty=1 is passed, MessagePack when the client accepts it
+        self.set_header("Vary", "Accept")
         self.set_status(status_code)
-        self.write(json.dumps((obj), indent=4))
+        if status_code != 200:
+            # Errors are never cached, see check_not_modified
+            self.clear_header("Etag")
+        if self.binary_requested():
+            self.set_header("Content-Type", serialization.MSGPACK_CONTENT_TYPES[0])
+            self.write(serialization.dumps_binary(obj))
+            return
+        pretty = self.get_argument("pretty", "0").lower() in ("1", "true")
+        self.set_header("Content-Type", "application/json")
+        self.write(serialization.dumps(obj, pretty=pretty))
+
+    def binary_requested(self):
+        return serialization.binary_accepted(self.request.headers.get("Accept"))
+
+    def columnar_requested(self):
+        # ?format=columnar returns pages as one array per column instead of one object per row
+        return self.get_argument("format", "rows") == "columnar"
+
+    def check_not_modified(self):
+        # Tags the response with the data version and the query args, and answers
+        # with 304 when the client's If-None-Match still matches, before any SQL runs
+        # JSON and MessagePack responses are different representations, with different tags
+        uri = self.request.uri + (" msgpack" if self.binary_requested() else "")
+        version = self.application.data_version
+        self.set_header("Etag", version_etag(version, uri))
+        # The response reflects at least this version, publicapi_service tags its pages with it
+        self.set_header("X-Data-Version", str(version))
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    @tornado.gen.coroutine
+    def write_ndjson(self, stream, fields):
+        # Streams query rows as newline-delimited JSON, one chunk of rows at a time
+        # Waiting on flush() after each chunk means a slow client slows down the reads
+        # instead of rows piling up in memory
+        self.set_header("Content-Type", "application/x-ndjson")
+        try:
+            while True:
+                rows = yield stream.next_chunk()
+                if not rows:
+                    break
+                lines = [
+                    tornado.escape.utf8(serialization.dumps({field: row[field] for field in fields}))
+                    for row in rows
+                ]
+                self.write(b"\n".join(lines) + b"\n")
+                yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            logging.info("Client closed the connection during export")
+        finally:
+            stream.close()
+
+
+# Columns of a user, in the order GET /users selects them
+USER_FIELDS = ("id", "name", "created_at", "updated_at")
+
+
+# Looks users up by id, resolving to rows in USER_FIELDS order, in the order of ids.
+# Ids that do not exist are left out.
+# A single id is a primary key lookup, more run one IN (...) query per chunk of ids.
+# Chunks are padded (with repeats of their last id) to a power of two, or LOOKUP_CHUNK_SIZE,
+# so that only a handful of distinct statements reach SQLite and they stay in the
+# connections' prepared statement caches.
+@tornado.gen.coroutine
+def query_users_by_ids(db, ids):
+    if len(ids) == 1:
+        results = yield db.query("SELECT {} FROM users WHERE id=?".format(",".join(USER_FIELDS)), ids)
+        return results
+
+    rows_by_id = {}
+    for start in range(0, len(ids), LOOKUP_CHUNK_SIZE):
+        chunk = ids[start:start + LOOKUP_CHUNK_SIZE]
+        size = 1
+        while size < len(chunk):
+            size *= 2
+        chunk = chunk + chunk[-1:] * (min(size, LOOKUP_CHUNK_SIZE) - len(chunk))
+        select_stmt = "SELECT {} FROM users WHERE id IN ({})".format(",".join(USER_FIELDS), ",".join("?" * len(chunk)))
+        results = yield db.query(select_stmt, chunk)
+        for row in results:
+            rows_by_id[row["id"]] = row
+    return [rows_by_id[id] for id in ids if id in rows_by_id]
+
+
+# Size estimate of a cached user row, in bytes
+def cached_row_size(row):
+    return CACHED_ROW_OVERHEAD + sum(len(value) if isinstance(value, str) else 8 for value in row)
+
+
+# Parses comma separated ids, dropping duplicates but keeping request order
+# Ids SQLite cannot store (beyond 64 bits) are dropped too, as no user can have them
+# Raises ValueError on anything but integers
+def parse_ids(ids_arg):
+    ids = [int(id) for id in ids_arg.split(",") if id.strip()]
+    return list(OrderedDict.fromkeys(id for id in ids if MIN_ID <= id <= MAX_ID))
+
+
+# Strong ETag for a response computed from the data version and the request URI
+def version_etag(version, uri):
+    digest = hashlib.sha1(tornado.escape.utf8(uri)).hexdigest()[:16]
+    return '"{}-{}"'.format(version, digest)
+
+
+# Opaque pagination cursors, encoding the (created_at, id) of the last row on a page
+def encode_cursor(created_at, id):
+    token = "{}:{}".format(created_at, id).encode("ascii")
+    return base64.urlsafe_b64encode(token).decode("ascii")
+
+
+def decode_cursor(cursor):
+    token = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii")
+    created_at, id = token.split(":")
+    return int(created_at), int(id)
+
+
+# Change feed resume tokens, encoding the last id read
+# Users are only ever inserted, and AUTOINCREMENT ids are handed out inside the writer's
+# transaction, so ids grow in commit order: whatever its updated_at, which is stamped
+# before the transaction, a user committed after a token was issued has a higher id.
+def encode_since(mark):
+    return base64.urlsafe_b64encode(str(mark).encode("ascii")).decode("ascii")
+
+
+def decode_since(since):
+    return int(base64.urlsafe_b64decode(since.encode("ascii")).decode("ascii"))
+
+
+# Users after the mark, in commit order, in USER_FIELDS order
+CHANGES_STMT = "SELECT {} FROM users WHERE id>? ORDER BY id LIMIT ?".format(",".join(USER_FIELDS))
+
+# Mark the change feed starts from when resuming from an updated_at: right before
+# the first user updated after it, or the last user when there is none yet
+# MIN(+id) reads the ids off the updated_at index, MIN(id) would walk the primary key instead
+CHANGES_START_STMT = (
+    "SELECT IFNULL((SELECT MIN(+id) FROM users WHERE updated_at>?) - 1, "
+    + "(SELECT IFNULL(MAX(id), 0) FROM users))"
+)
 
 
 # /users
 class UsersHandler(BaseHandler):
     @tornado.gen.coroutine
     def get(self):
+        # Nothing to do when the client already has this version of the response
+        if self.check_not_modified():
+            return
+
+        if self.get_argument("format", "rows") not in ("rows", "columnar"):
+            self.write_json({"result": False, "errors": "invalid format. Supported values: 'rows', 'columnar'"}, status_code=400)
+            return
+
+        # Multi-id lookup (/users?ids=1,2,3) skips pagination entirely
+        ids_arg = self.get_argument("ids", None)
+        if ids_arg is not None:
+            yield self._get_by_ids(ids_arg)
+            return
+
         # Parsing pagination params
         page_num = self.get_argument("page_num", 1)
         page_size = self.get_argument("page_size", 10)
@@ -60,25 +363,71 @@ class UsersHandler(BaseHandler):
             self.write_json({"result": False, "errors": "invalid page_size"}, status_code=400)
             return
 
+        # Parsing cursor param
+        # An empty cursor requests the first page in cursor mode
+        cursor_arg = self.get_argument("cursor", None)
+        after = None
+        if cursor_arg:
+            try:
+                after = decode_cursor(cursor_arg)
+            except:
+                logging.exception("Error while parsing cursor: {}".format(cursor_arg))
+                self.write_json({"result": False, "errors": "invalid cursor"}, status_code=400)
+                return
+
         # Building select statement
-        select_stmt = "SELECT * FROM users"
+        select_stmt = "SELECT {} FROM users".format(",".join(USER_FIELDS))
+        args = []
+        # Adding keyset clause to resume after the cursor row
+        if after is not None:
+            select_stmt += " WHERE created_at<=? AND (created_at<? OR id<?)"
+            args.extend([after[0], after[0], after[1]])
         # Order by and pagination
-        limit = page_size
-        offset = (page_num - 1) * page_size
-        select_stmt += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
+        select_stmt += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        args.append(page_size)
+        if cursor_arg is None:
+            select_stmt += " OFFSET ?"
+            args.append((page_num - 1) * page_size)
 
         # Fetching users from db
-        args = (limit, offset)  
-        cursor = self.application.db.cursor()
-        results = cursor.execute(select_stmt, args)
+        results = yield self.application.db.query(select_stmt, args)
 
-        users = []
-        for row in results:
-            fields = ["id", "name", "created_at", "updated_at"]
-            user = {
-                field: row[field] for field in fields
-            }
-            users.append(user)
+        # Rows are selected in USER_FIELDS order
+        if self.columnar_requested():
+            users = serialization.columns(USER_FIELDS, results)
+        else:
+            users = [dict(zip(USER_FIELDS, row)) for row in results]
+
+        if cursor_arg is not None:
+            # A short page means there is nothing left to read
+            next_cursor = None
+            if len(results) == page_size and page_size > 0:
+                last = results[-1]
+                next_cursor = encode_cursor(last["created_at"], last["id"])
+            self.write_json({"result": True, "users": users, "next_cursor": next_cursor})
+            return
+
+        self.write_json({"result": True, "users": users})
+
+    @tornado.gen.coroutine
+    def _get_by_ids(self, ids_arg):
+        try:
+            ids = parse_ids(ids_arg)
+        except:
+            logging.exception("Error while parsing ids: {}".format(ids_arg))
+            self.write_json({"result": False, "errors": "invalid ids"}, status_code=400)
+            return
+
+        if len(ids) > MAX_LOOKUP_IDS:
+            self.write_json({"result": False, "errors": "at most {} ids can be looked up".format(MAX_LOOKUP_IDS)}, status_code=400)
+            return
+
+        # Fetching users from the user cache or the db, rows are in USER_FIELDS order
+        results = yield self.application.lookup_users(ids)
+        if self.columnar_requested():
+            users = serialization.columns(USER_FIELDS, results)
+        else:
+            users = [dict(zip(USER_FIELDS, row)) for row in results]
 
         self.write_json({"result": True, "users": users})
 
@@ -97,27 +446,27 @@ class UsersHandler(BaseHandler):
             return
             
         # Proceed to store the users in our db
-        cursor = self.application.db.cursor()
-        cursor.execute(
+        lastrowid = yield self.application.db.execute(
             "INSERT INTO 'users' "
             + "('name', 'created_at', 'updated_at') "
             + "VALUES (?, ?, ?)",
             (name_val, time_now, time_now)
         )
-        self.application.db.commit()
 
         # Error out if we fail to retrieve the newly created user
-        if cursor.lastrowid is None:
+        if lastrowid is None:
             self.write_json({"result": False, "errors": ["Error while adding user to db"]}, status_code=500)
             return
 
         user = dict(
-            id=cursor.lastrowid,
+            id=lastrowid,
             name=name_val,
             created_at=time_now,
             updated_at=time_now
         )
 
+        self.application.invalidate_users([lastrowid])
+        self.application.notify_changes(lastrowid)
         self.write_json({"result": True, "user": user})
 
     # assumptions: we only want strings that only have letters in them, "dan99" or 95 are not valid names
@@ -132,52 +481,201 @@ class UsersHandler(BaseHandler):
             return None
 
 
-# /users/id
-# only GET supported
-class UserIDHandler(BaseHandler):
+# /users/batch
+# only POST supported, body is a JSON array of users
+class UsersBatchHandler(UsersHandler):
+    SUPPORTED_METHODS = ("POST",)
+
     @tornado.gen.coroutine
-    def get(self, id):
-        # Parsing pagination params
-        page_num = self.get_argument("page_num", 1)
-        page_size = self.get_argument("page_size", 10)
+    def post(self):
         try:
-            page_num = int(page_num)
+            items = serialization.loads(self.request.body)
         except:
-            logging.exception("Error while parsing page_num: {}".format(page_num))
-            self.write_json({"result": False, "errors": "invalid page_num"}, status_code=400)
+            logging.exception("Error while parsing batch body")
+            self.write_json({"result": False, "errors": "invalid JSON body"}, status_code=400)
             return
 
-        try:
-            page_size = int(page_size)
-        except:
-            logging.exception("Error while parsing page_size: {}".format(page_size))
-            self.write_json({"result": False, "errors": "invalid page_size"}, status_code=400)
+        if not isinstance(items, list):
+            self.write_json({"result": False, "errors": "body must be a JSON array"}, status_code=400)
             return
 
-        select_stmt = "SELECT * FROM users WHERE id = {}".format(id)
+        if len(items) > MAX_BATCH_SIZE:
+            self.write_json({"result": False, "errors": "batch size must be at most {}".format(MAX_BATCH_SIZE)}, status_code=400)
+            return
 
-        # Order by and pagination
-        limit = page_size
-        offset = (page_num - 1) * page_size
-        select_stmt += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
+        # Validating every item with the same rules as POST /users, collecting errors per item
+        time_now = int(time.time() * 1e6) # Converting current time to microseconds
+        rows = []
+        item_errors = []
+        for index, item in enumerate(items):
+            errors = []
+            if not isinstance(item, dict):
+                item_errors.append({"index": index, "errors": ["item must be a JSON object"]})
+                continue
+            if item.get("name") is None:
+                item_errors.append({"index": index, "errors": ["missing name"]})
+                continue
+
+            name_val = self._validate_name(item["name"], errors)
+            if len(errors) > 0:
+                item_errors.append({"index": index, "errors": errors})
+                continue
+            rows.append((name_val, time_now, time_now))
+
+        # The batch is all-or-nothing, end if any item is invalid
+        if len(item_errors) > 0:
+            self.write_json({"result": False, "errors": item_errors}, status_code=400)
+            return
 
-        # Fetching users from db
-        args = (limit, offset)  
-        cursor = self.application.db.cursor()
-        results = cursor.execute(select_stmt, args)
-        user = []
-        for row in results:
-            fields = ["id", "name", "created_at", "updated_at"]
-            user_info = {
-                field: row[field] for field in fields
-            }
-            user.append(user_info)
+        # Proceed to store all users in one transaction
+        ids = yield self.application.db.execute_many(
+            "INSERT INTO 'users' "
+            + "('name', 'created_at', 'updated_at') "
+            + "VALUES (?, ?, ?)",
+            rows
+        )
+
+        users = []
+        for id, row in zip(ids, rows):
+            users.append(dict(
+                id=id,
+                name=row[0],
+                created_at=row[1],
+                updated_at=row[2]
+            ))
+
+        self.application.invalidate_users(ids)
+        self.application.notify_changes(ids[-1] if ids else None)
+        self.write_json({"result": True, "users": users})
+
+
+# /users/export
+# only GET supported, streams every user as newline-delimited JSON
+class UsersExportHandler(BaseHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        # Parsing since (updated_at, in microseconds) filter
+        since = self.get_argument("since", None)
+        if since is not None:
+            try:
+                since = int(since)
+            except:
+                self.write_json({"result": False, "errors": "invalid since"}, status_code=400)
+                return
+
+        # Building select statement
+        select_stmt = "SELECT {} FROM users".format(",".join(USER_FIELDS))
+        args = []
+        if since is not None:
+            select_stmt += " WHERE updated_at>?"
+            # Clamped to the SQLite integers, beyond them nothing (or everything) is newer anyway
+            args.append(min(max(since, MIN_ID), MAX_ID))
+        select_stmt += " ORDER BY id"
+
+        yield self.write_ndjson(self.application.db.stream(select_stmt, args), USER_FIELDS)
+
+
+# /users/version
+# only GET supported, returns the current data version, which changes on every write
+class UsersVersionHandler(BaseHandler):
+    def get(self):
+        self.write_json({"result": True, "version": self.application.data_version})
 
+
+# /users/changes
+# only GET supported, returns rows committed after `since`, in commit order
+class UsersChangesHandler(BaseHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        # Parsing since param: either a resume token from a previous response,
+        # or a plain updated_at in microseconds (defaults to the beginning of time)
+        since = self.get_argument("since", "0")
+        updated_after = None
         try:
-            self.write_json({"result": True, "user": user_info})
+            if since.isdigit():
+                updated_after = int(since)
+            else:
+                try:
+                    mark = decode_since(since)
+                except ValueError:
+                    # Tokens of the former (updated_at, id) ordered feed resume from their updated_at
+                    updated_after = decode_cursor(since)[0] - 1
+            if updated_after is not None:
+                # Users are never updated after the largest updated_at SQLite stores
+                updated_after = min(updated_after, MAX_ID)
+            elif not MIN_ID <= mark <= MAX_ID:
+                raise ValueError("since is out of range")
         except:
+            logging.exception("Error while parsing since: {}".format(since))
+            self.write_json({"result": False, "errors": "invalid since"}, status_code=400)
+            return
+
+        # Parsing limit and wait (long-polling timeout, in seconds) params
+        try:
+            limit = int(self.get_argument("limit", 100))
+            wait = float(self.get_argument("wait", 0))
+        except:
+            self.write_json({"result": False, "errors": "invalid limit or wait"}, status_code=400)
+            return
+        limit = max(1, min(limit, MAX_CHANGES_LIMIT))
+        wait = max(0.0, min(wait, MAX_CHANGES_WAIT))
+
+        # Finding where the feed starts
+        db = self.application.db
+        if updated_after is not None and updated_after > 0:
+            start = yield db.query(CHANGES_START_STMT, (updated_after,))
+            mark = start[0][0]
+        elif updated_after is not None:
+            mark = 0
+
+        results = yield db.query(CHANGES_STMT, (mark, limit))
+
+        # Long-polling: wait for a commit on this node, re-checking the db periodically
+        io_loop = tornado.ioloop.IOLoop.current()
+        deadline = io_loop.time() + wait
+        while not results and io_loop.time() < deadline:
+            timeout = min(deadline - io_loop.time(), CHANGES_POLL_INTERVAL)
+            yield self.application.changes.wait(timeout=datetime.timedelta(seconds=timeout))
+            results = yield db.query(CHANGES_STMT, (mark, limit))
+
+        users = [dict(zip(USER_FIELDS, row)) for row in results]
+
+        # The resume token holds the last id returned
+        if users:
+            mark = users[-1]["id"]
+        self.write_json({"result": True, "users": users, "next_since": encode_since(mark)})
+
+
+# /users/<id>, or /users/<id>,<id>,... for several users
+# only GET supported
+class UserIDHandler(UsersHandler):
+    SUPPORTED_METHODS = ("GET",)
+
+    @tornado.gen.coroutine
+    def get(self, ids_arg):
+        # Nothing to do when the client already has this version of the response
+        if self.check_not_modified():
+            return
+
+        if self.get_argument("format", "rows") not in ("rows", "columnar"):
+            self.write_json({"result": False, "errors": "invalid format. Supported values: 'rows', 'columnar'"}, status_code=400)
+            return
+
+        # Several ids (/users/1,2,3) answer like /users?ids=1,2,3
+        if "," in ids_arg:
+            yield self._get_by_ids(ids_arg)
+            return
+
+        # Primary key lookup, from the user cache or the db
+        # The route only matches digits, an id out of range parses to no id at all
+        results = yield self.application.lookup_users(parse_ids(ids_arg))
+        if self.columnar_requested():
+            self.write_json({"result": True, "user": serialization.columns(USER_FIELDS, results)})
+        elif not results:
             # if id doesn't exist, return result=True with empty data, status_code=200 (based on listing_service implementation)
-            self.write_json({"result": True, "user": []}, status_code=200)
+            self.write_json({"result": True, "user": []})
+        else:
+            self.write_json({"result": True, "user": dict(zip(USER_FIELDS, results[0]))})
 
 
 # /users/ping
@@ -187,12 +685,39 @@ class PingHandler(tornado.web.RequestHandler):
         self.write("pong!")
 
 
+def define_options(parser=tornado.options.options):
+    # Specify how long (in seconds) user rows stay cached for lookups by id (0 disables the cache)
+    parser.define("user_cache_ttl", default=60.0)
+    # Specify the maximum number of cached user rows, least recently used ones are evicted first
+    parser.define("user_cache_max_entries", default=100000)
+    # Specify the maximum estimated size (in bytes) of the cached user rows
+    parser.define("user_cache_max_bytes", default=32 * 1024 * 1024)
+
+
 def make_app(options):
-    return App([
+    serialization.use_backend(options.json_backend)
+    handlers = [
+        (r"/metrics", MetricsHandler),
         (r"/users/ping", PingHandler),
         (r"/users", UsersHandler),
-        (r"/users/([0-9]+)", UserIDHandler),
-    ], debug=options.debug)
+        (r"/users/batch", UsersBatchHandler),
+        (r"/users/export", UsersExportHandler),
+        (r"/users/version", UsersVersionHandler),
+        (r"/users/changes", UsersChangesHandler),
+        (r"/users/([0-9]+(?:,[0-9]+)*)", UserIDHandler),
+    ]
+    return App(
+        handlers,
+        db_path=options.db_path,
+        db_pool_size=options.db_pool_size,
+        group_commit_window_ms=options.group_commit_window_ms,
+        group_commit_max_batch=options.group_commit_max_batch,
+        version_refresh_ms=options.version_refresh_ms,
+        user_cache_ttl=options.user_cache_ttl,
+        user_cache_max_entries=options.user_cache_max_entries,
+        user_cache_max_bytes=options.user_cache_max_bytes,
+        debug=options.debug
+    )
 
 
 if __name__ == "__main__":
@@ -200,8 +725,25 @@ if __name__ == "__main__":
     # Specify the port number to start the web app on (default value is port 6000)
     tornado.options.define("port", default=6000)
     # Specify whether the app should run in debug mode
-    # Debug mode restarts the app automatically on file changes
-    tornado.options.define("debug", default=True)
+    # Debug mode restarts the app automatically on file changes, only use it in development
+    tornado.options.define("debug", default=False)
+    # Define the process model options (processes, reuse_port, shutdown_timeout, max_restarts)
+    serving.define_options()
+    # Specify the SQLite database file
+    tornado.options.define("db_path", default="users.db")
+    # Specify the number of threads (and SQLite connections) serving queries
+    tornado.options.define("db_pool_size", default=4)
+    # Specify the JSON backend: orjson, ujson, json, or auto to pick the fastest installed one
+    tornado.options.define("json_backend", default="auto")
+    # Specify how long (in ms) inserts may wait to be committed together with others (0 disables group commit)
+    tornado.options.define("group_commit_window_ms", default=0)
+    # Specify the maximum number of inserts committed in one group commit transaction
+    tornado.options.define("group_commit_max_batch", default=128)
+    # Specify how often (in ms) the data version behind ETags is re-read from the db, so that
+    # writes made by other processes are noticed (0 disables, only safe with a single process)
+    tornado.options.define("version_refresh_ms", default=1000)
+    # Define the user cache options
+    define_options()
 
     # Read settings/options from command line
     tornado.options.parse_command_line()
@@ -209,10 +751,5 @@ if __name__ == "__main__":
     # Access the settings defined
     options = tornado.options.options
 
-    # Create web app
-    app = make_app(options)
-    app.listen(options.port)
-    logging.info("Starting user service. PORT: {}, DEBUG: {}".format(options.port, options.debug))
-
-    # Start event loop
-    tornado.ioloop.IOLoop.instance().start()
+    # Create web app(s) and start event loop(s)
+    serving.serve(make_app, options, "user service")
@@ -0,0 +1,285 @@
+import collections
+import logging
+import os
+import time
+import uuid
+import tornado.concurrent
+import tornado.escape
+import tornado.gen
+import tornado.locks
+import serialization
+
+
+# Raised by WriteQueue.submit() when the queue already holds max_size writes
+class QueueFull(Exception):
+    pass
+
+
+# A write waiting to be forwarded
+QueuedWrite = collections.namedtuple("QueuedWrite", ["tracking_id", "item", "queued_at"])
+
+
+# Write-behind queue forwarding single writes to an upstream batch endpoint
+# submit() accepts an item into a bounded in-memory queue and hands back a tracking
+# id. A background loop sends queued items in batches of up to batch_size as one
+# JSON array POST to path (e.g. /listings/batch), waiting batch_window seconds for a
+# batch to fill up. Failed batches (connection errors, timeouts, 5xx) are retried
+# max_retries times with exponential backoff starting at retry_delay; items rejected
+# by the upstream's validation fail on their own, and the rest of the batch is sent again.
+# Delivery is at least once: a batch that timed out may have been stored anyway.
+# With spool_path, accepted items are appended to a local file, and items still in it
+# at startup are queued again, so writes survive a restart (not a power loss, the
+# file is not fsynced). Every finished write appends a done marker; once markers
+# outnumber the pending writes (and SPOOL_COMPACT_MIN), the file is rewritten with the
+# pending writes only, so it stays in proportion to the queue under steady load.
+# A spool file must only ever be used by one queue at a time.
+# The outcome of a write is kept for the last RESULTS_KEPT writes, see status().
+class WriteQueue(object):
+    RESULTS_KEPT = 10000
+    MAX_RETRY_DELAY = 5.0
+    SPOOL_COMPACT_MIN = 1000
+
+    def __init__(self, name, upstream, path, key, item_key, max_size=10000, batch_size=100, batch_window=0.005,
+                 max_retries=5, retry_delay=0.1, spool_path=None, on_forwarded=None):
+        self.name = name
+        self.upstream = upstream
+        self.path = path
+        self.key = key  # field of the upstream response holding the stored items
+        self.item_key = item_key  # field holding the stored item in a forwarded write's status
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.spool_path = spool_path
+        self.on_forwarded = on_forwarded
+        self.accepted = 0
+        self.forwarded = 0
+        self.failed = 0
+        self.retries = 0
+        self.batches = 0
+        self._queue = collections.deque()
+        self._in_flight = []
+        self._pending = {}  # tracking id -> QueuedWrite, queued or in flight
+        self._waiters = {}  # tracking id -> Future resolving to the write's status
+        self._results = collections.OrderedDict()  # tracking id -> status, of finished writes
+        self._ready = tornado.locks.Event()
+        self._stopped = False
+        self._spool = None
+        self._spool_done = 0  # done markers in the spool file
+        if spool_path is not None:
+            self._load_spool()
+
+    def start(self):
+        self._run()
+
+    def stop(self):
+        self._stopped = True
+        self._ready.set()
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+    def submit(self, item):
+        # Queues item and returns its tracking id, raises QueueFull when there is no room
+        if len(self._pending) >= self.max_size:
+            raise QueueFull("{} write queue is full".format(self.name))
+        write = QueuedWrite(uuid.uuid4().hex, item, time.monotonic())
+        self._spool_append({"id": write.tracking_id, "item": item})
+        self._enqueue(write)
+        self.accepted += 1
+        return write.tracking_id
+
+    def wait(self, tracking_id):
+        # Future resolving to the write's final status (see status()) once it is forwarded or failed
+        future = self._waiters.get(tracking_id)
+        if future is None:
+            future = tornado.concurrent.Future()
+            status = self.status(tracking_id)
+            if status is not None and status["status"] != "queued":
+                future.set_result(status)
+            else:
+                self._waiters[tracking_id] = future
+        return future
+
+    def status(self, tracking_id):
+        # {"status": "queued"}, {"status": "forwarded", <item_key>: stored item},
+        # {"status": "failed", "errors": ...}, or None for unknown (or long forgotten) writes
+        if tracking_id in self._pending:
+            return {"status": "queued"}
+        return self._results.get(tracking_id)
+
+    def depth(self):
+        return len(self._pending)
+
+    def lag(self):
+        # Seconds the oldest write still pending has been waiting
+        oldest = self._in_flight[0] if self._in_flight else (self._queue[0] if self._queue else None)
+        return time.monotonic() - oldest.queued_at if oldest is not None else 0.0
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "lag_seconds": round(self.lag(), 3),
+            "accepted": self.accepted,
+            "forwarded": self.forwarded,
+            "failed": self.failed,
+            "retries": self.retries,
+            "batches": self.batches,
+        }
+
+    def _enqueue(self, write):
+        self._queue.append(write)
+        self._pending[write.tracking_id] = write
+        self._ready.set()
+
+    @tornado.gen.coroutine
+    def _run(self):
+        while not self._stopped:
+            if not self._queue:
+                self._ready.clear()
+                yield self._ready.wait()
+                continue
+            if len(self._queue) < self.batch_size and self.batch_window > 0:
+                yield tornado.gen.sleep(self.batch_window)
+            while self._queue and len(self._in_flight) < self.batch_size:
+                self._in_flight.append(self._queue.popleft())
+            try:
+                yield self._forward(self._in_flight)
+            except Exception:
+                logging.exception("Error while forwarding {} writes".format(self.name))
+                for write in self._in_flight:
+                    self._finish(write, {"status": "failed", "errors": "service error"})
+            self._in_flight = []
+
+    @tornado.gen.coroutine
+    def _forward(self, batch):
+        attempt = 0
+        while batch and not self._stopped:
+            self.batches += 1
+            try:
+                response = yield self.upstream.fetch(
+                    self.path,
+                    method="POST",
+                    body=serialization.dumps([write.item for write in batch]),
+                    headers={"Content-Type": "application/json"},
+                    raise_error=False
+                )
+            except Exception as e:
+                logging.warning("Error while forwarding {} writes: {}".format(self.name, e))
+                response = None
+
+            if response is not None and response.code == 200:
+                stored = serialization.loads(response.body)[self.key]
+                for write, item in zip(batch, stored):
+                    self._finish(write, {"status": "forwarded", self.item_key: item})
+                if self.on_forwarded is not None:
+                    self.on_forwarded()
+                return
+
+            if response is not None and 400 <= response.code < 500:
+                batch = self._reject(batch, response)
+                continue
+
+            attempt += 1
+            if attempt > self.max_retries:
+                logging.error("Giving up on {} {} writes after {} retries".format(len(batch), self.name, self.max_retries))
+                for write in batch:
+                    self._finish(write, {"status": "failed", "errors": "service error"})
+                return
+            self.retries += 1
+            yield tornado.gen.sleep(min(self.retry_delay * 2 ** (attempt - 1), self.MAX_RETRY_DELAY))
+
+    def _reject(self, batch, response):
+        # Fails the items the upstream rejected, returning the rest of the batch to send again
+        # The batch endpoints are all-or-nothing and report errors per item index
+        try:
+            errors = serialization.loads(response.body).get("errors")
+            errors_by_index = {error["index"]: error["errors"] for error in errors}
+        except Exception:
+            errors_by_index = None
+        if not errors_by_index:
+            logging.error("{} writes rejected by upstream: {}".format(self.name, response.code))
+            for write in batch:
+                self._finish(write, {"status": "failed", "errors": "rejected by upstream"})
+            return []
+
+        rest = []
+        for index, write in enumerate(batch):
+            if index in errors_by_index:
+                self._finish(write, {"status": "failed", "errors": errors_by_index[index]})
+            else:
+                rest.append(write)
+        return rest
+
+    def _finish(self, write, status):
+        if self._pending.pop(write.tracking_id, None) is None:
+            return
+        if status["status"] == "forwarded":
+            self.forwarded += 1
+        else:
+            self.failed += 1
+        self._results[write.tracking_id] = status
+        while len(self._results) > self.RESULTS_KEPT:
+            self._results.popitem(last=False)
+        self._spool_append({"id": write.tracking_id, "done": True})
+        if not self._pending:
+            self._truncate_spool()
+        elif self._spool_done >= max(self.SPOOL_COMPACT_MIN, len(self._pending)):
+            self._compact_spool()
+        future = self._waiters.pop(write.tracking_id, None)
+        if future is not None:
+            future.set_result(status)
+
+    def _load_spool(self):
+        # Queues the items accepted but not finished before the last shutdown, then compacts the file
+        unfinished = collections.OrderedDict()
+        if os.path.exists(self.spool_path):
+            with open(self.spool_path, "rb") as f:
+                for line in f:
+                    try:
+                        entry = serialization.loads(line)
+                    except Exception:
+                        # A line cut short by a crash
+                        continue
+                    if entry.get("done"):
+                        unfinished.pop(entry["id"], None)
+                    else:
+                        unfinished[entry["id"]] = entry["item"]
+        self._spool = open(self.spool_path, "wb")
+        for tracking_id, item in unfinished.items():
+            self._spool_append({"id": tracking_id, "item": item})
+            self._enqueue(QueuedWrite(tracking_id, item, time.monotonic()))
+        if unfinished:
+            logging.info("Requeued {} {} writes from {}".format(len(unfinished), self.name, self.spool_path))
+
+    def _spool_append(self, entry):
+        if self._spool is not None:
+            self._spool.write(_spool_line(entry))
+            self._spool.flush()
+            if entry.get("done"):
+                self._spool_done += 1
+
+    def _truncate_spool(self):
+        if self._spool is not None:
+            self._spool.seek(0)
+            self._spool.truncate()
+            self._spool_done = 0
+
+    def _compact_spool(self):
+        # Rewrites the spool with the pending writes only, through a temporary file
+        # replacing it in one step, so that a crash midway leaves the old spool in place
+        if self._spool is None:
+            return
+        tmp_path = self.spool_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for write in self._pending.values():
+                f.write(_spool_line({"id": write.tracking_id, "item": write.item}))
+        self._spool.close()
+        os.replace(tmp_path, self.spool_path)
+        self._spool = open(self.spool_path, "ab")
+        self._spool_done = 0
+
+
+def _spool_line(entry):
+    return tornado.escape.utf8(serialization.dumps(entry)) + b"\n"